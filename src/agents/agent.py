@@ -2,6 +2,10 @@ import logging
 import os
 from typing import Optional
 from dotenv import load_dotenv
+from agents.metrics import metrics
+
+# Records carry the agent in their attributes; see log_utils for the renderers
+logger = logging.getLogger("agents")
 
 class Agent:
     """
@@ -77,10 +81,60 @@ class Agent:
             raise FileNotFoundError(f"Required data file not found: {file_path}")
         return file_path if os.path.exists(file_path) else None
 
-    def log(self, message):
+    def log(self, message, event: Optional[str] = None, **fields):
+        """
+        Log this as an info message, identifying the agent.
+        The agent, event and fields travel on the record as attributes, and are only rendered
+        (in color, or as a JSON line) if a handler actually emits the record.
+
+        Args:
+            message: What happened
+            event: A short machine-readable name for what happened, such as 'prediction'
+            fields: Values to record with it, such as estimate='normal'
+        """
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        logger.info(message, extra={"agent": self.name, "color": self.BG_BLACK + self.color, "event": event, "fields": fields})
+
+    def timer(self, stage: str, **labels):
+        """
+        Time a block of work as a stage of the pipeline, for the metrics endpoint.
+
+        Args:
+            stage: The stage, such as 'scan' or 'featurize'
+            labels: Any further labels, such as the model
+        """
+        return metrics.timer("stage_seconds", stage=stage, **labels)
+
+    def count(self, name: str, value: float = 1, **labels):
+        """
+        Add to a counter, for the metrics endpoint.
+        """
+        metrics.count(name, value, **labels)
+
+    def record_prompt(self, prompt, response=None):
+        """
+        Log the size of a prompt against its budget, with the count the LLM reported if there is a response,
+        and count its tokens for the metrics endpoint.
+
+        Args:
+            prompt: The Prompt that was sent
+            response: The LLM's response, if the call has been made
+        """
+        usage = getattr(response, 'usage', None)
+        metrics.count("prompt_tokens_total", prompt.tokens, agent=self.name)
+        if prompt.omitted:
+            metrics.count("prompt_lines_omitted_total", prompt.omitted, agent=self.name)
+        self.log("Prompt tokens counted", event="prompt", tokens=prompt.tokens, budget=prompt.budget,
+                 reported_tokens=usage.prompt_tokens if usage is not None else None,
+                 events=prompt.events, lines=prompt.lines, omitted=prompt.omitted)
+
+    def count_llm_usage(self, response):
         """
-        Log this as an info message, identifying the agent
+        Count an LLM request and the tokens its response reports having used.
         """
-        color_code = self.BG_BLACK + self.color
-        message = f"[{self.name}] {message}"
-        logging.info(color_code + message + self.RESET)
+        metrics.count("llm_requests_total", agent=self.name)
+        usage = getattr(response, 'usage', None)
+        if usage is not None:
+            metrics.count("llm_tokens_total", usage.prompt_tokens or 0, agent=self.name, kind="prompt")
+            metrics.count("llm_tokens_total", usage.completion_tokens or 0, agent=self.name, kind="completion")
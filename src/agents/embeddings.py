@@ -0,0 +1,359 @@
+"""
+The sentence embedding model, shared by every caller through embed(). Requests from concurrent
+callers are gathered into batches, which the model encodes far faster per text than one at a time.
+
+By default each process loads the model itself, once. With EMBEDDING_SOCKET set to a path, the
+processes on a machine share one copy instead: the first to need it starts an embedding server
+listening on that Unix socket (python -m agents.embeddings PATH), and every process embeds through
+it, its requests batched with everybody else's. The server exits once nobody has used it for
+EMBEDDING_SERVER_IDLE_SECONDS.
+
+EMBEDDING_BACKEND chooses how the model runs:
+    torch      (default) the SentenceTransformer as published
+    int8       the same with its linear layers quantized to 8 bits, for CPUs
+    onnx       exported to ONNX Runtime, if optimum and onnxruntime are installed
+    onnx-int8  the quantized ONNX export the model publishes
+A backend whose libraries are missing falls back to torch.
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from functools import lru_cache
+from multiprocessing.connection import Client, Connection, Listener
+from typing import List, NamedTuple, Optional, Union
+
+import numpy as np
+
+from agents.metrics import metrics
+
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'torch')
+# The most texts encoded at once, and how long the first request of a batch waits for others to join it
+EMBED_BATCH_SIZE = int(os.getenv('EMBED_BATCH_SIZE', '64'))
+EMBED_MAX_WAIT_MS = float(os.getenv('EMBED_MAX_WAIT_MS', '2'))
+# The Unix socket of the embedding server the processes share; unset, each process loads the model
+EMBEDDING_SOCKET = os.getenv('EMBEDDING_SOCKET')
+EMBEDDING_SERVER_IDLE_SECONDS = float(os.getenv('EMBEDDING_SERVER_IDLE_SECONDS', '600'))
+# How long a process waits for a server it started to load the model and listen
+EMBEDDING_SERVER_START_SECONDS = 120
+
+# The quantized export published with the model, for CPUs with AVX2
+ONNX_INT8_FILE = 'onnx/model_qint8_avx2.onnx'
+
+BACKENDS = ("torch", "int8", "onnx", "onnx-int8")
+
+
+def load_model(name: str = EMBEDDING_MODEL, backend: str = EMBEDDING_BACKEND):
+    """
+    Load a SentenceTransformer to run on the given backend
+    :raises ValueError: if there is no such backend
+    """
+    from sentence_transformers import SentenceTransformer
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}', expected one of {', '.join(BACKENDS)}")
+    try:
+        if backend == "onnx":
+            return SentenceTransformer(name, backend="onnx")
+        if backend == "onnx-int8":
+            return SentenceTransformer(name, backend="onnx", model_kwargs={"file_name": ONNX_INT8_FILE})
+    except (ImportError, TypeError, ValueError, OSError) as e:
+        # Older sentence-transformers have no backend argument, and ONNX needs optimum and onnxruntime
+        logging.warning(f"Cannot run the embedding model on {backend} ({e}), using torch instead")
+        return SentenceTransformer(name)
+
+    model = SentenceTransformer(name, device="cpu" if backend == "int8" else None)
+    if backend == "int8":
+        import torch
+
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+class _Request(NamedTuple):
+    texts: List[str]
+    future: Future
+
+
+class EmbeddingService:
+    """
+    Encodes texts into unit vectors on a background thread. Every request that arrives while a batch
+    is being encoded, or within max_wait of the first, goes into the next batch, up to batch_size texts.
+    """
+
+    def __init__(self, model=None, batch_size: int = EMBED_BATCH_SIZE, max_wait: float = EMBED_MAX_WAIT_MS / 1000):
+        """
+        :param model: anything with SentenceTransformer's encode(), by default the model EMBEDDING_MODEL names
+        :param batch_size: the most texts encoded at once
+        :param max_wait: seconds the first request of a batch waits for others
+        """
+        self.model = model or load_model()
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def embed(self, texts: Union[str, List[str]]) -> np.ndarray:
+        """
+        Encode texts into normalized float32 vectors, waiting for the batch they go into
+        :param texts: a text, or a list of them
+        :return: a vector for a text, or an array with a row for each text in the list
+        """
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        self._start()
+        request = _Request(texts, Future())
+        self._queue.put(request)
+        vectors = request.future.result()
+        return vectors[0] if single else vectors
+
+    def _start(self) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="embedding-service", daemon=True)
+                    self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0].texts)
+            deadline = time.monotonic() + self.max_wait
+            while size < self.batch_size:
+                try:
+                    request = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request.texts)
+            self._encode(batch)
+
+    def _encode(self, batch: List[_Request]) -> None:
+        texts = [text for request in batch for text in request.texts]
+        try:
+            with metrics.timer("embed_batch_seconds"):
+                vectors = np.asarray(self.model.encode(texts, batch_size=self.batch_size, normalize_embeddings=True,
+                                                       convert_to_numpy=True), dtype=np.float32)
+        except BaseException as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        metrics.count("embed_texts_total", len(texts))
+        metrics.count("embed_batches_total")
+        start = 0
+        for request in batch:
+            request.future.set_result(vectors[start:start + len(request.texts)])
+            start += len(request.texts)
+
+
+class EmbeddingServer:
+    """
+    Serves an EmbeddingService to other processes over a Unix socket. Each connection is served
+    on a thread of its own, so requests from every process go into the same batches.
+    Only JSON and raw float32 arrays cross the socket, never pickles.
+    """
+
+    def __init__(self, address: str, service: Optional[EmbeddingService] = None,
+                 idle_timeout: Optional[float] = EMBEDDING_SERVER_IDLE_SECONDS):
+        """
+        :param address: the path of the socket
+        :param service: the service to share, by default a new one with the EMBEDDING_MODEL
+        :param idle_timeout: seconds without a connection after which serve_forever returns; None to serve until closed
+        """
+        self.listener = _listen(address)
+        self.address = address
+        self.service = service or EmbeddingService()
+        self.idle_timeout = idle_timeout
+        self._connections = 0
+        self._last_active = time.monotonic()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+
+    def serve_forever(self) -> None:
+        if self.idle_timeout is not None:
+            threading.Thread(target=self._close_when_idle, name="embedding-server-idle", daemon=True).start()
+        while not self._closed.is_set():
+            try:
+                connection = self.listener.accept()
+            except OSError:
+                break
+            if self._closed.is_set():
+                connection.close()
+                break
+            with self._lock:
+                self._connections += 1
+            threading.Thread(target=self._serve, args=(connection,), name="embedding-server", daemon=True).start()
+
+    def close(self) -> None:
+        self._closed.set()
+        try:
+            # Closing the socket does not wake a thread waiting in accept(); connecting does
+            Client(self.address, family='AF_UNIX').close()
+        except OSError:
+            pass
+        self.listener.close()
+
+    def _close_when_idle(self) -> None:
+        while not self._closed.wait(min(self.idle_timeout, 10.0)):
+            with self._lock:
+                idle = self._connections == 0 and time.monotonic() - self._last_active > self.idle_timeout
+            if idle:
+                logging.info(f"Embedding server at {self.address} idle, exiting")
+                self.close()
+
+    def _serve(self, connection: Connection) -> None:
+        try:
+            connection.send_bytes(json.dumps({"dimension": self.service.dimension}).encode('utf-8'))
+            while True:
+                texts = json.loads(connection.recv_bytes())
+                try:
+                    vectors = self.service.embed([str(text) for text in texts])
+                except Exception as e:
+                    connection.send_bytes(json.dumps({"error": str(e)}).encode('utf-8'))
+                    continue
+                connection.send_bytes(json.dumps({"shape": vectors.shape}).encode('utf-8'))
+                connection.send_bytes(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        except (EOFError, OSError):
+            pass
+        finally:
+            connection.close()
+            with self._lock:
+                self._connections -= 1
+                self._last_active = time.monotonic()
+
+
+def _listen(address: str) -> Listener:
+    try:
+        return Listener(address, family='AF_UNIX', backlog=64)
+    except OSError:
+        if not os.path.exists(address):
+            raise
+    # The socket file is there: either another server is listening on it, or one died and left it behind
+    try:
+        Client(address, family='AF_UNIX').close()
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.unlink(address)
+        return Listener(address, family='AF_UNIX', backlog=64)
+    raise FileExistsError(f"An embedding server is already listening at {address}")
+
+
+class RemoteEmbeddings:
+    """
+    Embeds through the EmbeddingServer at an address, with the interface of EmbeddingService.
+    Each thread keeps a connection of its own, so concurrent callers are batched by the server.
+    """
+
+    def __init__(self, address: str):
+        """
+        :raises ConnectionRefusedError, FileNotFoundError: if no server is listening at the address
+        """
+        self.address = address
+        self._local = threading.local()
+        self.dimension = self._connection()[1]
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            client = Client(self.address, family='AF_UNIX')
+            hello = json.loads(client.recv_bytes())
+            connection = self._local.connection = (client, hello["dimension"])
+        return connection
+
+    def embed(self, texts: Union[str, List[str]]) -> np.ndarray:
+        """
+        Encode texts into normalized float32 vectors (see EmbeddingService.embed)
+        :raises RuntimeError: if the server failed to encode them
+        """
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        client, _ = self._connection()
+        try:
+            client.send_bytes(json.dumps(texts).encode('utf-8'))
+            reply = json.loads(client.recv_bytes())
+            if "error" in reply:
+                raise RuntimeError(f"The embedding server failed: {reply['error']}")
+            vectors = np.frombuffer(client.recv_bytes(), dtype=np.float32).reshape(reply["shape"])
+        except (EOFError, OSError):
+            # The server went away, perhaps idle; the next call connects afresh
+            client.close()
+            self._local.connection = None
+            raise
+        return vectors[0] if single else vectors
+
+
+def connect(address: str, timeout: float = EMBEDDING_SERVER_START_SECONDS) -> RemoteEmbeddings:
+    """
+    Connect to the embedding server at an address, starting one if nobody is listening
+    :raises TimeoutError: if a started server is not listening within the timeout
+    """
+    try:
+        return RemoteEmbeddings(address)
+    except (ConnectionRefusedError, FileNotFoundError):
+        pass
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [src_dir, os.getenv('PYTHONPATH')]))}
+    # In a session of its own, so it outlives this process for the others sharing it
+    server = subprocess.Popen([sys.executable, '-m', 'agents.embeddings', address], env=environment,
+                              stdin=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return RemoteEmbeddings(address)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # Another process may have won the race to start it, in which case ours exits and theirs listens
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"No embedding server listening at {address} after {timeout:.0f}s")
+            time.sleep(0.1 if server.poll() is None else 0.5)
+
+
+@lru_cache(maxsize=1)
+def default_service() -> Union[EmbeddingService, RemoteEmbeddings]:
+    """
+    The embedding service every agent in this process shares: the server at EMBEDDING_SOCKET
+    if it is set, so the model is loaded once on the machine, otherwise one loaded in this process
+    """
+    if EMBEDDING_SOCKET and hasattr(socket, 'AF_UNIX'):
+        return connect(EMBEDDING_SOCKET)
+    if EMBEDDING_SOCKET:
+        logging.warning("Unix sockets are not available, loading the embedding model in this process")
+    return EmbeddingService()
+
+
+def embed(texts: Union[str, List[str]]) -> np.ndarray:
+    """
+    Encode texts with the shared service (see EmbeddingService.embed)
+    """
+    return default_service().embed(texts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the embedding model to the processes on this machine")
+    parser.add_argument("socket", help="the path of the Unix socket to listen on")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        server = EmbeddingServer(args.socket)
+    except FileExistsError as e:
+        logging.info(str(e))
+        return
+    logging.info(f"Embedding server listening at {args.socket}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,55 @@
+from typing import List, Optional
+
 import pandas as pd
 from sklearn.linear_model import LinearRegression
 import re
 import json
 
 from agents.agent import Agent
+from agents.metrics import metrics
 #from agents.specialist_agent import SpecialistAgent
 from agents.frontier_agent import FrontierAgent
 from agents.situations import Situation
 from agents.random_forest_agent import RandomForestAgent
 from agents.tabpfn_agent import TabPFNAgent
+from agents.worker_pool import WORKER_PROCESSES, WorkerPool
+
+
+def vote(votes: List[Optional[str]]) -> str:
+    """
+    Return the majority of the votes; a tie, even with no votes, is resolved as anomalous to err on the side of caution
+    """
+    normal_votes = votes.count("normal")
+    anomalous_votes = votes.count("anomalous")
+
+    # Return the label with the most votes
+    if normal_votes > anomalous_votes:
+        return "normal"
+    return "anomalous"
+
 
 class EnsembleAgent(Agent):
 
     name = "Ensemble Agent"
     color = Agent.YELLOW
+
+    # Worker processes predicting with the Random Forest and TabPFN models, if WORKER_PROCESSES is set
+    pool = None
     
     def __init__(self, collection):
         """
         Create an instance of Ensemble, by creating each of the models
         And loading the weights of the Ensemble
         """
+        super().__init__()
         self.log("Initializing Ensemble Agent")
 #        self.specialist = SpecialistAgent()
         self.frontier = FrontierAgent(collection)
-        self.random_forest = RandomForestAgent()
-        self.tabPFN = TabPFNAgent()
+        if WORKER_PROCESSES:
+            self.pool = WorkerPool(self.data_dir, WORKER_PROCESSES)
+        else:
+            self.random_forest = RandomForestAgent()
+            self.tabPFN = TabPFNAgent()
         self.log("Ensemble Agent is ready")
 
     def estimate(self, situation: Situation) -> float:
@@ -37,24 +62,31 @@ class EnsembleAgent(Agent):
         """
         self.log("Running Ensemble Agent - collaborating with random forest agents")
 #        specialist = self.specialist.price(description)
-        frontier = self.frontier.estimate(situation)
-        random_forest = self.random_forest.estimate(situation)
-        tabPFN = self.tabPFN.estimate(situation)
+        if self.pool is not None:
+            # The workers predict while the frontier model waits for the LLM
+            tabular = self.pool.submit([situation])
+        with metrics.timer("ensemble_member_seconds", member="frontier"):
+            frontier = self.frontier.estimate(situation)
+        if self.pool is not None:
+            with metrics.timer("ensemble_member_seconds", member="worker_pool"):
+                predictions = tabular.result()[0]
+            # A model the workers could not load has no vote, as an agent that failed to load would have none
+            random_forest, tabPFN = [predictions[name].label if name in predictions else None
+                                     for name in ("random_forest", "tabpfn")]
+            self.log("Ensemble Agent received predictions from the worker pool", event="prediction",
+                     **{f"{name}_probability": prediction.probability for name, prediction in predictions.items()})
+        else:
+            with metrics.timer("ensemble_member_seconds", member="random_forest"):
+                random_forest = self.random_forest.estimate(situation)
+            with metrics.timer("ensemble_member_seconds", member="tabpfn"):
+                tabPFN = self.tabPFN.estimate(situation)
 
         # Collect votes
         votes = [frontier, random_forest, tabPFN]
 
-        # Determine the majority vote
-        normal_votes = votes.count("normal")
-        anomalous_votes = votes.count("anomalous")
-
-        # Return the label with the most votes
-        if normal_votes > anomalous_votes:
-            y = "normal"
-        else:
-            y = "anomalous"
+        y = vote(votes)
 
-        self.log(f"Ensemble Agent ran a vote - returning {y}")
+        self.log("Ensemble Agent ran a vote", event="vote", estimate=y, votes=votes)
         return y
     
     
\ No newline at end of file
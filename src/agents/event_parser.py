@@ -1,10 +1,35 @@
-import json
-from datetime import datetime, timedelta
-from typing import List, Dict, Any
+from typing import Any, Dict, Iterable, Iterator, List
+from agents.events import SensorEvent
 from agents.rotating_json_file import RotatingJSONFile
 
 INVESTIGATON_PERIOD_IN_HOURS = 6
 
+
+def window_events(events: Iterable[SensorEvent]) -> Iterator[List[SensorEvent]]:
+    """
+    Group events, in time order, into windows: a window starts at an event and takes in every
+    event up to INVESTIGATON_PERIOD_IN_HOURS later. The events are consumed as the windows are
+    yielded, so a stream of any length can be windowed.
+    """
+    window_start = None
+    buffer = []
+    period = INVESTIGATON_PERIOD_IN_HOURS * 60 * 60
+
+    for event in events:
+        # Start or reset grouping window
+        if window_start is None or event.timestamp > window_start + period:
+            if buffer:
+                yield buffer
+            buffer = []
+            window_start = event.timestamp
+
+        buffer.append(event)
+
+    # Yield any remaining events in the buffer
+    if buffer:
+        yield buffer
+
+
 class EventParser:
     """
     EventParser groups events within 6-hour windows (i.e. INVESTIGATON_PERIOD_IN_HOURS) and returns them as structured entries.
@@ -17,32 +42,13 @@ class EventParser:
     def parse(self) -> 'EventParser':
         """
         Parse the input file and group events by a 6-hour window.
+        Each event is read into a SensorEvent once, here, and travels in that form to the agents.
         """
+        # The events file is appended to from outside, so it is rotated here rather than on write
+        self.file.rotate()
         # Load and sort events by timestamp
-        events = self.file.read()
-        events.sort(key=lambda x: datetime.fromtimestamp(x["timestamp"]))
-
-        grouped = []
-        window_start = None
-        buffer = []
-
-        # Group events in 6-hour windows
-        for event in events:
-            event_time = datetime.fromtimestamp(event["timestamp"])
-            
-            # Start or reset grouping window
-            if window_start is None or event_time > window_start + timedelta(hours=INVESTIGATON_PERIOD_IN_HOURS):
-                if buffer:
-                    grouped.append({"details": buffer.copy()})
-                buffer.clear()
-                window_start = event_time
-
-            buffer.append(event)
-
-        # Append any remaining events in the buffer
-        if buffer:
-            grouped.append({"details": buffer})
-
-        self.entries = grouped
-        return self
+        events = [SensorEvent.from_dict(event) for event in self.file.read()]
+        events.sort(key=lambda event: event.timestamp)
 
+        self.entries = [{"details": window} for window in window_events(events)]
+        return self
@@ -0,0 +1,109 @@
+"""
+The record a sensor event travels in, from the EventParser through the agents. Events are read from JSON
+once, and written back to JSON only where they leave the pipeline: in the memory file and in prompts.
+"""
+
+import ast
+import json
+import sys
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+TIMEZONE = datetime.now().astimezone().tzinfo
+
+# Keys of a raw event that have a field of their own; 'datetime' is derived from the timestamp
+_KNOWN_KEYS = {'timestamp', 'datetime', 'room', 'nodeId', 'endpointId', 'attribute'}
+
+
+def _intern(name: Optional[str]) -> Optional[str]:
+    # Room and attribute names repeat in every window, so every event shares one copy of each
+    return sys.intern(name) if isinstance(name, str) else name
+
+
+class SensorEvent(NamedTuple):
+    """
+    One event from a home sensor, such as {"timestamp": 1737900000, "room": "pillbox", "nodeId": 1,
+    "endpointId": 1, "attribute": {"OnOff": {"OnOff": true}}}, held as a tuple.
+    The attribute is almost always a single reading, which is kept as its cluster, field and value.
+    """
+    timestamp: Optional[int]
+    room: Optional[str]
+    node_id: Optional[int]
+    endpoint_id: Optional[int]
+    cluster: Optional[str]
+    field: Optional[str]
+    value: Any
+    # Any other keys of the raw event, including an attribute that is not a single reading; usually None
+    extra: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def from_dict(cls, event: Dict[str, Any]) -> 'SensorEvent':
+        extra = {key: value for key, value in event.items() if key not in _KNOWN_KEYS} or None
+        cluster = field = value = None
+        attribute = event.get('attribute')
+        inner = next(iter(attribute.values())) if isinstance(attribute, dict) and len(attribute) == 1 else None
+        if isinstance(inner, dict) and len(inner) == 1:
+            cluster = next(iter(attribute))
+            field, value = next(iter(inner.items()))
+        elif attribute is not None:
+            extra = {**(extra or {}), 'attribute': attribute}
+        return cls(event.get('timestamp'), _intern(event.get('room')), event.get('nodeId'), event.get('endpointId'),
+                   _intern(cluster), _intern(field), value, extra)
+
+    @classmethod
+    def from_json(cls, text: str) -> 'SensorEvent':
+        try:
+            return cls.from_dict(json.loads(text))
+        except json.JSONDecodeError:
+            # Older records hold the Python repr of an event, with single quotes and True/False
+            return cls.from_dict(ast.literal_eval(text))
+
+    @property
+    def attribute(self) -> Dict[str, Dict[str, Any]]:
+        if self.cluster is not None:
+            return {self.cluster: {self.field: self.value}}
+        return (self.extra or {}).get('attribute', {})
+
+    def readings(self) -> Iterator[Tuple[str, str, Any]]:
+        """
+        Yield the (cluster, field, value) of every reading in the attribute
+        """
+        if self.cluster is not None:
+            yield self.cluster, self.field, self.value
+            return
+        for cluster, inner in self.attribute.items():
+            if isinstance(inner, dict):
+                for field, value in inner.items():
+                    yield cluster, field, value
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Return the event as it is stored, with a human-readable local time next to the timestamp
+        """
+        event = {"timestamp": self.timestamp}
+        if self.timestamp is not None:
+            event["datetime"] = datetime.fromtimestamp(self.timestamp, tz=TIMEZONE).strftime("%a %b %d %Y %H:%M:%S")
+        event.update({"room": self.room, "nodeId": self.node_id, "endpointId": self.endpoint_id, "attribute": self.attribute})
+        if self.extra:
+            event.update({key: value for key, value in self.extra.items() if key != 'attribute'})
+        return event
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict())
+
+
+def load_event(event) -> SensorEvent:
+    if isinstance(event, SensorEvent):
+        return event
+    if isinstance(event, str):
+        return SensorEvent.from_json(event)
+    return SensorEvent.from_dict(event)
+
+
+def load_events(details) -> List[SensorEvent]:
+    """
+    Load the events of a window, which could be a JSON array, or a list of events, dicts or JSON strings
+    """
+    if isinstance(details, str):
+        details = json.loads(details)
+    return [load_event(event) for event in details]
@@ -0,0 +1,124 @@
+# Feature extraction shared by the Random Forest and TabPFN agents and by retraining,
+# so a model is always trained on exactly the features it is later asked to predict from
+
+import zlib
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Optional
+
+from agents.events import TIMEZONE, load_events
+
+# Rooms are hashed into this many slots, so fingerprints keep their length as homes gain rooms
+ROOM_SLOTS = 16
+# An hour-of-day histogram, a room histogram and a room-to-room transition matrix
+FINGERPRINT_DIM = 24 + ROOM_SLOTS + ROOM_SLOTS * ROOM_SLOTS
+
+
+def prepare_features(data) -> Dict[str, float]:
+    """Convert the raw sensor data into meaningful features dynamically."""
+    features = {}
+    events = load_events(data.details)
+
+    # Dynamic room counts: count visits for every room seen in the events
+    room_counts = {}
+    for event in events:
+        room = event.room
+        if room is not None:
+            room_counts[room] = room_counts.get(room, 0) + 1
+    # Add dynamic room count features (keys will be like 'room_kitchen_visits', etc.)
+    for room, count in room_counts.items():
+        features[f'room_{room}_visits'] = count
+
+    # Timestamp based features:
+    # Calculate average and maximum time between consecutive events
+    timestamps = [event.timestamp for event in events if event.timestamp is not None]
+    if len(timestamps) > 1:
+        diffs = np.diff(timestamps)
+        features['avg_time_between_events'] = float(np.mean(diffs))
+        features['max_time_between_events'] = float(np.max(diffs))
+    else:
+        features['avg_time_between_events'] = 0.0
+        features['max_time_between_events'] = 0.0
+
+    # Count rapid transitions (events less than 2 minutes apart)
+    rapid_transitions = 0
+    for i in range(len(timestamps) - 1):
+        if timestamps[i+1] - timestamps[i] < 120:
+            rapid_transitions += 1
+    features['rapid_transitions'] = rapid_transitions
+
+    # Attribute features:
+    # For each attribute present, create a feature (e.g., "TemperatureMeasurement_MeasuredValue")
+    # and aggregate by taking the average value for that attribute over the period.
+    attr_values = {}  # key: feature name, value: list of measurements
+    for event in events:
+        # Each reading is a cluster and field (e.g., "MeasuredValue": 1901 of "TemperatureMeasurement") and its value
+        for attr_name, inner_key, value in event.readings():
+            feature_key = f"{attr_name}_{inner_key}"
+            try:
+                numeric_value = float(value)
+            except (ValueError, TypeError):
+                continue
+            if feature_key not in attr_values:
+                attr_values[feature_key] = []
+            attr_values[feature_key].append(numeric_value)
+
+    # Compute the average for each attribute feature if available
+    for key, values in attr_values.items():
+        features[key] = float(np.mean(values))
+
+    return features
+
+
+def prepare_tabular_data(data, feature_names: Optional[List[str]] = None) -> pd.DataFrame:
+    """Convert a list of situations into a Pandas DataFrame with engineered features, as TabPFN expects."""
+    flattened_data = []
+    for entry in data:
+        features = prepare_features(entry)
+        features['result'] = entry.result
+        flattened_data.append(features)
+
+    df = pd.DataFrame(flattened_data)
+    df = df.fillna('missing')  # Handle missing values
+
+    if feature_names:
+        missing_features = {feature: 'missing' for feature in feature_names if feature not in df.columns}
+        df = pd.concat([df, pd.DataFrame(missing_features, index=df.index)], axis=1)
+        df = df[feature_names]
+
+    return df.astype(str)  # Ensure all data is of string type
+
+
+def room_slot(room: str) -> int:
+    return zlib.crc32(room.encode()) % ROOM_SLOTS
+
+
+def fingerprint(details) -> np.ndarray:
+    """
+    Describe a window by the pattern of its events rather than their values, as a unit vector
+    for nearest-neighbour search: when in the day the home was active, in which rooms, and how
+    the activity moved between rooms. Each part is a distribution whose square root is taken,
+    so cosine similarity compares their shapes rather than the number of events.
+    """
+    events = [event for event in load_events(details) if event.timestamp is not None and event.room is not None]
+    vector = np.zeros(FINGERPRINT_DIM, dtype=np.float32)
+    if not events:
+        return vector
+    timestamps = np.array([event.timestamp for event in events], dtype=np.int64)
+    offset = int(datetime.fromtimestamp(int(timestamps[0]), tz=TIMEZONE).utcoffset().total_seconds())
+    hours = (timestamps + offset) // 3600 % 24
+    slots = np.array([room_slot(event.room) for event in events])
+    moved = slots[1:] != slots[:-1]
+
+    hourly = np.bincount(hours, minlength=24)
+    rooms = np.bincount(slots, minlength=ROOM_SLOTS)
+    transitions = np.bincount(slots[:-1][moved] * ROOM_SLOTS + slots[1:][moved], minlength=ROOM_SLOTS * ROOM_SLOTS)
+    parts = (hourly, rooms, transitions)
+    start = 0
+    for part in parts:
+        if part.sum():
+            vector[start:start + len(part)] = np.sqrt(part / part.sum()) / np.sqrt(len(parts))
+        start += len(part)
+    return vector
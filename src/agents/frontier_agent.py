@@ -4,14 +4,16 @@ import os
 import re
 import math
 import json
-from typing import List, Dict
-from openai import OpenAI
-from sentence_transformers import SentenceTransformer, util
-from datasets import load_dataset
-from items import Item
-from testing import Tester
+from typing import List, Dict, Optional, Tuple
+import numpy as np
 from agents.agent import Agent
+from agents.llm import LLMClient, Priority, default_client
+from agents.prompt_builder import FRONTIER_PROMPT_TOKENS, Prompt, count_message_tokens, count_tokens, render_window, truncate
+from agents.embeddings import EmbeddingService, default_service
+from agents.features import FINGERPRINT_DIM, fingerprint
+from agents.json_store import investigation_id
 from agents.situations import Situation
+from agents.vector_index import SituationIndex
 
 class FrontierAgent(Agent):
 
@@ -19,53 +21,89 @@ class FrontierAgent(Agent):
     color = Agent.BLUE
 
     MODEL = "gpt-4o-mini"
+
+    SYSTEM_PROMPT = "You look for normal and anomalous situations in smart home sensor data in an elderly persons home. Reply only with the word normal or anomalous, no explanation"
+
+    # Tokens a call may take up, and the share of them the situation being estimated may use
+    PROMPT_TOKENS = FRONTIER_PROMPT_TOKENS
+    SITUATION_SHARE = 0.5
+
+    # How similar situations are found: by the text of their descriptions, by the pattern of their
+    # events, or by both, merging the two rankings
+    RETRIEVAL = os.getenv('FRONTIER_RETRIEVAL', 'hybrid')
+    # Rank constant of reciprocal rank fusion; larger values weigh the top places less
+    FUSION_K = 60
     
-    def __init__(self, collection):
+    def __init__(self, collection, llm: Optional[LLMClient] = None, embedder: Optional[EmbeddingService] = None):
         """
-        Set up this instance by connecting to OpenAI, to the Chroma Datastore,
+        Set up this instance with the LLM client to call, the Chroma Datastore,
         And setting up the vector encoding model
+        :param llm: the client, by default the one LLM_BACKEND configures, shared with the other agents
+        :param embedder: the embedding service, by default the one shared by this process (see embeddings.default_service)
         """
         self.log("Initializing Frontier Agent")
         super().__init__()  # Important: call parent class __init__
-        self.openai = OpenAI()
+        self.llm = llm or default_client()
         self.collection = collection
-        self.model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+        self.embedder = embedder or default_service()
+        self.indexes: Dict[str, SituationIndex] = {}
         self.log("Frontier Agent is ready")
 
-    def make_context(self, similars: List[str]) -> str:
+    def make_context(self, similars: List[str], budget: int) -> Tuple[str, int, int]:
         """
-        Create context that can be inserted into the prompt
-        :param similars: similar situations to the one being estimated
-        :param estimates: estimates of the similar situations
-        :return: text to insert in the prompt that provides context
+        Create context that can be inserted into the prompt, sharing the budget equally among the similar situations
+        :param similars: similar situations to the one being estimated, with their estimates
+        :param budget: the tokens the context may take up
+        :return: text to insert in the prompt that provides context, its number of event lines, and the number left out
         """
         message = "To provide some context, here are some other situations that might be similar to the situations you need to estimate.\n\n"
+        lines = omitted = 0
+        if not similars:
+            return message, lines, omitted
+        share = (budget - count_tokens(message)) // len(similars)
         for similar in similars:
-            details = json.dumps(similar['situation']['details'])
             estimate = similar['estimate']
-            message += f"Potentially related situation:\n{details}\nEstimate is {estimate}\n\n"
-        return message
-
-    def messages_for(self, situation: Situation, similar_situations: List[Situation]) -> List[Dict[str, str]]:
+            footer = f"\nEstimate is {estimate}\n\n"
+            header = "Potentially related situation:\n"
+            details, similar_lines, similar_omitted = render_window(
+                similar['situation']['details'], share - count_tokens(header + footer), header=False)
+            message += header + details + footer
+            lines += similar_lines
+            omitted += similar_omitted
+        return message, lines, omitted
+
+    def messages_for(self, situation: Situation, similar_situations: List[Situation]) -> Prompt:
         """
         Create the message list to be included in a call to OpenAI
-        With the system and user prompt
-        :param description: a description of the situation to estimate
-        :param similars: similar situations to this one
-        :param estimates: estimates of similar situations
-        :return: the list of messages in the format expected by OpenAI
-        """
-        system_message = "You look for normal and anomalous situations in smart home sensor data in an elderly persons home. Reply only with the word normal or anomalous, no explanation"
-        user_prompt = self.make_context(similar_situations)
+        With the system and user prompt, written compactly within the token budget:
+        the situation to estimate comes first, and the similar situations share what it leaves
+        :param situation: the situation to estimate
+        :param similar_situations: similar situations to this one, with their estimates
+        :return: the prompt, whose messages are in the format expected by OpenAI
+        """
+        question = "How would you classify this situation and related sensor data - normal or anomalous?\n\n"
+        budget = self.PROMPT_TOKENS - count_message_tokens([
+            {"role": "system", "content": self.SYSTEM_PROMPT},
+            {"role": "user", "content": "And now the situaton for you:\n\n" + question},
+            {"role": "assistant", "content": "Result is "}
+        ])
+        description = truncate(str(situation.situation_description), int(budget * self.SITUATION_SHARE) // 3)
+        details, lines, omitted = render_window(
+            situation.details, int(budget * self.SITUATION_SHARE) - count_tokens(description))
+        context, context_lines, context_omitted = self.make_context(
+            similar_situations, budget - count_tokens(description + details))
+
+        user_prompt = context
         user_prompt += "And now the situaton for you:\n\n"
-        details = situation.details
-        description = situation.situation_description
-        user_prompt += "How would you classify this situation and related sensor data - normal or anomalous?\n\n" + str(description) + "\n\n" + json.dumps(details)
-        return [
-            {"role": "system", "content": system_message},
+        user_prompt += question + description + "\n\n" + details
+        messages = [
+            {"role": "system", "content": self.SYSTEM_PROMPT},
             {"role": "user", "content": user_prompt},
             {"role": "assistant", "content": "Result is "}
         ]
+        events = len(situation.details) + sum(len(similar['situation']['details']) for similar in similar_situations)
+        return Prompt(messages, count_message_tokens(messages), self.PROMPT_TOKENS, events,
+                      lines + context_lines, omitted + context_omitted)
 
 
     def load_json_file(self, file_path):
@@ -74,34 +112,66 @@ class FrontierAgent(Agent):
         with open(file_path, 'r') as f:
             return json.load(f)
 
-    def vector_search(self, file_path, query, top_k=5):
-        # Load JSON data
-        data = self.load_json_file(file_path)
-
-        # Extract text data to embed and keep track of indices
-        texts = [item['situation']['situation_description'] for item in data]
-
-        # Return an empty list if there are no texts
-        if not texts:
-            return []
-        
-        # Ensure top_k does not exceed the number of available texts
-        top_k = min(top_k, len(texts))
-            
-        # Create embeddings for each text
-        embeddings = self.model.encode(texts, convert_to_tensor=True)
+    def embed_records(self, records: List[dict]) -> np.ndarray:
+        texts = [record['situation']['situation_description'] for record in records]
+        return self.embedder.embed(texts)
 
-        # Create embedding for the query
-        query_embedding = self.model.encode(query, convert_to_tensor=True)
+    def fingerprint_records(self, records: List[dict]) -> np.ndarray:
+        return np.array([fingerprint(record['situation']['details']) for record in records]).reshape(-1, FINGERPRINT_DIM)
 
-        # Compute cosine similarities
-        similarities = util.pytorch_cos_sim(query_embedding, embeddings)[0]
+    def situation_index(self, file_path: str, name: str) -> SituationIndex:
+        """
+        Return the index of the memory file by description or by fingerprint, saved next to it, up to date
+        """
+        if name not in self.indexes:
+            embed, dim = {
+                "descriptions": (self.embed_records, self.embedder.dimension),
+                "fingerprints": (self.fingerprint_records, FINGERPRINT_DIM),
+            }[name]
+            self.indexes[name] = SituationIndex(os.path.join(os.path.dirname(file_path), 'indexes', f'{name}.npz'),
+                                                embed, dim)
+        with self.timer("index_sync", index=name):
+            self.indexes[name].sync(file_path)
+        return self.indexes[name]
+
+    def vector_search(self, file_path, query, top_k=5, home: Optional[str] = None, label: Optional[str] = None):
+        """
+        Find the investigations in the memory file whose descriptions are most like the query.
+        The descriptions are embedded once, into an index saved next to the memory file,
+        so a search only embeds the query and whatever was added since the last one
+        :param home: only consider investigations of this home
+        :param label: only consider investigations with this estimate
+        :return: up to top_k investigation records, most similar first
+        """
+        index = self.situation_index(file_path, "descriptions")
+        query_embedding = self.embedder.embed(query)
+        return index.search(query_embedding, top_k, home=home, label=label)
 
-        # Get the top_k results
-        top_results = similarities.topk(top_k)
+    def pattern_search(self, file_path, details, top_k=5, home: Optional[str] = None, label: Optional[str] = None):
+        """
+        Find the investigations in the memory file whose events followed the most similar pattern
+        (see features.fingerprint). This needs only the events, so it can run before the window is described.
+        :return: up to top_k investigation records, most similar first
+        """
+        index = self.situation_index(file_path, "fingerprints")
+        return index.search(fingerprint(details), top_k, home=home, label=label)
 
-        # Return the most similar JSON objects
-        return [data[idx] for idx in top_results.indices.tolist()]
+    def find_similar(self, file_path, situation: Situation, top_k=5, home: Optional[str] = None) -> List[dict]:
+        """
+        Find the investigations most similar to the situation, the way RETRIEVAL says
+        """
+        if self.RETRIEVAL == "text" or (self.RETRIEVAL == "hybrid" and not situation.details):
+            return self.vector_search(file_path, situation.situation_description, top_k, home=home)
+        if self.RETRIEVAL == "pattern" or not situation.situation_description:
+            return self.pattern_search(file_path, situation.details, top_k, home=home)
+        scores, records = {}, {}
+        for ranking in (self.vector_search(file_path, situation.situation_description, top_k, home=home),
+                        self.pattern_search(file_path, situation.details, top_k, home=home)):
+            for rank, record in enumerate(ranking):
+                key = record.get('id') or investigation_id(record)
+                scores[key] = scores.get(key, 0.0) + 1 / (self.FUSION_K + rank)
+                records[key] = record
+        return [records[key] for key in sorted(scores, key=scores.get, reverse=True)[:top_k]]
 
 
     def get_result(self, text):
@@ -111,7 +181,7 @@ class FrontierAgent(Agent):
 
     def estimate(self, situation: Situation) -> str:  
         """
-        Make a call to OpenAI to estimate the normality of the described situation,
+        Make a call to the LLM to estimate the normality of the described situation,
         by looking up 5 similar situations and including them in the prompt to give context
         :param description: a description of the situation
         :return: an estimate of the normality or otherwise of the situation
@@ -119,18 +189,16 @@ class FrontierAgent(Agent):
 
         # Example usage:
         file_path = self.load_data_file('memory.json')
-        query = situation.situation_description
-        similar_situations = self.vector_search(file_path, query)
-
-        self.log("Frontier Agent is about to call OpenAI with context including similar situations")
-        response = self.openai.chat.completions.create(
-            model=self.MODEL, 
-            messages=self.messages_for(situation, similar_situations),
-            seed=42,
-            max_tokens=5
-        )
-        reply = response.choices[0].message.content
+        with self.timer("vector_search"):
+            similar_situations = self.find_similar(file_path, situation, home=os.getenv('HOME_ID'))
+
+        prompt = self.messages_for(situation, similar_situations)
+        self.log("Frontier Agent is about to call the LLM with context including similar situations")
+        response = self.llm.complete(prompt.messages, model=self.MODEL, max_tokens=5, priority=Priority.ALERT)
+        self.record_prompt(prompt, response)
+        self.count_llm_usage(response)
+        reply = response.text
         result = self.get_result(reply)
-        self.log(f"Frontier Agent completed - predicting {result}")
+        self.log("Frontier Agent completed", event="prediction", estimate=result)
         return result
         
\ No newline at end of file
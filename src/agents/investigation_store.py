@@ -0,0 +1,301 @@
+import threading
+from bisect import bisect_left, insort
+from datetime import date, datetime
+from functools import wraps
+from itertools import count
+from typing import Dict, List, Optional, Set, Tuple
+from agents.situations import Investigation
+from agents.rotating_json_file import RotatingJSONFile
+from agents.json_store import DEFAULT_HOME, investigation_id
+
+TIMEZONE = datetime.now().astimezone().tzinfo
+
+
+class DailyCounts:
+    """
+    The number of anomalous investigations per home and day.
+    Kept up to date as investigations are added or relabelled; the revision only
+    changes when a count does, so a chart drawn from it can be reused until then.
+    """
+
+    def __init__(self, revision: int = 0):
+        self.counts: Dict[Tuple[str, date], int] = {}
+        self.revision = revision
+
+    @staticmethod
+    def key_for(investigation: Investigation) -> Tuple[str, date]:
+        day = datetime.fromtimestamp(investigation.situation.start_timestamp, tz=TIMEZONE).date()
+        return (investigation.home or DEFAULT_HOME, day)
+
+    def adjust(self, key: Tuple[str, date], delta: int) -> None:
+        total = self.counts.get(key, 0) + delta
+        if total > 0:
+            self.counts[key] = total
+        else:
+            self.counts.pop(key, None)
+        self.revision += 1
+
+    def by_home(self) -> Dict[str, List[Tuple[date, int]]]:
+        """
+        Return the counts grouped by home, each sorted by day
+        """
+        homes = {}
+        for (home, day), total in sorted(self.counts.items()):
+            homes.setdefault(home, []).append((day, total))
+        return homes
+
+
+def synchronized(method):
+    """
+    Run a method of InvestigationStore while holding its lock
+    """
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+
+class InvestigationStore:
+    """
+    Holds the investigations from the memory file, indexed by estimate so that
+    a page of anomalous or normal investigations can be served without scanning them all.
+    Every row carries a version that changes whenever the row changes, so callers can
+    tell which rows need rendering again, and a stable id that other processes use to address it.
+
+    The UI changes the store from its run thread and its event handlers at once, so every method
+    holds the store's lock. A caller that looks up a position and then uses it holds the lock across both.
+    """
+
+    def __init__(self, memory_file: RotatingJSONFile):
+        self.memory_file = memory_file
+        # Taken before memory_file.lock, never after it
+        self.lock = threading.RLock()
+        self.investigations: List[Investigation] = []
+        self.versions: List[int] = []
+        self.revision = 0
+        # The estimate each position is indexed under; callers may mutate investigations in place
+        self._estimates: List[str] = []
+        self._version_counter = count(1)
+        self._by_estimate: Dict[str, List[int]] = {}
+        self._positions: Dict[str, int] = {}
+        # The ids in the file as last read or written, to recognise investigations rotated out since
+        self._saved: Set[str] = set()
+        # The ids of investigations added or updated here since, whose changes a merge keeps
+        self._changed: Set[str] = set()
+        # The version of the memory file as last read or written (see json_store.version_of)
+        self._version = None
+        self.daily = DailyCounts()
+
+    @synchronized
+    def load(self) -> 'InvestigationStore':
+        """
+        Read every investigation from the memory file and rebuild the indexes
+        """
+        # The version is taken under the same lock as the read, so it belongs to these contents
+        with self.memory_file.lock.shared():
+            data = self.memory_file.read()
+            self._version = self.memory_file.version
+        self._rebuild([self._with_id(Investigation(**item)) for item in data])
+        self._saved = set(self._positions)
+        self._changed = set()
+        return self
+
+    def _rebuild(self, investigations: List[Investigation]) -> 'InvestigationStore':
+        self.investigations = investigations
+        self._positions = {investigation.id: index for index, investigation in enumerate(self.investigations)}
+        self.versions = [next(self._version_counter) for _ in self.investigations]
+        self._estimates = [investigation.estimate for investigation in self.investigations]
+        self._by_estimate = {}
+        # Counted on from the previous revision, so a chart drawn from the old counts never looks current
+        self.daily = DailyCounts(self.daily.revision + 1)
+        for index, investigation in enumerate(self.investigations):
+            self._by_estimate.setdefault(investigation.estimate, []).append(index)
+            if investigation.estimate == "anomalous":
+                self.daily.adjust(DailyCounts.key_for(investigation), 1)
+        self.revision += 1
+        return self
+
+    @staticmethod
+    def _with_id(investigation: Investigation) -> Investigation:
+        if not investigation.id:
+            investigation.id = investigation_id({
+                'home': investigation.home,
+                'situation': {
+                    'start_timestamp': investigation.situation.start_timestamp,
+                    'end_timestamp': investigation.situation.end_timestamp,
+                },
+            })
+        return investigation
+
+    @synchronized
+    def save(self) -> None:
+        """
+        Write the investigations back to the memory file, merged with what other processes (such as
+        the dashboard backend or a backfill) saved since this store last read or wrote it (see _merge).
+        The merge and the write happen under one exclusive lock, so nothing saved in between is lost.
+        """
+        with self.memory_file.lock:
+            # Rotated first, so the investigations it archives are known before the rest are written back
+            self.memory_file.rotate()
+            if self.memory_file.version != self._version:
+                self._merge(self.memory_file.read())
+            self.memory_file.overwrite([investigation.model_dump() for investigation in self.investigations])
+            self._saved = set(self._positions)
+            self._changed = set()
+            self._version = self.memory_file.version
+
+    @synchronized
+    def refresh(self) -> bool:
+        """
+        Adopt what other processes saved to the memory file since this store last read or wrote it
+        (see _merge), keeping the changes made here and not yet saved. The file is only read if it changed.
+        :return: whether any investigation changed
+        """
+        if self.memory_file.version == self._version:
+            return False
+        with self.memory_file.lock.shared():
+            data = self.memory_file.read()
+            self._version = self.memory_file.version
+        return self._merge(data)
+
+    def _merge(self, data: List[Dict]) -> bool:
+        """
+        Merge the records read from the memory file into the store. Investigations new there are added, and
+        ones changed there but not here are updated in place, so only their rows need rendering again. One
+        changed in both places keeps the change made here, unless a person has reviewed it there since.
+        :return: whether any investigation changed
+        """
+        on_disk = {}
+        for item in data:
+            investigation = self._with_id(Investigation(**item))
+            on_disk[investigation.id] = investigation
+        changed = False
+        # Investigations saved before and since rotated out of the file are archived; written back,
+        # they would be archived again. Old ones never saved are written, for the next rotation to archive.
+        cutoff = self.memory_file.cutoff
+        rotated = {investigation.id for investigation in self.investigations
+                   if investigation.situation.start_timestamp < cutoff
+                   and investigation.id in self._saved and investigation.id not in on_disk}
+        if rotated:
+            # Which moves every position after them
+            self._rebuild([investigation for investigation in self.investigations if investigation.id not in rotated])
+            changed = True
+        # What is adopted here was not changed here
+        local = self._changed - rotated
+        for id, investigation in on_disk.items():
+            index = self._positions.get(id)
+            if index is None:
+                self.add(investigation)
+            elif id not in local:
+                if investigation == self.investigations[index]:
+                    continue
+                self.update(index, investigation)
+            elif (investigation.reviewed_at or 0) > (self.investigations[index].reviewed_at or 0):
+                # The person's label stands over the estimate made here
+                self.update(index, self.investigations[index].model_copy(
+                    update={'estimate': investigation.estimate, 'reviewed_at': investigation.reviewed_at}))
+            else:
+                continue
+            changed = True
+        self._changed = local
+        self._saved = set(on_disk)
+        return changed
+
+    @synchronized
+    def __len__(self) -> int:
+        return len(self.investigations)
+
+    @synchronized
+    def get(self, index: int) -> Investigation:
+        return self.investigations[index]
+
+    @synchronized
+    def position(self, investigation_id: str) -> int:
+        """
+        Return the position of the investigation with the given id
+        :raises KeyError: if there is no such investigation
+        """
+        return self._positions[investigation_id]
+
+    @synchronized
+    def add(self, investigation: Investigation) -> int:
+        """
+        Append an investigation and index it
+        :return: the position of the new investigation
+        """
+        index = len(self.investigations)
+        self._with_id(investigation)
+        self.investigations.append(investigation)
+        self._positions[investigation.id] = index
+        self._changed.add(investigation.id)
+        self.versions.append(next(self._version_counter))
+        self._estimates.append(investigation.estimate)
+        self._by_estimate.setdefault(investigation.estimate, []).append(index)
+        if investigation.estimate == "anomalous":
+            self.daily.adjust(DailyCounts.key_for(investigation), 1)
+        self.revision += 1
+        return index
+
+    @synchronized
+    def update(self, index: int, investigation: Investigation) -> None:
+        """
+        Replace the investigation at the given position, moving it between estimate indexes if needed
+        """
+        if not 0 <= index < len(self.investigations):
+            raise IndexError("Index out of range for investigations")
+        previous_estimate = self._estimates[index]
+        if previous_estimate != investigation.estimate:
+            self._unindex(index, previous_estimate)
+            insort(self._by_estimate.setdefault(investigation.estimate, []), index)
+            self._estimates[index] = investigation.estimate
+        investigation.id = self.investigations[index].id
+        self._changed.add(investigation.id)
+        previous_key = DailyCounts.key_for(self.investigations[index])
+        key = DailyCounts.key_for(investigation)
+        if previous_estimate == "anomalous" and (investigation.estimate != "anomalous" or key != previous_key):
+            self.daily.adjust(previous_key, -1)
+        if investigation.estimate == "anomalous" and (previous_estimate != "anomalous" or key != previous_key):
+            self.daily.adjust(key, 1)
+        self.investigations[index] = investigation
+        self.versions[index] = next(self._version_counter)
+        self.revision += 1
+
+    def _unindex(self, index: int, estimate: str) -> None:
+        positions = self._by_estimate.get(estimate, [])
+        position = bisect_left(positions, index)
+        if position < len(positions) and positions[position] == index:
+            del positions[position]
+
+    @synchronized
+    def count(self, estimate: str) -> int:
+        return len(self._by_estimate.get(estimate, []))
+
+    @synchronized
+    def query(self, estimate: Optional[str] = None, text: Optional[str] = None,
+              page: int = 1, page_size: int = 25) -> Tuple[int, List[Tuple[int, Investigation]]]:
+        """
+        Return one page of investigations, newest first
+        :param estimate: only include investigations with this estimate
+        :param text: only include investigations whose description contains this text (case insensitive)
+        :param page: the 1-based page number
+        :param page_size: the number of investigations per page
+        :return: the number of matching investigations, and the (position, investigation) pairs on the page
+        """
+        if estimate is None:
+            positions = range(len(self.investigations))
+        else:
+            positions = self._by_estimate.get(estimate, [])
+        start = (max(page, 1) - 1) * page_size
+
+        if not text:
+            total = len(positions)
+            # Walk the index backwards so the newest investigations come first
+            stop = max(total - start, 0)
+            selected = positions[max(stop - page_size, 0):stop]
+            return total, [(index, self.investigations[index]) for index in reversed(selected)]
+
+        needle = text.lower()
+        matches = [index for index in reversed(positions)
+                   if needle in self.investigations[index].situation.situation_description.lower()]
+        return len(matches), [(index, self.investigations[index]) for index in matches[start:start + page_size]]
@@ -0,0 +1,398 @@
+"""
+Locking and atomic replacement for the JSON files shared between the agent framework
+and the dashboard backend. This module only uses the standard library, so the backend
+can import it without pulling in the agents' dependencies.
+
+Every write is durable when it returns: the data and the rename are fsynced. Writers that
+arrive together share the cost through group commit (see GroupCommit): their changes are
+applied in one rewrite of the file and one fsync. GROUP_COMMIT_MS makes each batch wait that
+long for more writers; with 0, the default, a batch only gathers the writers that arrived
+while the previous one was being written.
+
+Readers take the lock shared (FileLock.shared) and writers exclusively, across processes. Every
+committed write also bumps a generation counter kept in the lock file, so a process holding a
+parsed copy of a file can tell from version_of() whether it changed without reading it.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to locking between threads of one process
+    fcntl = None
+
+# Home that investigations without one belong to
+DEFAULT_HOME = "home"
+
+GROUP_COMMIT_MS = float(os.getenv('GROUP_COMMIT_MS', '0'))
+
+
+def investigation_id(record: Dict[str, Any]) -> str:
+    """
+    A stable id for an investigation record, derived from its home and time window.
+    Records written before ids existed get the same id in every process.
+    """
+    situation = record.get('situation', {})
+    key = f"{record.get('home') or DEFAULT_HOME}|{situation.get('start_timestamp')}|{situation.get('end_timestamp')}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+class FileLock:
+    """
+    A lock on a file, held across processes through flock() on a sidecar '.lock' file
+    and across threads through an RLock. Held exclusively by writers, and re-entrant within
+    a thread; readers may hold it shared (see shared()). The lock file also holds the
+    generation of the file: the number of writes committed to it.
+
+    Within a process, a writer waiting for the lock holds back new readers, so that readers
+    overlapping one another cannot keep it out indefinitely.
+    """
+
+    def __init__(self, path: str):
+        self.path = path + '.lock'
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+        self._owner = None
+        # Where there is no lock file to keep the generation in, this process counts alone
+        self._generation = 0
+        # How deeply each thread holds the lock shared
+        self._shared = threading.local()
+        # Writers of this process waiting for the lock, which new readers wait for
+        self._writers = 0
+        self._gate = threading.Condition()
+
+    def acquire(self):
+        if self.held_shared() and not self.held():
+            # Upgrading would wait for our own shared lock, and two upgraders for each other
+            raise RuntimeError(f"Cannot lock {self.path} exclusively while holding it shared; release it first")
+        if self.held():
+            self._depth += 1
+            return
+        with self._gate:
+            self._writers += 1
+        try:
+            self._thread_lock.acquire()
+            if self._depth == 0 and fcntl is not None:
+                try:
+                    self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                    fcntl.flock(self._fd, fcntl.LOCK_EX)
+                except BaseException:
+                    if self._fd is not None:
+                        os.close(self._fd)
+                        self._fd = None
+                    self._thread_lock.release()
+                    raise
+            self._depth += 1
+            self._owner = threading.get_ident()
+        finally:
+            with self._gate:
+                self._writers -= 1
+                if self._writers == 0:
+                    self._gate.notify_all()
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._owner = None
+            if self._fd is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+                os.close(self._fd)
+                self._fd = None
+            self._thread_lock.release()
+
+    def held(self) -> bool:
+        """
+        Whether the calling thread holds this lock
+        """
+        return self._owner == threading.get_ident()
+
+    def held_shared(self) -> bool:
+        """
+        Whether the calling thread holds this lock shared
+        """
+        return getattr(self._shared, 'depth', 0) > 0
+
+    @contextmanager
+    def shared(self):
+        """
+        Hold the lock shared with other readers, in this process or others, so that no writer
+        changes the file meanwhile. Re-entrant; a thread that holds the lock exclusively keeps it that way.
+        A thread holding it shared cannot lock it exclusively (acquire() raises RuntimeError).
+        """
+        if fcntl is None or self.held():
+            with self:
+                yield self
+        elif self.held_shared():
+            self._shared.depth += 1
+            try:
+                yield self
+            finally:
+                self._shared.depth -= 1
+        else:
+            with self._gate:
+                self._gate.wait_for(lambda: self._writers == 0)
+            # A descriptor of its own, since flock() locks conflict between descriptors rather than processes
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                self._shared.depth = 1
+                try:
+                    yield self
+                finally:
+                    self._shared.depth = 0
+            finally:
+                os.close(fd)
+
+    def generation(self) -> int:
+        """
+        The number of writes committed to the file, by every process sharing it
+        """
+        if fcntl is None:
+            return self._generation
+        try:
+            with open(self.path, 'rb') as file:
+                return int.from_bytes(file.read(8), 'little')
+        except FileNotFoundError:
+            return 0
+
+    def bump(self) -> None:
+        """
+        Count a write to the file. Call with the lock held.
+        """
+        self._generation += 1
+        if self._fd is not None:
+            generation = int.from_bytes(os.pread(self._fd, 8, 0), 'little')
+            os.pwrite(self._fd, (generation + 1).to_bytes(8, 'little'), 0)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+_locks: Dict[str, FileLock] = {}
+_locks_guard = threading.Lock()
+
+
+def lock_for(path: str) -> FileLock:
+    """
+    Return the process-wide lock for a file, so every writer in this process shares it
+    """
+    path = os.path.abspath(path)
+    with _locks_guard:
+        if path not in _locks:
+            _locks[path] = FileLock(path)
+        return _locks[path]
+
+
+def version_of(path: str) -> Optional[Tuple[int, int, int, int]]:
+    """
+    A token that changes whenever the file does: its generation, and its inode, modification time
+    and size, which also catch writers that do not count generations (such as an editor)
+    :return: the token, or None if the file does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return lock_for(path).generation(), stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def fsync_directory(directory: str) -> None:
+    """
+    Make the entries of a directory durable, such as a file just renamed into it
+    """
+    if os.name == 'nt':  # Directories cannot be opened, and NTFS journals renames itself
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path: str, write: Callable, mode: str = 'w') -> None:
+    """
+    Write a file by streaming into a temporary file in the same directory and renaming it
+    over the target, so readers see either the old or the new contents, never a partial file,
+    and a crash leaves one or the other on disk.
+    :param path: the file to replace
+    :param write: called with the open temporary file
+    :param mode: the mode to open the temporary file with
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, mode) as file:
+            write(file)
+            file.flush()
+            os.fsync(file.fileno())
+        try:
+            os.chmod(temp_path, os.stat(path).st_mode & 0o777)
+        except FileNotFoundError:
+            os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    fsync_directory(directory)
+
+
+def append_lines(path: str, lines: List[str]) -> None:
+    """
+    Append lines to a file and fsync it. A line cut short by a crash is ended first,
+    so it costs only itself rather than also the line appended after it.
+    """
+    with open(path, 'a+b') as file:
+        if file.tell() > 0:
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b'\n':
+                file.write(b'\n')
+        file.write(''.join(lines).encode('utf-8'))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+class _Change:
+    __slots__ = ('apply', 'done', 'result', 'error')
+
+    def __init__(self, apply: Callable[[Any], Any]):
+        self.apply = apply
+        self.done = False
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class GroupCommit:
+    """
+    Commits changes to one file in batches. Each writer hands in a function that changes the
+    loaded document; the first writer to find no batch in progress becomes the leader, takes
+    every change waiting, and under the file lock loads the document once, applies them in
+    order and saves it once, while the other writers wait for their change to be committed.
+    A burst of N writes thus costs one load, one save and one fsync rather than N of each.
+
+    A change must not fail after changing the document, since the others in its batch are saved with it.
+    """
+
+    def __init__(self, path: str, load: Callable[[], Any], save: Callable[[Any], None], delay: float = GROUP_COMMIT_MS / 1000):
+        """
+        :param path: the file, whose lock is held while a batch is committed
+        :param load: returns the document changes are applied to
+        :param save: writes the changed document durably
+        :param delay: seconds a leader waits for more changes before committing
+        """
+        self.lock = lock_for(path)
+        self.load = load
+        self.save = save
+        self.delay = delay
+        self._pending: List[_Change] = []
+        self._leading = False
+        self._condition = threading.Condition()
+
+    def commit(self, apply: Callable[[Any], Any]) -> Any:
+        """
+        Apply a change to the document and save it, returning once it is on disk
+        :param apply: called with the document, which it changes in place
+        :return: whatever apply returns
+        """
+        change = _Change(apply)
+        if self.lock.held_shared() and not self.lock.held():
+            # A leader would wait for this thread's shared lock while this thread waited for the leader
+            raise RuntimeError(f"Cannot write {self.lock.path[:-len('.lock')]} while holding it shared")
+        if self.lock.held():
+            # The caller already excludes every other writer, and a leader would wait on it for the lock
+            self._commit([change])
+        else:
+            with self._condition:
+                self._pending.append(change)
+                while self._leading and not change.done:
+                    self._condition.wait()
+                if not change.done:
+                    self._leading = True
+            if not change.done:
+                try:
+                    if self.delay:
+                        time.sleep(self.delay)
+                    with self._condition:
+                        batch, self._pending = self._pending, []
+                    with self.lock:
+                        self._commit(batch)
+                finally:
+                    with self._condition:
+                        self._leading = False
+                        self._condition.notify_all()
+        if change.error is not None:
+            raise change.error
+        return change.result
+
+    def _commit(self, batch: List[_Change]) -> None:
+        try:
+            document = self.load()
+            for change in batch:
+                try:
+                    change.result = change.apply(document)
+                except Exception as e:
+                    change.error = e
+            if any(change.error is None for change in batch):
+                self.save(document)
+                self.lock.bump()
+        except BaseException as e:
+            for change in batch:
+                change.error = change.error or e
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            for change in batch:
+                change.done = True
+
+
+def _load_json(path: str, default: Any) -> Any:
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            contents = file.read()
+        if contents.strip():
+            return json.loads(contents)
+    return default
+
+
+_commits: Dict[Tuple[str, int], GroupCommit] = {}
+_commits_guard = threading.Lock()
+
+
+def _json_commit(path: str, indent: int) -> GroupCommit:
+    path = os.path.abspath(path)
+    with _commits_guard:
+        if (path, indent) not in _commits:
+            # The document is boxed, so the first change of a batch can start it from its own default
+            _commits[path, indent] = GroupCommit(
+                path, load=lambda: [_load_json(path, None)],
+                save=lambda box: atomic_write(path, lambda file: json.dump(box[0], file, indent=indent)))
+        return _commits[path, indent]
+
+
+def update_json(path: str, update: Callable[[Any], Any], default: Any = None, indent: int = 2) -> Any:
+    """
+    Read-modify-write a JSON document while holding its lock, replacing it atomically.
+    Concurrent updates of the same file are committed together (see GroupCommit).
+    :param path: the JSON file
+    :param update: called with the parsed document, which it mutates in place
+    :param default: the document to start from when the file is missing or empty
+    :return: whatever update returns
+    """
+    def apply(box):
+        if box[0] is None:
+            box[0] = default
+        return update(box[0])
+
+    return _json_commit(path, indent).commit(apply)
@@ -0,0 +1,276 @@
+"""
+The LLM clients the Scanner and Frontier agents call through. The client owns the connection pool,
+the request timeout and the limit on requests in flight, so the agents only build messages.
+The agents share one client per process, behind the LLMScheduler in llm_scheduler.py.
+
+LLM_BACKEND chooses the client, and LLM_MODEL overrides the model the agents ask for:
+    openai  the OpenAI API, or any server speaking it (llama.cpp, vLLM, Ollama) when LLM_BASE_URL is set
+    stub    a deterministic stand-in that never leaves the process, for offline runs and throughput tests
+"""
+
+import os
+import re
+import threading
+import time
+from collections import deque
+from enum import IntEnum
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Type
+
+from pydantic import BaseModel
+
+from agents.metrics import metrics
+from agents.prompt_builder import count_message_tokens, count_tokens
+
+LLM_TIMEOUT_SECONDS = float(os.getenv('LLM_TIMEOUT_SECONDS', '30'))
+# Requests in flight at once, across every agent sharing the client; also the size of the connection pool
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '4'))
+LLM_STUB_LATENCY_MS = float(os.getenv('LLM_STUB_LATENCY_MS', '0'))
+
+
+class Priority(IntEnum):
+    """
+    Which requests a scheduler sends first when the budget is short: lower values go first
+    """
+    ALERT = 0
+    BACKLOG = 1
+
+
+class LLMError(Exception):
+    """
+    A request the LLM did not answer, such as one that timed out, which may succeed if sent again
+    """
+
+
+class RateLimited(LLMError):
+    """
+    The provider refused a request because a rate limit was reached
+    """
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        # Seconds the provider asked us to wait, if it said
+        self.retry_after = retry_after
+
+
+class Usage(NamedTuple):
+    prompt_tokens: int
+    completion_tokens: int
+
+
+class Completion(NamedTuple):
+    """
+    What a client returns: the reply's text, the reply parsed into the requested model if one was
+    given, and the tokens used, shaped like an OpenAI response's usage
+    """
+    text: str
+    parsed: Optional[BaseModel]
+    usage: Usage
+
+
+class LLMClient:
+    """
+    The interface the agents call. Subclasses implement _complete; complete() holds one of
+    max_concurrency slots around it, so a burst of calls queues here instead of at the provider.
+    """
+
+    name: str = ""
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, timeout: float = LLM_TIMEOUT_SECONDS,
+                 model: Optional[str] = None):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        # Read here rather than at import, after the agents have loaded .env
+        self.model = model or os.getenv('LLM_MODEL')
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+    def complete(self, messages: List[Dict[str, str]], model: str, max_tokens: Optional[int] = None,
+                 response_format: Optional[Type[BaseModel]] = None, seed: Optional[int] = 42,
+                 priority: Priority = Priority.BACKLOG) -> Completion:
+        """
+        Send messages to the model and wait for the reply
+        :param messages: the chat messages, in the format expected by OpenAI
+        :param model: the model to use, unless this client was configured with another
+        :param max_tokens: the most tokens the reply may have
+        :param response_format: a pydantic model the reply must be parsed into
+        :param seed: for replies that are as repeatable as the backend allows
+        :param priority: how urgent the request is; only a scheduler acts on it
+        :return: the completion
+        :raises LLMError: if the request failed in a way that may succeed if sent again
+        """
+        with self._slots:
+            start = time.perf_counter()
+            try:
+                return self._complete(messages, self.model or model, max_tokens, response_format, seed)
+            finally:
+                metrics.observe("llm_request_seconds", time.perf_counter() - start, backend=self.name)
+
+    def _complete(self, messages, model, max_tokens, response_format, seed) -> Completion:
+        raise NotImplementedError
+
+
+class OpenAIClient(LLMClient):
+    """
+    Calls the OpenAI API through one pooled HTTP client, or any server that speaks the same API
+    """
+
+    name = "openai"
+
+    # Retries are left to the scheduler, which knows about every other request in flight
+    def __init__(self, base_url: Optional[str] = None, max_retries: int = 0, **kwargs):
+        super().__init__(**kwargs)
+        base_url = base_url or os.getenv('LLM_BASE_URL')
+        import httpx
+        from openai import DefaultHttpxClient, OpenAI
+
+        self.client = OpenAI(
+            base_url=base_url,
+            # A local server needs no key, but the client insists on one
+            api_key=os.getenv('OPENAI_API_KEY') or ('local' if base_url else None),
+            timeout=self.timeout,
+            max_retries=max_retries,
+            http_client=DefaultHttpxClient(limits=httpx.Limits(max_connections=self.max_concurrency,
+                                                               max_keepalive_connections=self.max_concurrency)),
+        )
+
+    def _complete(self, messages, model, max_tokens, response_format, seed):
+        import openai
+
+        try:
+            if response_format is not None:
+                response = self.client.beta.chat.completions.parse(
+                    model=model, messages=messages, seed=seed, max_tokens=max_tokens, response_format=response_format)
+                parsed = response.choices[0].message.parsed
+            else:
+                response = self.client.chat.completions.create(
+                    model=model, messages=messages, seed=seed, max_tokens=max_tokens)
+                parsed = None
+        except openai.RateLimitError as e:
+            raise RateLimited(str(e), retry_after=self._retry_after(e.response)) from e
+        except (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError) as e:
+            raise LLMError(str(e)) from e
+        usage = response.usage
+        return Completion(response.choices[0].message.content or "", parsed,
+                          Usage(usage.prompt_tokens if usage else 0, usage.completion_tokens if usage else 0))
+
+
+    @staticmethod
+    def _retry_after(response) -> Optional[float]:
+        headers = getattr(response, 'headers', None) or {}
+        try:
+            if headers.get('retry-after-ms'):
+                return float(headers['retry-after-ms']) / 1000
+            if headers.get('retry-after'):
+                return float(headers['retry-after'])
+        except ValueError:
+            pass
+        return None
+
+
+_WINDOW = re.compile(r"Window from (\d+) .*? to (\d+) .*?, (\d+) events:")
+_CLOCK = re.compile(r"^(\d\d):\d\d:\d\d", re.MULTILINE)
+
+# Hours in which activity makes the stub call a window anomalous
+NIGHT_HOURS = range(0, 5)
+
+
+def night_activity(text: str) -> bool:
+    return any(int(hour) in NIGHT_HOURS for hour in _CLOCK.findall(text))
+
+
+def stub_reply(messages: List[Dict[str, str]], response_format: Optional[Type[BaseModel]]):
+    """
+    Answer the way the agents' prompts ask, from what the prompt itself says: a window is anomalous
+    if it has events at night. For the scanner, the first window in the prompt is described by its
+    timestamps and event count; for anything else, the reply is the one word.
+    """
+    prompt = messages[-1]["content"] if messages[-1]["role"] == "user" else messages[-2]["content"]
+    if response_format is None:
+        # The situation being estimated comes last, after the similar ones
+        return "anomalous" if night_activity(prompt.rsplit("And now the situaton for you:", 1)[-1]) else "normal"
+
+    match = _WINDOW.search(prompt)
+    if match is None:
+        return response_format(situations=[])
+    start, end, events = match.groups()
+    window = prompt[match.end():].split("\n\n", 1)[0]
+    rooms = sorted(set(re.findall(r"^\d\d:\d\d:\d\d\S* (\w+) ", window, re.MULTILINE)))
+    return response_format(situations=[{
+        "situation_description": f"{events} sensor events were recorded in the {', '.join(rooms) or 'home'}.",
+        "result": "anomalous" if night_activity(window) else "normal",
+        "start_timestamp": int(start),
+        "end_timestamp": int(end),
+    }])
+
+
+class StubClient(LLMClient):
+    """
+    A deterministic stand-in that answers in-process after a fixed latency, so the pipeline can run
+    and be timed offline. Replies come from stub_reply unless another responder is given.
+    Given request or token limits, it also throttles like a provider: a request that would take
+    the last `window` seconds over a limit is refused with RateLimited.
+    """
+
+    name = "stub"
+
+    def __init__(self, latency: float = LLM_STUB_LATENCY_MS / 1000,
+                 responder: Optional[Callable[[List[Dict[str, str]], Optional[Type[BaseModel]]], Any]] = None,
+                 rpm_limit: Optional[int] = None, tpm_limit: Optional[int] = None, window: float = 60.0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.responder = responder or stub_reply
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.window = window
+        self.calls = 0
+        self.throttled = 0
+        self._recent = deque()  # (time, tokens) of the requests accepted within the window
+        self._lock = threading.Lock()
+
+    def _admit(self, tokens: int) -> None:
+        with self._lock:
+            now = time.monotonic()
+            while self._recent and self._recent[0][0] <= now - self.window:
+                self._recent.popleft()
+            over_requests = self.rpm_limit is not None and len(self._recent) + 1 > self.rpm_limit
+            over_tokens = self.tpm_limit is not None and sum(used for _, used in self._recent) + tokens > self.tpm_limit
+            if over_requests or over_tokens:
+                self.throttled += 1
+                retry_after = self._recent[0][0] + self.window - now if self._recent else self.window
+                raise RateLimited("Rate limit reached (simulated)", retry_after=retry_after)
+            self._recent.append((now, tokens))
+            self.calls += 1
+
+    def _complete(self, messages, model, max_tokens, response_format, seed):
+        prompt_tokens = count_message_tokens(messages)
+        self._admit(prompt_tokens + (max_tokens or 0))
+        if self.latency:
+            time.sleep(self.latency)
+        reply = self.responder(messages, response_format)
+        parsed = reply if isinstance(reply, BaseModel) else None
+        text = reply.model_dump_json() if parsed is not None else str(reply)
+        return Completion(text, parsed, Usage(prompt_tokens, count_tokens(text)))
+
+
+BACKENDS = {"openai": OpenAIClient, "stub": StubClient}
+
+
+def make_client(backend: Optional[str] = None, **kwargs) -> LLMClient:
+    """
+    Create a client for the named backend, by default the one LLM_BACKEND names
+    :raises ValueError: if there is no such backend
+    """
+    backend = backend or os.getenv('LLM_BACKEND', 'openai')
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown LLM backend '{backend}', expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[backend](**kwargs)
+
+
+@lru_cache(maxsize=1)
+def default_client() -> LLMClient:
+    """
+    The client every agent in this process shares, behind one scheduler, so they share its connections,
+    rate limits and concurrency
+    """
+    from agents.llm_scheduler import LLMScheduler
+    return LLMScheduler(make_client())
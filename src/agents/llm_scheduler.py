@@ -0,0 +1,196 @@
+"""
+One queue for every LLM request a process makes, so the agents share the provider's rate limits instead
+of each running into them. Requests are sent in order of priority (alerts before backlog), within
+requests-per-minute and tokens-per-minute budgets. A request refused for a rate limit or lost to a
+timeout is retried after a jittered backoff. The number of requests in flight adapts: it halves when
+the provider throttles, drops when replies slow down, and creeps back up while they come back quickly.
+"""
+
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from agents.llm import Completion, LLMClient, LLMError, Priority, RateLimited
+from agents.metrics import metrics
+from agents.prompt_builder import count_message_tokens
+
+# Budgets per minute, by default those of gpt-4o-mini on the first usage tier
+LLM_RPM = int(os.getenv('LLM_RPM', '500'))
+LLM_TPM = int(os.getenv('LLM_TPM', '200000'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '4'))
+# Replies slower than this make the scheduler send fewer requests at once
+LLM_TARGET_LATENCY_SECONDS = float(os.getenv('LLM_TARGET_LATENCY_SECONDS', '15'))
+
+# Tokens a reply is assumed to take when the request does not cap it
+COMPLETION_TOKENS_ESTIMATE = 500
+# Backoff before the nth retry is drawn between 0 and min(BACKOFF_CAP, BACKOFF_BASE * 2**n) seconds
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_CAP_SECONDS = 30.0
+
+
+class TokenBucket:
+    """
+    A budget that refills continuously up to `per_window` every `window` seconds. Not thread-safe: the scheduler
+    only touches it with its lock held.
+    """
+
+    def __init__(self, per_window: float, window: float = 60.0):
+        self.capacity = per_window
+        self.rate = per_window / window
+        self.level = per_window
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """
+        Seconds until `amount` can be taken; a request larger than the whole budget waits for a full bucket
+        """
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float, now: float) -> None:
+        """
+        Spend from the budget; a negative amount gives back an overestimate
+        """
+        self._refill(now)
+        self.level = min(self.capacity, self.level - amount)
+
+
+class LLMScheduler(LLMClient):
+    """
+    Wraps a client and sends every request through a shared priority queue.
+    Within a priority, requests go in the order they were made, and a retried request keeps its place.
+    """
+
+    name = "scheduler"
+
+    def __init__(self, client: LLMClient, rpm: int = LLM_RPM, tpm: int = LLM_TPM,
+                 max_retries: int = LLM_MAX_RETRIES, target_latency: float = LLM_TARGET_LATENCY_SECONDS,
+                 window: float = 60.0):
+        """
+        :param client: the client that makes the requests; its concurrency limit is the most the scheduler allows
+        :param rpm: requests allowed per window
+        :param tpm: tokens allowed per window, counting each request's prompt and the most its reply may take
+        :param max_retries: how many times a failed request is sent again before its error is raised
+        :param target_latency: replies slower than this, in seconds, reduce the requests in flight
+        :param window: the length of the budget window in seconds; shorter in tests
+        """
+        super().__init__(max_concurrency=client.max_concurrency, timeout=client.timeout, model=client.model)
+        self.client = client
+        self.max_retries = max_retries
+        self.target_latency = target_latency
+        self.requests = TokenBucket(rpm, window)
+        self.tokens = TokenBucket(tpm, window)
+        # The number of requests allowed in flight, between 1 and the client's limit
+        self.limit = client.max_concurrency
+        self.in_flight = 0
+        self._fast_replies = 0
+        self._paused_until = 0.0
+        self._queue: List[Tuple[int, int]] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def complete(self, messages, model, max_tokens=None, response_format=None, seed=42,
+                 priority: Priority = Priority.BACKLOG) -> Completion:
+        """
+        Queue a request, send it when its turn comes and the budgets allow, and retry it if it fails
+        in a way that may succeed later
+        :raises LLMError: the last error, once the retries are used up
+        """
+        estimate = count_message_tokens(messages) + (max_tokens or COMPLETION_TOKENS_ESTIMATE)
+        ticket = (int(priority), next(self._sequence))
+        label = priority.name.lower()
+        queued = time.monotonic()
+
+        for attempt in range(self.max_retries + 1):
+            self._acquire(ticket, estimate)
+            if attempt == 0:
+                metrics.observe("llm_queue_seconds", time.monotonic() - queued, priority=label)
+            start = time.monotonic()
+            try:
+                completion = self.client.complete(messages, model, max_tokens, response_format, seed)
+            except RateLimited as e:
+                self._release(throttled=True, retry_after=e.retry_after)
+                error, delay, reason = e, self._backoff(attempt, e.retry_after), "rate_limited"
+            except LLMError as e:
+                self._release()
+                error, delay, reason = e, self._backoff(attempt), "error"
+            except BaseException:
+                self._release()
+                raise
+            else:
+                used = completion.usage.prompt_tokens + completion.usage.completion_tokens
+                self._release(latency=time.monotonic() - start, overestimate=estimate - used if used else 0)
+                return completion
+
+            if attempt == self.max_retries:
+                raise error
+            metrics.count("llm_retries_total", reason=reason, priority=label)
+            time.sleep(delay)
+
+    def _backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Full jitter, so requests refused together do not all come back together
+        """
+        if retry_after is not None:
+            return retry_after + random.uniform(0, BACKOFF_BASE_SECONDS)
+        return random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+    def _acquire(self, ticket: Tuple[int, int], estimate: int) -> None:
+        with self._condition:
+            heapq.heappush(self._queue, ticket)
+            try:
+                while True:
+                    timeout = None
+                    if self._queue[0] == ticket and self.in_flight < self.limit:
+                        now = time.monotonic()
+                        timeout = max(self._paused_until - now,
+                                      self.requests.wait_time(1, now),
+                                      self.tokens.wait_time(estimate, now))
+                        if timeout <= 0:
+                            heapq.heappop(self._queue)
+                            self.requests.take(1, now)
+                            self.tokens.take(min(estimate, self.tokens.capacity), now)
+                            self.in_flight += 1
+                            # The next request in line may be able to go as well
+                            self._condition.notify_all()
+                            return
+                    self._condition.wait(timeout)
+            except BaseException:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                self._condition.notify_all()
+                raise
+
+    def _release(self, latency: Optional[float] = None, overestimate: int = 0,
+                 throttled: bool = False, retry_after: Optional[float] = None) -> None:
+        with self._condition:
+            now = time.monotonic()
+            self.in_flight -= 1
+            if throttled:
+                # Multiplicative decrease, and nobody sends until the provider said we may
+                self.limit = max(1, self.limit // 2)
+                self._fast_replies = 0
+                if retry_after:
+                    self._paused_until = max(self._paused_until, now + retry_after)
+                metrics.count("llm_throttled_total")
+            elif latency is not None:
+                self.tokens.take(-overestimate, now)
+                if latency > self.target_latency:
+                    self.limit = max(1, self.limit - 1)
+                    self._fast_replies = 0
+                else:
+                    # Additive increase: one more in flight after a full round of quick replies
+                    self._fast_replies += 1
+                    if self._fast_replies >= self.limit:
+                        self.limit = min(self.max_concurrency, self.limit + 1)
+                        self._fast_replies = 0
+            self._condition.notify_all()
@@ -0,0 +1,175 @@
+"""
+Counters and timing histograms for the agent pipeline, rendered as Prometheus text or a JSON snapshot.
+Recording is a dictionary lookup and a few additions, so it stays on the hot path.
+This module only uses the standard library, so the dashboard backend can import it too.
+"""
+
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
+
+from agents.json_store import atomic_write
+
+# Prefix of every exported metric name
+NAMESPACE = "careagent"
+
+# Upper bounds of the latency buckets, in seconds: from featurizing a window to a slow LLM call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HELP = {
+    "stage_seconds": "Time spent in each stage of the pipeline",
+    "ensemble_member_seconds": "Time each ensemble member takes to estimate a situation",
+    "llm_tokens_total": "Tokens sent to and received from the LLM",
+    "llm_requests_total": "Requests made to the LLM",
+    "llm_request_seconds": "Time each LLM request takes, including waiting for a free slot in the client",
+    "llm_queue_seconds": "Time LLM requests wait in the scheduler's queue before they are first sent",
+    "llm_retries_total": "LLM requests sent again after a rate limit or an error",
+    "llm_throttled_total": "LLM requests the provider refused for a rate limit",
+    "prompt_tokens_total": "Tokens in the prompts built for the LLM, counted locally",
+    "prompt_lines_omitted_total": "Lines of sensor events left out of prompts to keep within their token budget",
+    "embed_batch_seconds": "Time the embedding model takes to encode each batch of texts",
+    "embed_texts_total": "Texts encoded by the embedding model",
+    "embed_batches_total": "Batches the embedding model encoded; texts per batch show how well requests are combined",
+    "cache_hits_total": "Lookups answered from a cache",
+    "cache_misses_total": "Lookups a cache could not answer",
+    "windows_processed_total": "Sensor windows estimated by the ensemble",
+    "alerts_total": "Alerts sent about anomalous situations",
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket, plus one for values above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class MetricsRegistry:
+    """
+    Holds every counter and histogram of the process, each identified by a name and labels
+    """
+
+    def __init__(self):
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._lock = threading.Lock()
+
+    def count(self, name: str, value: float = 1, **labels) -> None:
+        """
+        Add to a counter
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """
+        Record a value, such as a duration in seconds, in a histogram
+        """
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        """
+        Time the enclosed block into a histogram, whether or not it raises
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self, process: str = "") -> Dict[str, Any]:
+        """
+        Return every metric as JSON-compatible data
+        :param process: a name for this process, such as 'agents' or 'backend'
+        """
+        with self._lock:
+            counters = list(self._counters.items())
+            histograms = list(self._histograms.items())
+        return {
+            "process": process,
+            "generated_at": time.time(),
+            "pid": os.getpid(),
+            "counters": [{"name": name, "labels": dict(labels), "value": value}
+                         for (name, labels), value in counters],
+            "histograms": [{"name": name, "labels": dict(labels), "buckets": list(histogram.buckets),
+                            "counts": list(histogram.counts), "sum": histogram.sum, "count": histogram.count}
+                           for (name, labels), histogram in histograms],
+        }
+
+    def write_snapshot(self, path: str, process: str = "") -> None:
+        """
+        Save the snapshot to a file, for another process to serve
+        """
+        snapshot = self.snapshot(process)
+        atomic_write(path, lambda file: json.dump(snapshot, file))
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return "{" + pairs + "}"
+
+
+def render_prometheus(snapshots: List[Dict[str, Any]]) -> str:
+    """
+    Render snapshots in the Prometheus text exposition format. Samples from a snapshot that names
+    its process get a process label, so the same metric from two processes stays apart.
+    """
+    families: Dict[str, Tuple[str, List[str]]] = {}
+
+    for snapshot in snapshots:
+        extra = {"process": snapshot["process"]} if snapshot.get("process") else {}
+        for counter in snapshot.get("counters", []):
+            samples = families.setdefault(counter["name"], ("counter", []))[1]
+            samples.append(f"{NAMESPACE}_{counter['name']}{_format_labels({**counter['labels'], **extra})} {counter['value']}")
+        for histogram in snapshot.get("histograms", []):
+            name, labels = histogram["name"], {**histogram["labels"], **extra}
+            samples = families.setdefault(name, ("histogram", []))[1]
+            cumulative = 0
+            for bound, count in zip(list(histogram["buckets"]) + ["+Inf"], histogram["counts"]):
+                cumulative += count
+                samples.append(f"{NAMESPACE}_{name}_bucket{_format_labels({**labels, 'le': bound})} {cumulative}")
+            samples.append(f"{NAMESPACE}_{name}_sum{_format_labels(labels)} {histogram['sum']}")
+            samples.append(f"{NAMESPACE}_{name}_count{_format_labels(labels)} {histogram['count']}")
+
+    lines = []
+    for name, (kind, samples) in families.items():
+        lines.append(f"# HELP {NAMESPACE}_{name} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {NAMESPACE}_{name} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+# The registry every agent in this process records into
+metrics = MetricsRegistry()
@@ -0,0 +1,191 @@
+"""
+Versioned model artifacts in data/models, described by data/models/manifest.json.
+Retraining publishes new versions here, and the agents load whichever version the manifest names.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import joblib
+
+from agents.json_store import atomic_write, lock_for, update_json
+
+MODELS_DIR = 'models'
+MANIFEST_FILE = 'manifest.json'
+
+# Artifacts kept per model besides the current one, so a bad publish can be rolled back by hand
+KEEP_VERSIONS = 5
+
+# How often watchers check the manifest for a new version, in seconds
+WATCH_INTERVAL_SECONDS = float(os.getenv('MODEL_WATCH_INTERVAL', '5'))
+
+# Memory-map the arrays in artifacts, so processes loading the same version share their pages.
+# Set MODEL_MMAP=0 to load them into private memory instead.
+MMAP_MODE = 'r' if os.getenv('MODEL_MMAP', '1') != '0' else None
+
+
+class ModelRegistry:
+    """
+    Stores each published artifact as data/models/<name>/v<version>.pkl and records the current
+    version of every model, with its validation metrics, in the manifest
+    """
+
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+        self.root = os.path.join(data_dir, MODELS_DIR)
+        self.manifest_path = os.path.join(self.root, MANIFEST_FILE)
+
+    def read_manifest(self) -> Dict[str, Any]:
+        try:
+            with open(self.manifest_path, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {"models": {}}
+
+    def current(self, name: str) -> Optional[Dict[str, Any]]:
+        """
+        Return the manifest entry of the current version of a model, or None if none was published
+        """
+        return self.read_manifest()["models"].get(name)
+
+    def artifact_path(self, name: str, version: int) -> str:
+        return os.path.join(self.root, name, f"v{version:04d}.pkl")
+
+    def publish(self, name: str, artifact: Any, metrics: Dict[str, float], **info) -> int:
+        """
+        Save an artifact as the next version of a model and make it current
+        :param name: the model name, such as 'random_forest'
+        :param artifact: the object the agent loads, such as a (model, scaler, vectorizer) tuple
+        :param metrics: the validation metrics the artifact was accepted with
+        :param info: anything else worth recording in the manifest
+        :return: the new version number
+        """
+        os.makedirs(os.path.join(self.root, name), exist_ok=True)
+        with lock_for(self.manifest_path):
+            entry = self.current(name) or {}
+            version = entry.get("version", 0) + 1
+            path = self.artifact_path(name, version)
+            atomic_write(path, lambda file: joblib.dump(artifact, file), mode='wb')
+
+            def update(manifest):
+                manifest["models"][name] = {
+                    "version": version,
+                    "file": os.path.relpath(path, self.root),
+                    "published_at": int(time.time()),
+                    "metrics": metrics,
+                    **info,
+                }
+
+            update_json(self.manifest_path, update, default={"models": {}})
+            self._prune(name, version)
+        return version
+
+    def _prune(self, name: str, version: int) -> None:
+        for old in range(version - KEEP_VERSIONS - 1, 0, -1):
+            path = self.artifact_path(name, old)
+            if not os.path.exists(path):
+                break
+            os.unlink(path)
+
+    def load(self, name: str, legacy_file: Optional[str] = None, mmap_mode: Optional[str] = None) -> Tuple[Any, int]:
+        """
+        Load the current artifact of a model
+        :param name: the model name
+        :param legacy_file: a file in the data directory to fall back to while nothing has been published
+        :param mmap_mode: passed to joblib.load; 'r' maps the artifact's arrays read-only instead of copying them
+        :return: the artifact and its version, which is 0 for the legacy file
+        :raises FileNotFoundError: if there is neither a published version nor a legacy file
+        """
+        entry = self.current(name)
+        if entry is not None:
+            return joblib.load(os.path.join(self.root, entry["file"]), mmap_mode=mmap_mode), entry["version"]
+        if legacy_file is not None:
+            path = os.path.join(self.data_dir, legacy_file)
+            if os.path.exists(path):
+                return joblib.load(path, mmap_mode=mmap_mode), 0
+        raise FileNotFoundError(f"No published version of model '{name}' in {self.root}")
+
+    def watch(self, name: str, legacy_file: Optional[str] = None,
+              on_swap: Optional[Callable[[int], None]] = None) -> 'ModelWatcher':
+        """
+        Load the current artifact of a model and keep it current in the background
+        """
+        return ModelWatcher(self, name, legacy_file, on_swap).start()
+
+
+class ModelWatcher:
+    """
+    Holds the current artifact of one model. A background thread checks the manifest and,
+    when a new version is published, loads it and swaps it in with a single assignment:
+    predictions keep using the previous artifact until then and never wait for a load.
+    """
+
+    def __init__(self, registry: ModelRegistry, name: str, legacy_file: Optional[str] = None,
+                 on_swap: Optional[Callable[[int], None]] = None, interval: float = WATCH_INTERVAL_SECONDS):
+        self.registry = registry
+        self.name = name
+        self.legacy_file = legacy_file
+        self.on_swap = on_swap
+        self.interval = interval
+        self._current: Tuple[Any, int] = registry.load(name, legacy_file, mmap_mode=MMAP_MODE)
+        self._manifest_stamp = self._stamp()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def artifact(self) -> Any:
+        return self._current[0]
+
+    @property
+    def version(self) -> int:
+        return self._current[1]
+
+    def current(self) -> Tuple[Any, int]:
+        """
+        Return the artifact together with its version, read consistently
+        """
+        return self._current
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.registry.manifest_path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def start(self) -> 'ModelWatcher':
+        self._thread = threading.Thread(target=self._loop, name=f"model-watcher-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                logging.warning(f"Could not load a new version of model '{self.name}': {e}")
+
+    def check(self) -> bool:
+        """
+        Swap in the current version if the manifest names a different one
+        :return: whether a new version was swapped in
+        """
+        stamp = self._stamp()
+        if stamp == self._manifest_stamp:
+            return False
+        entry = self.registry.current(self.name)
+        if entry is None or entry["version"] == self.version:
+            self._manifest_stamp = stamp
+            return False
+        self._current = self.registry.load(self.name, self.legacy_file, mmap_mode=MMAP_MODE)
+        self._manifest_stamp = stamp
+        if self.on_swap is not None:
+            self.on_swap(self.version)
+        return True
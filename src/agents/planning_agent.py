@@ -16,7 +16,7 @@ class PlanningAgent(Agent):
         Create instances of the 3 Agents that this planner coordinates across
         """
         self.log("Planning Agent is initializing")
-        self.log(collection)
+        self.log("Planning Agent was given a collection", event="collection", size=len(collection))
         self.scanner = ScannerAgent()
         self.ensemble = EnsembleAgent(collection)
         self.messenger = MessagingAgent()
@@ -29,9 +29,11 @@ class PlanningAgent(Agent):
         :returns: an investigation including the result
         """
         self.log("Planning Agent is investigating a potential situation")
-        estimate = self.ensemble.estimate(situation)
+        with self.timer("ensemble"):
+            estimate = self.ensemble.estimate(situation)
+        self.count("windows_processed_total", estimate=estimate)
 #        estimate = "anomalous"
-        self.log(f"Planning Agent has processed a situation with estimate: {estimate}")
+        self.log("Planning Agent has processed a situation", event="estimate", estimate=estimate)
         return Investigation(situation=situation, estimate=estimate)
 
     def plan(self, memory: List[str] = []) -> Optional[Investigation]:
@@ -49,9 +51,11 @@ class PlanningAgent(Agent):
             investigations = [self.run(situation) for situation in selection.situations[:5]]
             investigations.sort(key=lambda inv: inv.estimate, reverse=True)
             best = investigations[0]
-            self.log(f"Planning Agent has identified the best situation has result ${best.estimate}")
+            self.log("Planning Agent has identified the best situation", event="best", estimate=best.estimate)
             if best.estimate == "anomalous":
-                self.messenger.alert(best)
+                with self.timer("alert"):
+                    self.messenger.alert(best)
+                self.count("alerts_total")
             self.log("Planning Agent has completed a run")
 #            return best if best.estimate == "anomalous" else None
             return best
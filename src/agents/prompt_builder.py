@@ -0,0 +1,238 @@
+"""
+Prompts that fit a token budget. Sensor events are written one short line each, with identical
+consecutive readings dropped and runs of occupancy pings in a room collapsed into one line. When a
+window still does not fit, events are cut from its middle, so its start and end always survive.
+"""
+
+import importlib.util
+import json
+import math
+import os
+import re
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from agents.events import SensorEvent, load_events
+
+TIMEZONE = datetime.now().astimezone().tzinfo
+
+# The encoding of gpt-4o and gpt-4o-mini
+ENCODING = 'o200k_base'
+
+# Token budgets for a whole call (system and user messages), per agent
+SCANNER_PROMPT_TOKENS = int(os.getenv('SCANNER_PROMPT_TOKENS', '6000'))
+FRONTIER_PROMPT_TOKENS = int(os.getenv('FRONTIER_PROMPT_TOKENS', '3000'))
+
+# Occupancy pings in one room less than this many seconds apart are written as one line
+OCCUPANCY_RUN_SECONDS = 15 * 60
+
+# An event that repeats the one right before it within this many seconds is a duplicate report and dropped.
+# Further apart, or with other events in between, a repeat is kept: event sensors (a fridge door, a
+# pillbox) always report the same reading, and each of their reports is activity.
+REPEAT_SECONDS = 60
+
+# Tokens the chat format adds around each message, and to prime the reply
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+_PIECES = re.compile(r"[A-Za-z]+|\d+|[^\w\s]")
+
+
+class Tokenizer:
+    """
+    Counts tokens locally with tiktoken when it is installed and has the encoding. Otherwise it estimates
+    them from the words, digits and punctuation in the text, erring slightly on the high side.
+    """
+
+    def __init__(self, encoding: str = ENCODING):
+        self.encoding = None
+        if importlib.util.find_spec('tiktoken') is not None:
+            import tiktoken
+            try:
+                self.encoding = tiktoken.get_encoding(encoding)
+            except Exception:
+                # The encoding is downloaded on first use, which fails offline
+                self.encoding = None
+
+    def count(self, text: str) -> int:
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        tokens = 0
+        for piece in _PIECES.findall(text):
+            if piece[0].isdigit():
+                tokens += math.ceil(len(piece) / 3)
+            elif piece[0].isalpha():
+                tokens += math.ceil(len(piece) / 5)
+            else:
+                tokens += 1
+        return tokens
+
+
+@lru_cache(maxsize=1)
+def tokenizer() -> Tokenizer:
+    return Tokenizer()
+
+
+def count_tokens(text: str) -> int:
+    return tokenizer().count(text)
+
+
+def count_message_tokens(messages: List[Dict[str, str]]) -> int:
+    """
+    Count the tokens a list of chat messages takes up in a call
+    """
+    return sum(TOKENS_PER_MESSAGE + count_tokens(message["content"]) for message in messages) + TOKENS_PER_REPLY
+
+
+class Prompt(NamedTuple):
+    """
+    The messages for one call, and what went into them
+    """
+    messages: List[Dict[str, str]]
+    tokens: int
+    budget: int
+    events: int
+    lines: int
+    omitted: int
+
+
+def _clock(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp, tz=TIMEZONE).strftime("%H:%M:%S")
+
+
+def _day(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp, tz=TIMEZONE).strftime("%a %b %d %Y")
+
+
+def _reading(event: SensorEvent) -> str:
+    """
+    Write an event's attribute briefly: 'OnOff=true' for {"OnOff": {"OnOff": true}}, 'occupied' for an occupancy of 1
+    """
+    readings = []
+    for name, key, value in event.readings():
+        if name == 'OccupancySensing' and key == 'Occupancy':
+            readings.append('occupied' if value else 'vacant')
+            continue
+        value = json.dumps(value) if isinstance(value, bool) else value
+        readings.append(f"{name}={value}" if name == key else f"{name}.{key}={value}")
+    return ' '.join(readings)
+
+
+def _is_occupancy(event: SensorEvent) -> bool:
+    return any(name == 'OccupancySensing' for name, _, _ in event.readings())
+
+
+def encode_events(events: List[SensorEvent]) -> List[str]:
+    """
+    Write events as one short line each, in the order given:
+    an event repeating the one right before it within REPEAT_SECONDS is dropped, and the occupancy changes in a room that follow
+    each other closely become a single line giving the first and last time, the count and the final state.
+    A line marks each change of day.
+    """
+    lines = []
+    previous: Optional[Tuple[Tuple, str, Optional[int]]] = None  # sensor, reading and timestamp of the event before
+    run: Optional[List[Any]] = None  # room, first timestamp, last timestamp, count, final reading
+    day = None
+
+    def flush():
+        if run is None:
+            return
+        room, first, last, count, reading = run
+        if count == 1:
+            lines.append(f"{_clock(first)} {room} {reading}")
+        else:
+            lines.append(f"{_clock(first)}-{_clock(last)} {room} occupancy changed {count} times, ends {reading}")
+
+    for event in events:
+        timestamp, room = event.timestamp, event.room
+        reading = _reading(event)
+        sensor = (room, event.node_id, event.endpoint_id, event.cluster or tuple(event.attribute))
+        repeat = previous is not None and previous[:2] == (sensor, reading) and (
+            timestamp is None or previous[2] is None or timestamp - previous[2] <= REPEAT_SECONDS)
+        previous = (sensor, reading, timestamp)
+        if repeat:
+            continue
+        if timestamp is None:
+            continue
+
+        if _day(timestamp) != day:
+            flush()
+            run = None
+            day = _day(timestamp)
+            lines.append(f"[{day}]")
+
+        if _is_occupancy(event):
+            if run is not None and run[0] == room and timestamp - run[2] <= OCCUPANCY_RUN_SECONDS:
+                run[2], run[3], run[4] = timestamp, run[3] + 1, reading
+                continue
+            flush()
+            run = [room, timestamp, timestamp, 1, reading]
+            continue
+
+        flush()
+        run = None
+        lines.append(f"{_clock(timestamp)} {room} {reading}")
+    flush()
+    return lines
+
+
+def fit_lines(lines: List[str], budget: int) -> Tuple[List[str], int]:
+    """
+    Keep as many lines as fit in the budget, taken alternately from the start and the end,
+    with a line saying how many were left out in between
+    :return: the lines kept, and the number left out
+    """
+    costs = [count_tokens(line) + 1 for line in lines]
+    if sum(costs) <= budget:
+        return lines, 0
+    budget -= count_tokens(f"... {len(lines)} lines left out ...") + 1
+    head, tail = 0, len(lines)
+    spent = 0
+    from_start = True
+    while head < tail:
+        index = head if from_start else tail - 1
+        if spent + costs[index] > budget:
+            break
+        spent += costs[index]
+        if from_start:
+            head += 1
+        else:
+            tail -= 1
+        from_start = not from_start
+    omitted = tail - head
+    return lines[:head] + [f"... {omitted} lines left out ..."] + lines[tail:], omitted
+
+
+def truncate(text: str, budget: int) -> str:
+    """
+    Cut text down to roughly the budget, at a word boundary
+    """
+    if count_tokens(text) <= budget:
+        return text
+    words = text.split()
+    low, high = 0, len(words)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(' '.join(words[:middle])) + 1 <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return ' '.join(words[:low]) + ' ...'
+
+
+def render_window(details: List[Any], budget: int, header: bool = True) -> Tuple[str, int, int]:
+    """
+    Write the events of a window compactly within a budget
+    :param details: the events, as SensorEvents or as they are stored
+    :param header: start with the exact first and last timestamps and the number of events
+    :return: the text, the number of lines it has, and the number of lines that were left out
+    """
+    events = load_events(details)
+    timestamps = [event.timestamp for event in events if event.timestamp is not None]
+    first = ""
+    if header and timestamps:
+        first = (f"Window from {min(timestamps)} ({_day(min(timestamps))} {_clock(min(timestamps))}) "
+                 f"to {max(timestamps)} ({_day(max(timestamps))} {_clock(max(timestamps))}), {len(events)} events:\n")
+    lines, omitted = fit_lines(encode_events(events), budget - count_tokens(first))
+    return first + '\n'.join(lines), len(lines), omitted
@@ -1,7 +1,120 @@
+import glob
+import gzip
 import os
 import json
+import re
 import shutil
 from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+from agents.json_store import GroupCommit, append_lines, atomic_write, investigation_id, lock_for, version_of
+
+# Rotated-out records are archived as gzipped JSON lines, one segment per rotation, named after
+# the file they came from and the time range they cover. The first line of a segment is a header
+# repeating that, so a segment still describes itself when renamed or moved.
+SEGMENT_NAME = re.compile(r"^archive_(?P<source>.+)_(?P<start>\d+)_(?P<end>\d+)(?:-\d+)?\.jsonl\.gz$")
+SEGMENT_VERSION = 1
+# A rotation writes one segment per week of records, so a read of a few days opens a segment or two
+SEGMENT_SECONDS = 7 * 24 * 60 * 60
+# Plain-text archives written before segments, which cover a time range their name does not give
+LEGACY_ARCHIVE = re.compile(r"^archive_\d{4}_\d{2}_\d{2}\.(?P<extension>jsonl|json)$")
+
+
+def record_timestamp(entry: Dict[str, Any]) -> Optional[int]:
+    """
+    The time of a record: an event's timestamp, or the start of an investigation's window
+    """
+    if 'situation' in entry:
+        return entry['situation'].get('start_timestamp')
+    return entry.get('timestamp')
+
+
+def record_key(entry: Any) -> str:
+    """
+    What identifies a record among the archives: an investigation's id, or an event's contents
+    """
+    if isinstance(entry, str):
+        entry = json.loads(entry)
+    if isinstance(entry, dict) and 'situation' in entry:
+        return entry.get('id') or investigation_id(entry)
+    return json.dumps(entry, sort_keys=True)
+
+
+class Segment(NamedTuple):
+    """
+    An archive file and the time range of its records; the range is None for a legacy archive
+    """
+    path: str
+    start: Optional[int]
+    end: Optional[int]
+
+    def overlaps(self, start: Optional[int], end: Optional[int]) -> bool:
+        if self.start is None:
+            return True
+        return (start is None or self.end >= start) and (end is None or self.start <= end)
+
+    def header(self) -> Dict[str, Any]:
+        """
+        Read the header of a segment, which only decompresses its first block
+        """
+        with gzip.open(self.path, 'rt') as file:
+            return json.loads(file.readline())
+
+    def records(self) -> Iterator[Dict[str, Any]]:
+        """
+        Yield the records of the archive as they are read
+        """
+        if self.path.endswith('.gz'):
+            with gzip.open(self.path, 'rt') as file:
+                file.readline()
+                for line in file:
+                    yield json.loads(line)
+            return
+        with open(self.path, 'r') as file:
+            if self.path.endswith('.jsonl'):
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    yield json.loads(entry) if isinstance(entry, str) else entry
+                return
+            # Legacy JSON archives hold one array per rotation, appended one after the other
+            contents = file.read()
+        decoder = json.JSONDecoder()
+        position = 0
+        while True:
+            while position < len(contents) and contents[position].isspace():
+                position += 1
+            if position == len(contents):
+                return
+            try:
+                array, position = decoder.raw_decode(contents, position)
+            except json.JSONDecodeError:
+                return
+            yield from array
+
+
+class _Changes:
+    """
+    The writes of one group commit: the records replacing the file, if any, and those appended after them
+    """
+    __slots__ = ('replace', 'appends')
+
+    def __init__(self):
+        self.replace: Optional[List[Dict[str, Any]]] = None
+        self.appends: List[Dict[str, Any]] = []
+
+    def overwrite(self, data: List[Dict[str, Any]]) -> None:
+        self.replace = list(data)
+        self.appends = []
+
+
+def _encode_details(data: List[Dict[str, Any]]) -> None:
+    for entry in data:
+        # Ensure details are written as JSON strings
+        if 'situation' in entry and 'details' in entry['situation']:
+            entry['situation']['details'] = [json.dumps(detail) if isinstance(detail, dict) else detail for detail in entry['situation']['details']]
+
 
 class RotatingJSONFile:
     def __init__(self, filename, retention_weeks=1, archive_dir=None, is_jsonl=True):
@@ -9,16 +122,22 @@ class RotatingJSONFile:
         self.retention_weeks = retention_weeks
         self.archive_dir = archive_dir or os.path.join(os.path.dirname(filename), "archives")
         self.is_jsonl = is_jsonl
+        # Held around every access, so other processes sharing the file never interleave with us
+        self.lock = lock_for(filename)
+        # Writes arriving together are rotated, written and fsynced once between them
+        self.commits = GroupCommit(filename, load=self._begin_commit, save=self._save)
         os.makedirs(self.archive_dir, exist_ok=True)
 
     def _rotate_file(self):
-        """Rotate the file if it contains data older than the retention period."""
+        """Rotate the file if it contains data older than the retention period. Call with self.lock held."""
         if not os.path.exists(self.filename):
             return
 
-        cutoff_date = datetime.now() - timedelta(weeks=self.retention_weeks)
+        cutoff_date = datetime.fromtimestamp(self.cutoff)
         new_data = []
         old_data = []
+        old_timestamps = []
+        old_keys = []
 
         with open(self.filename, 'r') as file:
             if self.is_jsonl:
@@ -30,6 +149,8 @@ class RotatingJSONFile:
                         timestamp = datetime.fromtimestamp(entry['timestamp'])
                         if timestamp < cutoff_date:
                             old_data.append(line)
+                            old_timestamps.append(entry['timestamp'])
+                            old_keys.append(record_key(entry))
                         else:
                             new_data.append(line)
                     except (json.JSONDecodeError, KeyError):
@@ -41,29 +162,149 @@ class RotatingJSONFile:
                         timestamp = datetime.fromtimestamp(entry['situation']['start_timestamp'])
                         if timestamp < cutoff_date:
                             old_data.append(entry)
+                            old_timestamps.append(entry['situation']['start_timestamp'])
+                            old_keys.append(record_key(entry))
                         else:
                             new_data.append(entry)
                 except json.JSONDecodeError:
                     pass
 
         if old_data:
-            extension = 'jsonl' if self.is_jsonl else 'json'
-            archive_filename = os.path.join(self.archive_dir, f"archive_{cutoff_date.strftime('%Y_%m_%d')}.{extension}")
-            with open(archive_filename, 'a') as archive_file:
+            # One record per line in either mode, so archives never hold arrays to be concatenated
+            lines = old_data if self.is_jsonl else [json.dumps(entry) + '\n' for entry in old_data]
+            weeks = {}
+            for line, timestamp, key in zip(lines, old_timestamps, old_keys):
+                week = weeks.setdefault(int(timestamp) // SEGMENT_SECONDS, ([], [], []))
+                week[0].append(line)
+                week[1].append(timestamp)
+                week[2].append(key)
+            for week in sorted(weeks):
+                week_lines, week_timestamps, week_keys = weeks[week]
+                # A record written back after it was rotated out (by a writer holding an old copy) is archived once
+                archived = self._archived_keys(int(min(week_timestamps)), int(max(week_timestamps)))
+                fresh = [index for index, key in enumerate(week_keys) if key not in archived]
+                if fresh:
+                    self._archive([week_lines[index] for index in fresh], [week_timestamps[index] for index in fresh])
+
+            def write_remaining(file):
                 if self.is_jsonl:
-                    archive_file.writelines(old_data)
+                    file.writelines(new_data)
                 else:
-                    json.dump(old_data, archive_file, indent=2)
+                    json.dump(new_data, file, indent=2)
 
-        with open(self.filename, 'w') as file:
-            if self.is_jsonl:
-                file.writelines(new_data)
-            else:
-                json.dump(new_data, file, indent=2)
+            # Only once the archives are on disk, and in one step, so a crash loses no records
+            atomic_write(self.filename, write_remaining)
+            self.lock.bump()
+
+    def _archived_keys(self, start: int, end: int) -> set:
+        """
+        The keys (see record_key) of the records the segments overlapping start to end hold
+        """
+        keys = set()
+        for segment in self.segments(start, end):
+            if segment.start is not None:
+                keys.update(record_key(entry) for entry in segment.records())
+        return keys
+
+    def _archive(self, lines: List[str], timestamps: List[int]) -> str:
+        """
+        Write rotated-out records to a new archive segment. Call with self.lock held.
+        :param lines: the records, as JSON lines
+        :param timestamps: the time of each record
+        :return: the path of the segment
+        """
+        start, end = int(min(timestamps)), int(max(timestamps))
+        header = {
+            "segment": SEGMENT_VERSION,
+            "source": os.path.basename(self.filename),
+            "start": start,
+            "end": end,
+            "count": len(lines),
+            "created_at": int(datetime.now().timestamp()),
+        }
+        base = os.path.join(self.archive_dir, f"archive_{self.source}_{start}_{end}")
+        path, copy = base + ".jsonl.gz", 1
+        while os.path.exists(path):
+            path, copy = f"{base}-{copy}.jsonl.gz", copy + 1
+
+        def write_segment(file):
+            with gzip.GzipFile(fileobj=file, mode='wb', mtime=0) as compressed:
+                compressed.write((json.dumps(header) + '\n').encode('utf-8'))
+                compressed.writelines(line.encode('utf-8') if line.endswith('\n') else (line + '\n').encode('utf-8')
+                                      for line in lines)
+
+        atomic_write(path, write_segment, mode='wb')
+        return path
+
+    @property
+    def source(self) -> str:
+        """
+        The name archive segments of this file are filed under
+        """
+        return os.path.splitext(os.path.basename(self.filename))[0]
+
+    def segments(self, start: Optional[int] = None, end: Optional[int] = None) -> List[Segment]:
+        """
+        List the archives of this file that may hold records between start and end, oldest first.
+        Segments are selected by the time range in their names, without being opened.
+        Legacy archives cannot be, and are always listed first; they are told apart by extension,
+        .jsonl for JSONL files and .json otherwise.
+        """
+        legacy, segments = [], []
+        for path in glob.glob(os.path.join(self.archive_dir, "archive_*")):
+            name = os.path.basename(path)
+            match = SEGMENT_NAME.match(name)
+            if match and match.group('source') == self.source:
+                segment = Segment(path, int(match.group('start')), int(match.group('end')))
+                if segment.overlaps(start, end):
+                    segments.append(segment)
+                continue
+            match = LEGACY_ARCHIVE.match(name)
+            if match and (match.group('extension') == 'jsonl') == self.is_jsonl:
+                legacy.append(Segment(path, None, None))
+        return sorted(legacy) + sorted(segments, key=lambda segment: (segment.start, segment.end, segment.path))
+
+    def read_archives(self, start: Optional[int] = None, end: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Stream the archived records between start and end, inclusive, one segment after another, oldest first.
+        Segments outside the range are skipped whole; records within a segment keep the order they were archived in.
+        """
+        for segment in self.segments(start, end):
+            for entry in segment.records():
+                timestamp = record_timestamp(entry) if isinstance(entry, dict) else None
+                if timestamp is None and (start is not None or end is not None):
+                    continue
+                if (start is None or timestamp >= start) and (end is None or timestamp <= end):
+                    yield entry
+
+    @property
+    def cutoff(self) -> float:
+        """
+        The time before which records are rotated out, as a unix timestamp
+        """
+        return (datetime.now() - timedelta(weeks=self.retention_weeks)).timestamp()
+
+    @property
+    def version(self):
+        """
+        A token that changes whenever the file does (see json_store.version_of)
+        """
+        return version_of(self.filename)
+
+    def rotate(self) -> None:
+        """
+        Archive the records older than the retention period. Every write does this first;
+        call it before reading a file that is only ever appended to from outside this class.
+        """
+        with self.lock:
+            self._rotate_file()
 
     def read(self):
-        """Read the entire file and return as a list of dicts."""
-        self._rotate_file()
+        """Read the entire file and return as a list of dicts. Readers share the lock, excluding only writers."""
+        with self.lock.shared():
+            return self._read()
+
+    def _read(self) -> List[Any]:
         data = []
         if os.path.exists(self.filename):
             with open(self.filename, 'r') as file:
@@ -74,45 +315,42 @@ class RotatingJSONFile:
                         except json.JSONDecodeError:
                             continue
                 else:
-                    try:
-                        data = json.load(file)
-                    except json.JSONDecodeError:
-                        pass
+                    contents = file.read()
+                    # Every write replaces the file whole, so anything unreadable was damaged outside of this class
+                    if contents.strip():
+                        data = json.loads(contents)
         return data
 
-    def write(self, data):
-        """Write a list of JSON-compatible dicts to the file."""
+    def _begin_commit(self) -> _Changes:
         self._rotate_file()
-        with open(self.filename, 'a') as file:
+        return _Changes()
+
+    def _save(self, changes: _Changes) -> None:
+        if changes.replace is None and not changes.appends:
+            return
+        if self.is_jsonl and changes.replace is None:
+            append_lines(self.filename, [json.dumps(entry) + '\n' for entry in changes.appends])
+            return
+        data = (self._read() if changes.replace is None else changes.replace) + changes.appends
+
+        def write_entries(file):
             if self.is_jsonl:
-                for entry in data:
-                    # Ensure details are written as JSON strings
-                    if 'situation' in entry and 'details' in entry['situation']:
-                        entry['situation']['details'] = [json.dumps(detail) if isinstance(detail, dict) else detail for detail in entry['situation']['details']]
-                    file.write(json.dumps(entry) + '\n')
+                file.writelines(json.dumps(entry) + '\n' for entry in data)
             else:
-                for entry in data:
-                    # Ensure details are written as JSON strings
-                    if 'situation' in entry and 'details' in entry['situation']:
-                        entry['situation']['details'] = [json.dumps(detail) if isinstance(detail, dict) else detail for detail in entry['situation']['details']]
-                json.dump(data, file)
+                json.dump(data, file, indent=2)
+
+        # Replace the file in one step so a concurrent reader never sees it half written
+        atomic_write(self.filename, write_entries)
+
+    def write(self, data):
+        """Append a list of JSON-compatible dicts to the file."""
+        _encode_details(data)
+        self.commits.commit(lambda changes: changes.appends.extend(data))
 
     def overwrite(self, data):
         """Overwrite the file with a new list of JSON-compatible dicts."""
-        self._rotate_file()
-        with open(self.filename, 'w') as file:
-            if self.is_jsonl:
-                for entry in data:
-                    # Ensure details are written as JSON strings
-                    if 'situation' in entry and 'details' in entry['situation']:
-                        entry['situation']['details'] = [json.dumps(detail) if isinstance(detail, dict) else detail for detail in entry['situation']['details']]
-                    file.write(json.dumps(entry) + '\n')
-            else:
-                for entry in data:
-                    # Ensure details are written as JSON strings
-                    if 'situation' in entry and 'details' in entry['situation']:
-                        entry['situation']['details'] = [json.dumps(detail) if isinstance(detail, dict) else detail for detail in entry['situation']['details']]
-                json.dump(data, file, indent=2)
+        _encode_details(data)
+        self.commits.commit(lambda changes: changes.overwrite(data))
 
     def __enter__(self):
         return self
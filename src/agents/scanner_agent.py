@@ -1,10 +1,9 @@
 import os
-import json
-import re
 from typing import Optional, List
-from openai import OpenAI
-from agents.situations import LoadedSituation, SituationSelection
+from agents.situations import LoadedSituation, Situation, SituationSelection, SituationSummary, SummarySelection
 from agents.agent import Agent
+from agents.llm import LLMClient, Priority, default_client
+from agents.prompt_builder import Prompt, SCANNER_PROMPT_TOKENS, count_message_tokens, count_tokens, render_window
 from datetime import datetime
 
 TIMEZONE = datetime.now().astimezone().tzinfo
@@ -21,7 +20,6 @@ For each 6-hour grouping, ensure the output includes:
     situation_description: A concise, neutral summary (4-5 sentences) of the events that took place during the hour. This description should detail the observed movement patterns and sensor events without implying any evaluation.
     result: A field that is either "normal" or "anomalous" based strictly on the log data. Do not embed this judgment in the narrative.
     start_timestamp and end_timestamp: The exact timestamps from the logs that mark the beginning and end of the 6-hour interval.
-    details: A list of the raw log entries that occurred during the interval. Each log entry should include the original details (e.g., {"timestamp": 1737900000, "room": "pillbox", "nodeId": 1, "onOff": true}) and be escaped appropriately for JSON formatting.
 
 Important rules:
 
@@ -39,8 +37,7 @@ The output format must strictly adhere to the following JSON structure:
       "situation_description": "Neutral narrative describing the events that occurred.",
       "result": "normal | anomalous",
       "start_timestamp": "exact log entry timestamp marking the start",
-      "end_timestamp": "exact log entry timestamp marking the end",
-      "details": "list of log entries that occurred in the interval"
+      "end_timestamp": "exact log entry timestamp marking the end"
     }
   ]
 }
@@ -50,6 +47,8 @@ The output format must strictly adhere to the following JSON structure:
     USER_PROMPT_PREFIX = """Analyze the following 6-hour block of log entries and create a neutral, human-readable scenario description of the events observed. 
 Your description should summarize the recorded movement patterns in 4-5 clear sentences without including any evaluative language regarding whether the movement is 
 typical or atypical. 
+Each window starts with its exact first and last timestamps. Its log entries follow one per line, as local time, room and reading:
+repeated readings are left out, and a run of occupancy changes in a room is written as one line.
 Here are the log entries:
 
 """
@@ -59,55 +58,18 @@ Here are the log entries:
     name = "Scanner Agent"
     color = Agent.CYAN
 
-    def __init__(self):
+    # Tokens a call may take up, system prompt included
+    PROMPT_TOKENS = SCANNER_PROMPT_TOKENS
+
+    def __init__(self, llm: Optional[LLMClient] = None):
         """
-        Set up this instance by initializing OpenAI
+        Set up this instance with the LLM client to call
+        :param llm: the client, by default the one LLM_BACKEND configures, shared with the other agents
         """
         self.log("Scanner Agent is initializing")
-        self.openai = OpenAI()
+        self.llm = llm or default_client()
         self.log("Scanner Agent is ready")
 
-    def add_human_readable_time(self, data):
-        """
-        This function performs the following steps:
-        
-        Adds a human readable time to the details field.
-        """
-        for situation in data:
-            for detail in situation.details:
-                # The LLM appears to get confused with timestamped data so lets add a human readable time
-                ts = detail["timestamp"]
-                # Convert timestamp to a datetime object in local timezone
-                dt = datetime.fromtimestamp(ts, tz=TIMEZONE)
-                # Format datetime to a human-readable string (e.g., "Sun Jan 26 2025 20:00:00")
-                detail["datetime"] = dt.strftime("%a %b %d %Y %H:%M:%S")
-
-
-    def transform_json(self, data):
-        """
-        This function performs the following steps:
-        
-        Iterates over each string in the details list.
-        Replaces single quotes with double quotes.
-        Replaces True/False with true/false.
-        Converts the modified string to a JSON object using json.loads.
-        Collects the valid JSON objects in a list.
-        Converts the list of JSON objects back to a JSON string using json.dumps.
-        """
-        details = data.details
-        valid_json_details = []
-    
-        for detail in details:
-            # Replace single quotes with double quotes
-            detail = detail.replace("'", '"')
-            # Replace True/False with true/false
-            detail = re.sub(r'\bTrue\b', 'true', detail)
-            detail = re.sub(r'\bFalse\b', 'false', detail)
-            valid_json_details.append(detail)
-
-        data.details = valid_json_details
-        return data
-    
     def fetch_situations(self, memory) -> List[LoadedSituation]:
         """
         Look up situations published in files
@@ -125,57 +87,94 @@ Here are the log entries:
         result = []
         for item in loaded:
             # Extract timestamps only once
-            timestamps = {entry['timestamp'] for entry in item.details if 'timestamp' in entry}
+            timestamps = {event.timestamp for event in item.details}
             
             # Add item if no matching timestamps are found
             if not timestamps.intersection(start_timestamps_set):
                 result.append(item)
 
-        self.log(f"Scanner Agent received {len(result)} situations not already loaded")
+        self.log("Scanner Agent received situations not already loaded", event="fetched", count=len(result))
         return result
 
-    def make_user_prompt(self, loaded) -> str:
+    def make_user_prompt(self, windows: List[str]) -> str:
         """
-        Create a user prompt for OpenAI based on the scraped deals provided
+        Create a user prompt for OpenAI from the windows, already written out
         """
-        user_prompt = self.USER_PROMPT_PREFIX
-        user_prompt += '\n\n'.join([situation.describe() for situation in loaded])
-        user_prompt += self.USER_PROMPT_SUFFIX
-        return user_prompt
+        return self.USER_PROMPT_PREFIX + '\n\n'.join(windows) + self.USER_PROMPT_SUFFIX
+
+    def make_prompt(self, loaded: List[LoadedSituation]) -> Prompt:
+        """
+        Create the messages for OpenAI, writing the windows compactly within the token budget.
+        The first window is always included, cut down in the middle if need be; later windows only if they fit whole.
+        """
+        budget = self.PROMPT_TOKENS - count_message_tokens([
+            {"role": "system", "content": self.SYSTEM_PROMPT},
+            {"role": "user", "content": self.make_user_prompt([])},
+        ])
+        windows, events, lines, omitted = [], 0, 0, 0
+        for situation in loaded:
+            text, window_lines, window_omitted = render_window(situation.details, budget)
+            tokens = count_tokens(text) + 1
+            if windows and (window_omitted or tokens > budget):
+                break
+            windows.append(text)
+            events += len(situation.details)
+            lines += window_lines
+            omitted += window_omitted
+            budget -= tokens
+
+        messages = [
+            {"role": "system", "content": self.SYSTEM_PROMPT},
+            {"role": "user", "content": self.make_user_prompt(windows)},
+        ]
+        return Prompt(messages, count_message_tokens(messages), self.PROMPT_TOKENS, events, lines, omitted)
+
+    def to_situation(self, summary: SituationSummary, loaded: List[LoadedSituation]) -> Situation:
+        """
+        The model only describes a window, so give its description the events and exact timestamps
+        of the window it describes: the one its start falls in
+        """
+        window = loaded[0]
+        for candidate in loaded:
+            timestamps = [event.timestamp for event in candidate.details]
+            if timestamps and min(timestamps) <= summary.start_timestamp <= max(timestamps):
+                window = candidate
+                break
+        timestamps = [event.timestamp for event in window.details]
+        return Situation(situation_description=summary.situation_description, result=summary.result,
+                         start_timestamp=min(timestamps, default=summary.start_timestamp),
+                         end_timestamp=max(timestamps, default=summary.end_timestamp),
+                         details=window.details)
 
     def scan(self, memory: List[str]=[]) -> Optional[SituationSelection]:
         """
-        Call OpenAI to provide a high potential list of situations with good descriptions and results
+        Call the LLM to provide a high potential list of situations with good descriptions and results
         Use StructuredOutputs to ensure it conforms to our specifications
         :param memory: a list of URLs representing deals already raised
         :return: a selection of good situations, or None if there aren't any
         """
-        loaded = self.fetch_situations(memory)
-
-        self.add_human_readable_time(loaded)
+        with self.timer("fetch"):
+            loaded = self.fetch_situations(memory)
+        return self.summarize(loaded)
 
+    def summarize(self, loaded: List[LoadedSituation]) -> Optional[SituationSelection]:
+        """
+        Call the LLM to describe and classify situations that have already been loaded
+        :param loaded: the situations to describe
+        :return: a selection of good situations, or None if there aren't any
+        """
         if loaded:
-            user_prompt = self.make_user_prompt(loaded)
-            self.log("Scanner Agent is calling OpenAI using Structured Output")
-            result = self.openai.beta.chat.completions.parse(
-                model=self.MODEL,
-                messages=[
-                    {"role": "system", "content": self.SYSTEM_PROMPT},
-                    {"role": "user", "content": user_prompt}
-                ],
-                seed=42,
-                response_format=SituationSelection
-            )
-
-            result = result.choices[0].message.parsed
-            result.situations = [situation for situation in result.situations if situation.result is not None]
-
-            # Transform the details field for each situation and update the list
-            # This may not be necessary but sometimes the returned details field are not transformed
-            for i, situation in enumerate(result.situations):
-                result.situations[i] = self.transform_json(situation)
-            
-            self.log(f"Scanner Agent received {len(result.situations)} selected situations with result not None from OpenAI")
+            prompt = self.make_prompt(loaded)
+            self.log("Scanner Agent is calling the LLM using Structured Output")
+            with self.timer("scan"):
+                result = self.llm.complete(prompt.messages, model=self.MODEL, response_format=SummarySelection,
+                                          priority=Priority.BACKLOG)
+            self.record_prompt(prompt, result)
+            self.count_llm_usage(result)
+
+            summaries = [summary for summary in result.parsed.situations if summary.result is not None]
+            result = SituationSelection(situations=[self.to_situation(summary, loaded) for summary in summaries])
+
+            self.log("Scanner Agent received selected situations with result not None from the LLM", event="scanned", count=len(result.situations))
             return result
         return None
-                
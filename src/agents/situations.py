@@ -1,10 +1,11 @@
-from pydantic import BaseModel
-from typing import List, Dict, Self
+from pydantic import BaseModel, InstanceOf, field_serializer, field_validator
+from typing import Any, List, Dict, Optional, Self
 import re
 from tqdm import tqdm
 import requests
 import time
 from agents.event_parser import EventParser
+from agents.events import SensorEvent, load_events
 
 files = [
 #    "data/daily_routine_data_new.json"
@@ -16,13 +17,13 @@ class LoadedSituation:
     """
     A class to represent a Situation retrieved from a file
     """
-    details: str
+    details: List[SensorEvent]
 
-    def __init__(self, entry: Dict[str, str]):
+    def __init__(self, entry: Dict[str, Any]):
         """
         Populate this instance based on the provided dict
         """
-        self.details = entry["details"]
+        self.details = load_events(entry["details"])
 
     def __repr__(self):
         """
@@ -35,7 +36,7 @@ class LoadedSituation:
         Return a longer string to describe this situation for use in calling a model
         """
 
-        return f"Details: {','.join(map(str, self.details)).strip()}\n"
+        return f"Details: {','.join(event.to_json() for event in self.details).strip()}\n"
 
     @classmethod
     def fetch(cls, show_progress : bool = False) -> List[Self]:
@@ -56,13 +57,39 @@ class LoadedSituation:
 
 class Situation(BaseModel):
     """
-    A class to Represent a Situation with a summary description
+    A class to Represent a Situation with a summary description.
+    The details are held as SensorEvents, and written as a list of JSON strings when the situation is stored.
     """
     situation_description: str
     result: str
     start_timestamp: int
     end_timestamp: int
-    details: List[str]
+    details: List[InstanceOf[SensorEvent]]
+
+    @field_validator('details', mode='before')
+    @classmethod
+    def load_details(cls, details):
+        return load_events(details)
+
+    @field_serializer('details')
+    def dump_details(self, details: List[SensorEvent]) -> List[str]:
+        return [event.to_json() for event in details]
+
+class SituationSummary(BaseModel):
+    """
+    A class to Represent what the Scanner Agent asks the model for: a Situation without its events,
+    which the scanner already has and attaches itself
+    """
+    situation_description: str
+    result: str
+    start_timestamp: int
+    end_timestamp: int
+
+class SummarySelection(BaseModel):
+    """
+    A class to Represent a list of SituationSummaries
+    """
+    situations: List[SituationSummary]
 
 class SituationSelection(BaseModel):
     """
@@ -77,3 +104,7 @@ class Investigation(BaseModel):
     """
     situation: Situation
     estimate: str
+    home: Optional[str] = None
+    id: Optional[str] = None
+    # When a person last confirmed or corrected the estimate, as a unix timestamp
+    reviewed_at: Optional[int] = None
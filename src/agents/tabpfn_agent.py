@@ -6,10 +6,25 @@ import pandas as pd
 import numpy as np
 import json
 from typing import List
-from sentence_transformers import SentenceTransformer
 import joblib
 from agents.agent import Agent
 from agents.situations import Situation
+from agents.features import prepare_features, prepare_tabular_data
+from agents.model_registry import ModelRegistry
+
+MODEL_NAME = 'tabpfn'
+# Loaded while no version has been published to the registry
+LEGACY_FILE = 'tabpfn_model.pkl'
+
+
+def predict_proba(artifact, situations) -> np.ndarray:
+    """
+    Return the probability that each situation is anomalous, featurizing and predicting them as one batch
+    :param artifact: the (model, feature names) the registry holds
+    """
+    model, feature_names = artifact
+    X = prepare_tabular_data(situations, feature_names)
+    return model.predict_proba(X)[:, list(model.classes_).index(1)]
 
 
 class TabPFNAgent(Agent):
@@ -24,98 +39,32 @@ class TabPFNAgent(Agent):
         """
         super().__init__()  # Important: call parent class __init__
         self.log("TabPFN is initializing")
-        model_path = self.load_data_file('tabpfn_model.pkl')
-        (self.model, self.feature_names) = joblib.load(model_path)
+        self.registry = ModelRegistry(self.data_dir)
+        # Newly published versions are loaded and swapped in by a background thread
+        self.models = self.registry.watch(MODEL_NAME, legacy_file=LEGACY_FILE, on_swap=self.on_model_swap)
         self.log("TabPFN is ready")
 
+    def on_model_swap(self, version: int):
+        self.log("TabPFN Agent switched model version", event="model_swap", version=version)
+
+    @property
+    def model_version(self) -> int:
+        return self.models.version
+
     def prepare_features(self, data):
         """Convert the raw sensor data into meaningful features dynamically."""
-        features = {}
-        
-        # Load events from data.details (which could be a JSON string, list of JSON strings, or list of dicts)
-        if isinstance(data.details, str):
-            events = json.loads(data.details)
-        elif isinstance(data.details, list) and all(isinstance(item, str) for item in data.details):
-            events = [json.loads(event) for event in data.details]
-        else:  
-            events = data.details
-
-        # Dynamic room counts: count visits for every room seen in the events
-        room_counts = {}
-        for event in events:
-            room = event.get('room')
-            if room is not None:
-                room_counts[room] = room_counts.get(room, 0) + 1
-        # Add dynamic room count features (keys will be like 'room_kitchen_visits', etc.)
-        for room, count in room_counts.items():
-            features[f'room_{room}_visits'] = count
-
-        # Timestamp based features:
-        # Calculate average and maximum time between consecutive events
-        timestamps = [event.get('timestamp') for event in events if 'timestamp' in event]
-        if len(timestamps) > 1:
-            diffs = np.diff(timestamps)
-            features['avg_time_between_events'] = float(np.mean(diffs))
-            features['max_time_between_events'] = float(np.max(diffs))
-        else:
-            features['avg_time_between_events'] = 0.0
-            features['max_time_between_events'] = 0.0
-        
-        # Count rapid transitions (events less than 2 minutes apart)
-        rapid_transitions = 0
-        for i in range(len(timestamps) - 1):
-            if timestamps[i+1] - timestamps[i] < 120:
-                rapid_transitions += 1
-        features['rapid_transitions'] = rapid_transitions
-
-        # Attribute features:
-        # For each attribute present, create a feature (e.g., "TemperatureMeasurement_MeasuredValue")
-        # and aggregate by taking the average value for that attribute over the period.
-        attr_values = {}  # key: feature name, value: list of measurements
-        for event in events:
-            attr = event.get('attribute', {})
-            # Each event's attribute is assumed to be a dict with a single key
-            for attr_name, inner in attr.items():
-                # inner is a dict (e.g., {"MeasuredValue": 1901} or {"Occupancy": 1})
-                for inner_key, value in inner.items():
-                    feature_key = f"{attr_name}_{inner_key}"
-                    try:
-                        numeric_value = float(value)
-                    except (ValueError, TypeError):
-                        continue
-                    if feature_key not in attr_values:
-                        attr_values[feature_key] = []
-                    attr_values[feature_key].append(numeric_value)
-        
-        # Compute the average for each attribute feature if available
-        for key, values in attr_values.items():
-            features[key] = float(np.mean(values))
-        
-        return features
+        return prepare_features(data)
 
     def prepare_tabular_data(self, data, feature_names=None):
         """Convert a list of JSON entries into a Pandas DataFrame with engineered features."""
-        flattened_data = []
-        for entry in data:
-            features = self.prepare_features(entry)
-            features['result'] = entry.result
-            flattened_data.append(features)
-        
-        df = pd.DataFrame(flattened_data)
-        df = df.fillna('missing')  # Handle missing values
-        
-        if feature_names:
-            missing_features = {feature: 'missing' for feature in feature_names if feature not in df.columns}
-            df = pd.concat([df, pd.DataFrame(missing_features, index=df.index)], axis=1)
-            df = df[feature_names]
-        
-        return df.astype(str)  # Ensure all data is of string type
+        return prepare_tabular_data(data, feature_names)
 
 
     # Function to predict result for a new datapoint
     def predict_anomaly(self, model, new_data, feature_names):
         """Predict if a new datapoint is anomalous using TabPFN."""
-        df = self.prepare_tabular_data([new_data], feature_names)
+        with self.timer("featurize", model=MODEL_NAME):
+            df = self.prepare_tabular_data([new_data], feature_names)
         X = df.drop(columns=['result'], errors='ignore')
 
         # Ensure no NaN values are present
@@ -141,8 +90,9 @@ class TabPFNAgent(Agent):
         :return: the estimate
         """        
         self.log("TabPFN Agent is starting a prediction")
-        result = self.predict_anomaly(self.model, situation, self.feature_names)
-        self.log(f"TabPFN Agent completed - prediction is_anomalous:{result['is_anomalous']}")
+        (model, feature_names) = self.models.artifact
+        result = self.predict_anomaly(model, situation, feature_names)
+        self.log("TabPFN Agent completed", event="prediction", is_anomalous=result['is_anomalous'], confidence=result['confidence'])
         if result['is_anomalous']:
             return 'anomalous'
         else:
@@ -0,0 +1,470 @@
+"""
+Nearest-neighbour search over unit vectors for similar-situation retrieval. Vectors can be added and
+deleted one at a time, filtered by home and label, and saved to a single .npz file.
+
+VECTOR_INDEX chooses the search structure:
+    flat  scores every vector: exact, and fast enough up to some tens of thousands
+    ivf   (default) an inverted file in pure NumPy: vectors are bucketed under k-means centroids, and a
+          query only scores the buckets of its nearest centroids. It searches flat until IVF_MIN_VECTORS.
+    hnsw  an hnswlib graph, if hnswlib is installed
+"""
+
+import importlib.util
+import json
+import logging
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from agents.json_store import DEFAULT_HOME, atomic_write, investigation_id, lock_for, version_of
+
+INDEX_KIND = os.getenv('VECTOR_INDEX', 'ivf')
+
+# The IVF index is trained once it holds this many vectors, and retrained each time it doubles
+IVF_MIN_VECTORS = int(os.getenv('IVF_MIN_VECTORS', '10000'))
+IVF_MAX_LISTS = 1024
+# Buckets a query scores; more is slower and closer to exact
+IVF_PROBES = int(os.getenv('IVF_PROBES', '8'))
+KMEANS_ITERATIONS = 8
+KMEANS_SAMPLES_PER_LIST = 32
+
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF = int(os.getenv('HNSW_EF', '64'))
+
+# Deleted rows are dropped from the arrays once they are this share of them
+COMPACT_FRACTION = 0.25
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class VectorIndex:
+    """
+    Exact search by cosine similarity, and the storage every index shares: vectors in one growing array,
+    with the id, home and label of each row. A deleted row is only marked dead until the next compaction.
+    Subclasses narrow down the rows a query scores by overriding _candidates.
+    """
+
+    kind = "flat"
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.size = 0
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.alive = np.zeros(0, dtype=bool)
+        self.homes = np.zeros(0, dtype=np.int32)
+        self.labels = np.zeros(0, dtype=np.int32)
+        self.ids: List[Optional[str]] = []
+        self.rows: Dict[str, int] = {}
+        # Homes and labels are stored as codes into this list of names
+        self.names: List[str] = []
+        self.codes: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, id: str) -> bool:
+        return id in self.rows
+
+    def _code(self, name: str) -> int:
+        if name not in self.codes:
+            self.codes[name] = len(self.names)
+            self.names.append(name)
+        return self.codes[name]
+
+    def _reserve(self, count: int) -> None:
+        needed = self.size + count
+        if needed <= len(self.alive):
+            return
+        capacity = max(needed, 2 * len(self.alive), 64)
+        vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+        vectors[:self.size] = self.vectors[:self.size]
+        self.vectors = vectors
+        for name in ('alive', 'homes', 'labels'):
+            array = getattr(self, name)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            setattr(self, name, grown)
+
+    def add(self, ids: List[str], vectors: np.ndarray, homes: List[str], labels: List[str]) -> None:
+        """
+        Add vectors, replacing any already held under the same ids
+        """
+        self.remove([id for id in ids if id in self.rows])
+        vectors = normalize(vectors).reshape(len(ids), self.dim)
+        self._reserve(len(ids))
+        rows = np.arange(self.size, self.size + len(ids))
+        self.vectors[rows] = vectors
+        self.alive[rows] = True
+        self.homes[rows] = [self._code(home or DEFAULT_HOME) for home in homes]
+        self.labels[rows] = [self._code(label) for label in labels]
+        for id, row in zip(ids, rows):
+            self.ids.append(id)
+            self.rows[id] = int(row)
+        self.size += len(ids)
+        self._inserted(rows)
+
+    def remove(self, ids: List[str]) -> None:
+        rows = [self.rows.pop(id) for id in ids if id in self.rows]
+        if not rows:
+            return
+        self.alive[rows] = False
+        for row in rows:
+            self.ids[row] = None
+        self._deleted(rows)
+        if self.size - len(self.rows) > COMPACT_FRACTION * self.size:
+            self.compact()
+
+    def set_label(self, id: str, label: str) -> None:
+        self.labels[self.rows[id]] = self._code(label)
+
+    def label_of(self, id: str) -> str:
+        return self.names[self.labels[self.rows[id]]]
+
+    def compact(self) -> None:
+        """
+        Drop the deleted rows from the arrays
+        """
+        keep = np.flatnonzero(self.alive[:self.size])
+        self.vectors = self.vectors[keep]
+        self.alive = self.alive[keep]
+        self.homes = self.homes[keep]
+        self.labels = self.labels[keep]
+        self.ids = [self.ids[row] for row in keep]
+        self.rows = {id: row for row, id in enumerate(self.ids)}
+        self.size = len(keep)
+        self._reindexed()
+
+    def _mask(self, home: Optional[str], label: Optional[str]) -> Optional[np.ndarray]:
+        mask = self.alive[:self.size].copy()
+        for name, codes in ((home, self.homes), (label, self.labels)):
+            if name is not None:
+                if name not in self.codes:
+                    return None
+                mask &= codes[:self.size] == self.codes[name]
+        return mask
+
+    def search(self, query: np.ndarray, k: int = 5, home: Optional[str] = None,
+               label: Optional[str] = None) -> List[Tuple[str, float]]:
+        """
+        Find the vectors most similar to the query
+        :param home: only consider vectors of this home
+        :param label: only consider vectors with this label
+        :return: up to k (id, cosine similarity) pairs, most similar first
+        """
+        mask = self._mask(home, label)
+        if mask is None or not self.rows:
+            return []
+        query = normalize(query).reshape(self.dim)
+        rows = self._candidates(query, k, mask)
+        if rows is None:
+            # Scoring every row at once is cheaper than gathering the ones the mask allows first
+            rows = np.flatnonzero(mask)
+            similarities = (self.vectors[:self.size] @ query)[rows]
+        else:
+            rows = rows[mask[rows]]
+            similarities = self.vectors[rows] @ query
+        if len(rows) == 0:
+            return []
+        k = min(k, len(rows))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return [(self.ids[rows[i]], float(similarities[i])) for i in top]
+
+    def _candidates(self, query: np.ndarray, k: int, mask: np.ndarray) -> Optional[np.ndarray]:
+        """
+        The rows worth scoring exactly, or None to score every row the mask allows
+        """
+        return None
+
+    def _inserted(self, rows: np.ndarray) -> None:
+        pass
+
+    def _deleted(self, rows: List[int]) -> None:
+        pass
+
+    def _reindexed(self) -> None:
+        """
+        Called after the rows were renumbered, by compaction or loading
+        """
+
+    def _state(self) -> Dict[str, np.ndarray]:
+        return {}
+
+    def _restore(self, state) -> None:
+        self._reindexed()
+
+    def save(self, path: str) -> None:
+        """
+        Save the index to an .npz file, replacing it atomically
+        """
+        if self.size != len(self.rows):
+            self.compact()
+        arrays = {
+            "kind": np.array(self.kind),
+            "vectors": self.vectors[:self.size],
+            "ids": np.array(self.ids, dtype=str),
+            "homes": self.homes[:self.size],
+            "labels": self.labels[:self.size],
+            "names": np.array(self.names, dtype=str),
+            **self._state(),
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        atomic_write(path, lambda file: np.savez(file, **arrays), mode='wb')
+
+    @classmethod
+    def load(cls, path: str) -> 'VectorIndex':
+        """
+        Load an index saved by save(); it is searched the way it was saved unless that needs a missing library
+        """
+        with np.load(path, allow_pickle=False) as state:
+            vectors = state["vectors"]
+            index = make_index(vectors.shape[1], str(state["kind"]))
+            index.vectors = vectors.copy()
+            index.size = len(vectors)
+            index.alive = np.ones(index.size, dtype=bool)
+            index.homes = state["homes"].copy()
+            index.labels = state["labels"].copy()
+            index.ids = [str(id) for id in state["ids"]]
+            index.rows = {id: row for row, id in enumerate(index.ids)}
+            index.names = [str(name) for name in state["names"]]
+            index.codes = {name: code for code, name in enumerate(index.names)}
+            index._restore(state)
+        return index
+
+
+class IVFIndex(VectorIndex):
+    """
+    An inverted file: spherical k-means centroids, and the rows nearest each. A query scores the rows
+    of its IVF_PROBES nearest centroids, probing further while the filters leave fewer than k.
+    """
+
+    kind = "ivf"
+
+    def __init__(self, dim: int):
+        super().__init__(dim)
+        self.centroids: Optional[np.ndarray] = None
+        self.lists: List[List[int]] = []
+        self._arrays: Dict[int, np.ndarray] = {}
+        self.trained_size = 0
+
+    def train(self) -> None:
+        """
+        Fit the centroids to the current vectors and bucket every row under its nearest
+        """
+        live = self.vectors[np.flatnonzero(self.alive[:self.size])]
+        lists = min(IVF_MAX_LISTS, max(1, int(4 * np.sqrt(len(live)))))
+        rng = np.random.default_rng(42)
+        sample = live[rng.choice(len(live), min(len(live), lists * KMEANS_SAMPLES_PER_LIST), replace=False)]
+        centroids = sample[rng.choice(len(sample), lists, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            nearest = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, nearest, sample)
+            empty = np.bincount(nearest, minlength=lists) == 0
+            sums[empty] = centroids[empty]
+            centroids = normalize(sums)
+        self.centroids = centroids
+        self.trained_size = len(live)
+        self._assign_all()
+
+    def _assign(self, rows: np.ndarray) -> np.ndarray:
+        assignments = np.empty(len(rows), dtype=np.int32)
+        for start in range(0, len(rows), 65536):
+            chunk = rows[start:start + 65536]
+            assignments[start:start + len(chunk)] = np.argmax(self.vectors[chunk] @ self.centroids.T, axis=1)
+        return assignments
+
+    def _assign_all(self) -> None:
+        rows = np.flatnonzero(self.alive[:self.size])
+        self.lists = [[] for _ in range(len(self.centroids))]
+        for row, bucket in zip(rows.tolist(), self._assign(rows).tolist()):
+            self.lists[bucket].append(row)
+        self._arrays = {}
+
+    def _inserted(self, rows):
+        live = len(self.rows)
+        if self.centroids is None:
+            if live >= IVF_MIN_VECTORS:
+                self.train()
+            return
+        if live >= 2 * self.trained_size:
+            self.train()
+            return
+        for row, bucket in zip(rows.tolist(), self._assign(rows).tolist()):
+            self.lists[bucket].append(row)
+            self._arrays.pop(bucket, None)
+
+    def _reindexed(self):
+        if self.centroids is not None:
+            self._assign_all()
+
+    def _list(self, bucket: int) -> np.ndarray:
+        array = self._arrays.get(bucket)
+        if array is None:
+            array = self._arrays[bucket] = np.array(self.lists[bucket], dtype=np.int64)
+        return array
+
+    def _candidates(self, query, k, mask):
+        if self.centroids is None:
+            return None
+        order = np.argsort(-(self.centroids @ query))
+        probes = min(IVF_PROBES, len(order))
+        while True:
+            rows = np.concatenate([self._list(bucket) for bucket in order[:probes]])
+            if probes >= len(order) or np.count_nonzero(mask[rows]) >= k:
+                return rows
+            probes *= 2
+
+    def _state(self):
+        if self.centroids is None:
+            return {}
+        return {"centroids": self.centroids, "trained_size": np.array(self.trained_size)}
+
+    def _restore(self, state):
+        if "centroids" in state:
+            self.centroids = state["centroids"].copy()
+            self.trained_size = int(state["trained_size"])
+            self._assign_all()
+
+
+class HNSWIndex(VectorIndex):
+    """
+    Searches an hnswlib graph over the rows, then rescores its candidates exactly.
+    The graph is rebuilt from the vectors when the index is loaded or compacted.
+    """
+
+    kind = "hnsw"
+
+    def __init__(self, dim: int):
+        super().__init__(dim)
+        self._new_graph(1024)
+
+    def _new_graph(self, capacity: int) -> None:
+        import hnswlib
+
+        self.graph = hnswlib.Index(space='ip', dim=self.dim)
+        self.graph.init_index(max_elements=capacity, ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M)
+        self.graph.set_ef(HNSW_EF)
+
+    def _inserted(self, rows):
+        needed = self.size
+        if needed > self.graph.get_max_elements():
+            self.graph.resize_index(max(needed, 2 * self.graph.get_max_elements()))
+        self.graph.add_items(self.vectors[rows], rows)
+
+    def _deleted(self, rows):
+        for row in rows:
+            self.graph.mark_deleted(row)
+
+    def _reindexed(self):
+        self._new_graph(max(1024, self.size))
+        rows = np.flatnonzero(self.alive[:self.size])
+        if len(rows):
+            self.graph.add_items(self.vectors[rows], rows)
+
+    def _candidates(self, query, k, mask):
+        allowed = int(np.count_nonzero(mask))
+        if allowed == 0:
+            return np.zeros(0, dtype=np.int64)
+        try:
+            rows, _ = self.graph.knn_query(query, k=min(k, allowed), filter=lambda row: bool(mask[row]))
+        except RuntimeError:
+            # The graph could not find k rows passing the filter; score them all instead
+            return None
+        return rows[0].astype(np.int64)
+
+
+KINDS = {"flat": VectorIndex, "ivf": IVFIndex, "hnsw": HNSWIndex}
+
+
+def make_index(dim: int, kind: Optional[str] = None) -> VectorIndex:
+    """
+    Create an empty index of the kind VECTOR_INDEX names, falling back to IVF when hnswlib is not installed
+    :raises ValueError: if there is no such kind
+    """
+    kind = kind or INDEX_KIND
+    if kind not in KINDS:
+        raise ValueError(f"Unknown vector index '{kind}', expected one of {', '.join(KINDS)}")
+    if kind == "hnsw" and importlib.util.find_spec('hnswlib') is None:
+        logging.warning("hnswlib is not installed, using the IVF vector index instead")
+        kind = "ivf"
+    return KINDS[kind](dim)
+
+
+class SituationIndex:
+    """
+    An index of the investigations in the memory file, kept in step with it: records that appear are
+    embedded and added, relabelled ones re-tagged, and ones rotated out of the file deleted. The index is
+    saved after each change, so a restart only embeds what changed since.
+    """
+
+    def __init__(self, path: str, embed: Callable[[List[dict]], np.ndarray], dim: int):
+        """
+        :param path: where the index is saved
+        :param embed: returns a vector for each of a list of investigation records
+        :param dim: the length of those vectors
+        """
+        self.path = path
+        self.embed = embed
+        self.index = self._load(dim)
+        self.records: Dict[str, dict] = {}
+        self._stamp = None
+
+    def _load(self, dim: int) -> VectorIndex:
+        if os.path.exists(self.path):
+            try:
+                index = VectorIndex.load(self.path)
+                if index.dim == dim:
+                    return index
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Rebuilding the vector index at {self.path}: {e}")
+        return make_index(dim)
+
+    def sync(self, memory_path: str) -> None:
+        """
+        Bring the index up to date with the memory file, if it changed since the last call
+        """
+        if version_of(memory_path) == self._stamp:
+            return
+        data = []
+        with lock_for(memory_path).shared():
+            stamp = version_of(memory_path)
+            if stamp is not None:
+                with open(memory_path, 'r') as file:
+                    contents = file.read()
+                data = json.loads(contents) if contents.strip() else []
+        self.records = {record.get('id') or investigation_id(record): record for record in data}
+
+        changed = False
+        gone = [id for id in list(self.index.rows) if id not in self.records]
+        if gone:
+            self.index.remove(gone)
+            changed = True
+        new = []
+        for id, record in self.records.items():
+            if id not in self.index:
+                new.append(id)
+            elif self.index.label_of(id) != record['estimate']:
+                self.index.set_label(id, record['estimate'])
+                changed = True
+        if new:
+            records = [self.records[id] for id in new]
+            self.index.add(new, self.embed(records), [record.get('home') for record in records],
+                           [record['estimate'] for record in records])
+            changed = True
+        if changed:
+            self.index.save(self.path)
+        self._stamp = stamp
+
+    def search(self, vector: np.ndarray, k: int = 5, home: Optional[str] = None,
+               label: Optional[str] = None) -> List[dict]:
+        """
+        Return the records of the k most similar investigations, most similar first
+        """
+        return [self.records[id] for id, _ in self.index.search(vector, k, home=home, label=label)]
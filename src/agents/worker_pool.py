@@ -0,0 +1,151 @@
+"""
+A pool of worker processes for the CPU-bound part of estimating windows: extracting features and
+predicting with the Random Forest and TabPFN models. Each worker loads the models once, memory-mapped
+from the registry so the workers share their pages, and follows newly published versions. Windows are
+sent in batches, and each batch is featurized and predicted in one call per model. The GIL of the
+process serving the UI is then never held by this work, and throughput grows with the cores.
+
+WORKER_PROCESSES sets the number of workers; with 0, the default, the ensemble predicts in-process.
+"""
+
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence
+
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', '0'))
+# Windows per task: large enough to amortize the round trip, small enough to spread a batch over the workers
+WORKER_BATCH_SIZE = int(os.getenv('WORKER_BATCH_SIZE', '32'))
+
+MODEL_NAMES = ('random_forest', 'tabpfn')
+
+
+class Prediction(NamedTuple):
+    """
+    What one model predicted for one window
+    """
+    model: str
+    version: int
+    label: str
+    # The probability that the window is anomalous
+    probability: float
+
+    @property
+    def confidence(self) -> float:
+        """
+        The probability of the predicted label
+        """
+        return self.probability if self.label == 'anomalous' else 1 - self.probability
+
+
+class Window(NamedTuple):
+    """
+    The part of a situation the models look at, which is all that is sent to a worker
+    """
+    details: List[Any]
+    result: Optional[str] = None
+
+
+# The state of a worker process: the watcher and prediction function of each model it loaded
+_models: Dict[str, Any] = {}
+
+
+def _model_modules():
+    from agents import random_forest_agent, tabpfn_agent
+
+    return {module.MODEL_NAME: module for module in (random_forest_agent, tabpfn_agent)}
+
+
+def _single_threaded(artifact) -> None:
+    # A model trained to use every core would compete with the other workers for them
+    for part in artifact if isinstance(artifact, tuple) else (artifact,):
+        if hasattr(part, 'n_jobs'):
+            part.n_jobs = 1
+
+
+def init_worker(data_dir: str, names: Sequence[str] = MODEL_NAMES) -> None:
+    """
+    Load the models into this process. Models that were never trained are skipped.
+    """
+    from threadpoolctl import threadpool_limits
+
+    from agents.model_registry import ModelRegistry, ModelWatcher
+
+    # The workers already use every core between them, so each keeps its numeric libraries to one thread
+    threadpool_limits(1)
+    registry = ModelRegistry(data_dir)
+    modules = _model_modules()
+    _models.clear()
+    for name in names:
+        module = modules[name]
+        try:
+            watcher = ModelWatcher(registry, name, module.LEGACY_FILE,
+                                   on_swap=lambda version, name=name: _single_threaded(_models[name][0].artifact))
+        except FileNotFoundError as e:
+            logging.warning(f"Worker {os.getpid()} has no model '{name}': {e}")
+            continue
+        _single_threaded(watcher.artifact)
+        _models[name] = (watcher, module.predict_proba)
+
+
+def predict_batch(windows: List[Window]) -> List[Dict[str, Prediction]]:
+    """
+    Predict a batch of windows with every model this process loaded
+    :return: for each window, the prediction of each model
+    """
+    results: List[Dict[str, Prediction]] = [{} for _ in windows]
+    for name, (watcher, predict_proba) in _models.items():
+        # Between batches, rather than on a thread, so a batch is predicted by one version throughout
+        watcher.check()
+        artifact, version = watcher.current()
+        for result, probability in zip(results, predict_proba(artifact, windows)):
+            result[name] = Prediction(name, version, 'anomalous' if probability >= 0.5 else 'normal', float(probability))
+    return results
+
+
+class WorkerPool:
+    """
+    Sends batches of windows to worker processes and collects their predictions in order
+    """
+
+    def __init__(self, data_dir: str, processes: int = WORKER_PROCESSES or (os.cpu_count() or 1),
+                 names: Sequence[str] = MODEL_NAMES, batch_size: int = WORKER_BATCH_SIZE):
+        """
+        :param data_dir: the data directory holding the model registry
+        :param processes: the number of workers, by default WORKER_PROCESSES or one per core
+        :param names: the models to load
+        :param batch_size: the most windows sent to a worker at once
+        """
+        self.processes = processes
+        self.batch_size = batch_size
+        # Spawned rather than forked: the parent runs threads (the UI, model watchers) that a fork would copy mid-flight
+        self.executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=init_worker, initargs=(data_dir, tuple(names)))
+
+    def submit(self, situations) -> Future:
+        """
+        Send one batch of situations (or anything with their details) to a worker
+        :return: a future of the predictions, as predict_batch returns them
+        """
+        return self.executor.submit(predict_batch, [Window(list(situation.details)) for situation in situations])
+
+    def predict(self, situations) -> List[Dict[str, Prediction]]:
+        """
+        Predict every situation, spread over the workers in batches
+        :return: for each situation, in order, the prediction of each model
+        """
+        situations = list(situations)
+        # Small enough that every worker gets a share
+        size = max(1, min(self.batch_size, -(-len(situations) // self.processes)))
+        futures = [self.submit(situations[start:start + size]) for start in range(0, len(situations), size)]
+        return [result for future in futures for result in future.result()]
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self) -> 'WorkerPool':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
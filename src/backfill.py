@@ -0,0 +1,297 @@
+"""
+Replay the archived and live sensor data through the pipeline, for example after a model update:
+stream the events of every file in time order, window them as the event parser does, describe each
+window, predict with the tabular models on every core, vote as the ensemble does, and write the
+investigations to the memory file a batch at a time. Investigations already in the memory file are
+re-estimated, unless a person reviewed them.
+
+By default no LLM is called: windows are described by the offline stub client, and the vote is the
+Random Forest's and TabPFN's. With --llm, the scanner and the Frontier agent call the LLM through a
+scheduler of their own, limited to --rpm and --tpm so the backfill leaves the live agents their share.
+
+Progress is saved after every batch, so an interrupted backfill resumes where it stopped. The agents may
+keep running meanwhile: each save merges with what they saved to the memory file since (see InvestigationStore.save).
+
+    python backfill.py
+    python backfill.py --events /tmp/daily_routine_data.json --llm --rpm 60
+    python backfill.py --restart      # ignore the checkpoint and replay everything
+"""
+
+import argparse
+import heapq
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+from dotenv import load_dotenv
+
+from agents.ensemble_agent import vote
+from agents.event_parser import window_events
+from agents.events import SensorEvent
+from agents.investigation_store import InvestigationStore
+from agents.json_store import DEFAULT_HOME, atomic_write, investigation_id
+from agents.llm import StubClient, make_client
+from agents.llm_scheduler import LLMScheduler
+from agents.rotating_json_file import RotatingJSONFile
+from agents.scanner_agent import ScannerAgent
+from agents.situations import Investigation, LoadedSituation, Situation
+from agents.worker_pool import WorkerPool
+from log_utils import make_formatter
+
+# Colors for logging
+BG_MAGENTA = '\033[45m'
+WHITE = '\033[37m'
+
+ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EVENTS_FILE = 'daily_routine_data.json'
+MEMORY_FILE = 'memory.json'
+CHECKPOINT_FILE = 'backfill_checkpoint.json'
+
+# Windows described, predicted and written together
+BATCH_SIZE = 256
+# The memory file keeps a year of investigations, as in the agent framework
+RETENTION_WEEKS = 52
+
+
+def log(message: str, event: Optional[str] = None, **fields):
+    logging.info(message, extra={"agent": "Backfill", "color": BG_MAGENTA + WHITE, "event": event, "fields": fields})
+
+
+class Source(NamedTuple):
+    """
+    A file of events, live or archived, and the time range it covers
+    """
+    name: str
+    start: Optional[int]
+    end: Optional[int]
+    read: Callable[[], Iterable[Dict[str, Any]]]
+
+
+def read_lines(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Read the records of a JSON lines file as they are, without rotating it; lines that are not JSON are skipped
+    """
+    with open(path, 'r') as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+                yield json.loads(entry) if isinstance(entry, str) else entry
+            except json.JSONDecodeError:
+                continue
+
+
+def to_events(records: Iterable[Dict[str, Any]], start: Optional[int] = None) -> Iterator[SensorEvent]:
+    for entry in records:
+        if isinstance(entry, dict) and isinstance(entry.get('timestamp'), (int, float)) and \
+                (start is None or entry['timestamp'] >= start):
+            yield SensorEvent.from_dict(entry)
+
+
+def event_sources(events_file: str, start: Optional[int] = None) -> List[Source]:
+    """
+    The live events file and the archive segments its rotation wrote, leaving out those that end before start.
+    A segment's range comes from its name; only the live file and legacy archives are read to find theirs.
+    """
+    file = RotatingJSONFile(events_file, is_jsonl=True)
+    sources = []
+    for segment in file.segments(start=start):
+        sources.append(Source(segment.path, segment.start, segment.end, segment.records))
+    if os.path.exists(events_file):
+        sources.append(Source(events_file, None, None, lambda: read_lines(events_file)))
+    spanned = []
+    for source in sources:
+        if source.start is None:
+            timestamps = [event.timestamp for event in to_events(source.read())]
+            if not timestamps:
+                continue
+            source = source._replace(start=min(timestamps), end=max(timestamps))
+        if start is None or source.end >= start:
+            spanned.append(source)
+    return spanned
+
+
+def stream_events(sources: List[Source], start: Optional[int] = None) -> Iterator[SensorEvent]:
+    """
+    Yield the events of the sources from start on, in time order. Sources whose time ranges overlap
+    are merged; the others are read one after the other, so only one group is held in memory at a time.
+    """
+    group, group_end = [], None
+    for source in sorted(sources, key=lambda source: (source.start, source.end)) + [None]:
+        if group and (source is None or source.start > group_end):
+            sorted_sources = [sorted(to_events(member.read(), start), key=lambda event: event.timestamp) for member in group]
+            yield from heapq.merge(*sorted_sources, key=lambda event: event.timestamp)
+            group, group_end = [], None
+        if source is not None:
+            group.append(source)
+            group_end = source.end if group_end is None else max(group_end, source.end)
+
+
+class Checkpoint:
+    """
+    The start of the last window written, in a small JSON file replaced atomically after every batch
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.state = {"last_window_start": None, "windows": 0, "investigations": 0}
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                self.state.update(json.load(file))
+
+    @property
+    def last_window_start(self) -> Optional[int]:
+        return self.state["last_window_start"]
+
+    def advance(self, window_start: int, windows: int, investigations: int) -> None:
+        self.state["last_window_start"] = window_start
+        self.state["windows"] += windows
+        self.state["investigations"] += investigations
+        self.state["updated_at"] = int(time.time())
+        atomic_write(self.path, lambda file: json.dump(self.state, file, indent=2))
+
+    def clear(self) -> None:
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.state = {"last_window_start": None, "windows": 0, "investigations": 0}
+
+
+class Backfill:
+    """
+    Estimates windows a batch at a time and writes them to the memory file
+    """
+
+    def __init__(self, store: InvestigationStore, scanner: ScannerAgent, pool: WorkerPool,
+                 frontier=None, home: str = DEFAULT_HOME, threads: int = 1):
+        """
+        :param scanner: describes the windows, with whichever LLM client it was given
+        :param pool: the worker processes predicting with the tabular models
+        :param frontier: the Frontier agent to vote as well, or None to leave it out
+        :param threads: windows described, and estimated by the Frontier agent, at once
+        """
+        self.store = store
+        self.scanner = scanner
+        self.pool = pool
+        self.frontier = frontier
+        self.home = home
+        self.threads = threads
+
+    def describe(self, window: List[SensorEvent]) -> Optional[Situation]:
+        selection = self.scanner.summarize([LoadedSituation({"details": window})])
+        return selection.situations[0] if selection and selection.situations else None
+
+    def process(self, windows: List[List[SensorEvent]]) -> int:
+        """
+        Describe, estimate and save a batch of windows
+        :return: the number of investigations written; windows the scanner found nothing to say about are skipped
+        """
+        with ThreadPoolExecutor(self.threads) as executor:
+            situations = [situation for situation in executor.map(self.describe, windows) if situation is not None]
+            if not situations:
+                return 0
+            frontier_votes = (list(executor.map(self.frontier.estimate, situations)) if self.frontier is not None
+                              else [None] * len(situations))
+        predictions = self.pool.predict(situations)
+
+        for situation, frontier, predicted in zip(situations, frontier_votes, predictions):
+            votes = [frontier] + [prediction.label for prediction in predicted.values()]
+            # Without a model or the LLM to vote, the description's own result stands
+            estimate = vote(votes) if any(votes) else situation.result
+            id = investigation_id({'home': self.home, 'situation': situation.model_dump(include={'start_timestamp', 'end_timestamp'})})
+            investigation = Investigation(situation=situation, estimate=estimate, home=self.home, id=id)
+            try:
+                index = self.store.position(investigation.id)
+            except KeyError:
+                self.store.add(investigation)
+                continue
+            if self.store.get(index).reviewed_at is None:
+                self.store.update(index, investigation)
+        self.store.save()
+        return len(situations)
+
+    def run(self, events: Iterator[SensorEvent], checkpoint: Checkpoint, batch_size: int = BATCH_SIZE) -> Dict[str, int]:
+        """
+        Window the events and process the windows after the checkpoint, a batch at a time
+        """
+        resume_after = checkpoint.last_window_start
+        if resume_after is not None:
+            log(f"Resuming after the window starting at {resume_after}", event="resume", after=resume_after)
+        started = time.perf_counter()
+        totals = {"windows": 0, "investigations": 0, "skipped": 0}
+        batch = []
+        for window in window_events(events):
+            if resume_after is not None and window[0].timestamp <= resume_after:
+                totals["skipped"] += 1
+                continue
+            batch.append(window)
+            if len(batch) == batch_size:
+                self._commit(batch, checkpoint, totals, started)
+                batch = []
+        if batch:
+            self._commit(batch, checkpoint, totals, started)
+        return totals
+
+    def _commit(self, batch, checkpoint: Checkpoint, totals: Dict[str, int], started: float) -> None:
+        written = self.process(batch)
+        # After the investigations are saved: a crash in between only means the batch is estimated again
+        checkpoint.advance(batch[-1][0].timestamp, len(batch), written)
+        totals["windows"] += len(batch)
+        totals["investigations"] += written
+        elapsed = time.perf_counter() - started
+        log(f"Backfilled {totals['windows']} windows ({totals['windows'] / elapsed:.1f}/s)", event="progress",
+            windows=totals["windows"], investigations=totals["investigations"], last_window_start=batch[-1][0].timestamp)
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(make_formatter("[%(asctime)s] [%(levelname)s] %(message)s"))
+    logging.basicConfig(level=logging.INFO, handlers=[handler])
+    data_dir = os.getenv('DATA_DIR', os.path.join(ROOT_PROJECT_PATH, 'data'))
+
+    parser = argparse.ArgumentParser(description="Replay archived and live sensor data through the anomaly pipeline")
+    parser.add_argument("--events", action="append", dest="events_files",
+                        help=f"live events file, read with its archives (repeatable; default {EVENTS_FILE} in the data directory)")
+    parser.add_argument("--memory", default=os.path.join(data_dir, MEMORY_FILE), help="memory file to write investigations to")
+    parser.add_argument("--checkpoint", default=os.path.join(data_dir, CHECKPOINT_FILE), help="where progress is saved")
+    parser.add_argument("--retention-weeks", type=int, default=RETENTION_WEEKS,
+                        help="investigations older than this are moved from the memory file to its archives")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and replay everything")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="windows estimated and written together")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes for the tabular models")
+    parser.add_argument("--llm", action="store_true", help="describe windows with the LLM and let the Frontier agent vote")
+    parser.add_argument("--rpm", type=int, default=60, help="LLM requests per minute the backfill may make, with --llm")
+    parser.add_argument("--tpm", type=int, default=60000, help="LLM tokens per minute the backfill may use, with --llm")
+    parser.add_argument("--home", default=os.getenv('HOME_ID', DEFAULT_HOME), help="home the investigations belong to")
+    parser.add_argument("--verbose", action="store_true", help="log every agent step, not only progress")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        # A line per window from every agent would drown the progress
+        logging.getLogger("agents").setLevel(logging.WARNING)
+    checkpoint = Checkpoint(args.checkpoint)
+    if args.restart:
+        checkpoint.clear()
+    # Windows are chained from their first event, so streaming from the start of the last window
+    # written windows the rest exactly as before, and every segment ending earlier can be skipped
+    resume_from = checkpoint.last_window_start
+    sources = [source for events_file in args.events_files or [os.path.join(data_dir, EVENTS_FILE)]
+               for source in event_sources(events_file, resume_from)]
+    log(f"Backfilling from {len(sources)} files", event="start", files=[source.name for source in sources])
+
+    frontier = None
+    if args.llm:
+        llm = LLMScheduler(make_client(), rpm=args.rpm, tpm=args.tpm)
+        from agents.frontier_agent import FrontierAgent
+        frontier = FrontierAgent([], llm=llm)
+    else:
+        llm = StubClient()
+    store = InvestigationStore(RotatingJSONFile(args.memory, retention_weeks=args.retention_weeks, is_jsonl=False)).load()
+    with WorkerPool(data_dir, args.workers) as pool:
+        backfill = Backfill(store, ScannerAgent(llm), pool, frontier, home=args.home,
+                            threads=llm.max_concurrency if args.llm else 1)
+        totals = backfill.run(stream_events(sources, resume_from), checkpoint, args.batch_size)
+    log("Backfill is complete", event="complete", **totals)
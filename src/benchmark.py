@@ -0,0 +1,269 @@
+"""
+Replay the labelled datasets in data/ through the agent pipeline - parsing, scanning, featurization,
+ensemble voting and persistence - and report per-stage latency, throughput, peak memory and accuracy as JSON.
+
+The LLM calls are stubbed so runs are repeatable and free: the scanner's stub judges each window by the
+stub's rule (anomalous if there are events at night) and echoes its labelled description, and the Frontier
+Agent's vote is replaced by the scanner's result. The Random Forest and TabPFN agents run for real with
+whichever model versions the registry holds; a member that is stubbed votes with the scanner too.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --compare bench.json      # flag stages that got slower than a previous run
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from agents.event_parser import EventParser
+from agents.ensemble_agent import EnsembleAgent
+from agents.llm import StubClient, stub_reply
+from agents.features import prepare_features
+from agents.investigation_store import InvestigationStore
+from agents.rotating_json_file import RotatingJSONFile
+from agents.scanner_agent import ScannerAgent
+from agents.situations import Investigation, LoadedSituation, Situation
+
+ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATASETS = ['training_data.json', 'adjusted_training_data.json', 'all_data.json']
+
+# The datasets are older than any retention period; keep every event while replaying them
+RETENTION_WEEKS = 100 * 52
+
+# A stage counts as regressed in --compare when its median latency grows by more than this factor
+REGRESSION_FACTOR = 1.2
+
+
+class WindowEcho:
+    """
+    Replies to the scanner as the stub LLM client would (see llm.stub_reply), judging the window by its
+    events, but with the labelled description of the window it is being told about, as a responder for the stub
+    """
+
+    def __init__(self):
+        self.description: Optional[str] = None
+
+    def __call__(self, messages, response_format):
+        reply = stub_reply(messages, response_format)
+        for situation in reply.situations:
+            situation.situation_description = self.description
+        return reply
+
+
+class Timed:
+    """
+    Wraps an ensemble member so every estimate it makes is timed and recorded
+    """
+
+    def __init__(self, member, latencies: List[float], votes: List[str]):
+        self.member = member
+        self.latencies = latencies
+        self.votes = votes
+
+    def estimate(self, situation: Situation) -> str:
+        start = time.perf_counter()
+        vote = self.member.estimate(situation)
+        self.latencies.append(time.perf_counter() - start)
+        self.votes.append(vote)
+        return vote
+
+
+class ScannerVote:
+    """
+    Votes whatever the scanner said, in place of the Frontier Agent's LLM call
+    """
+
+    def estimate(self, situation: Situation) -> str:
+        return situation.result
+
+
+def load_member(name: str, factory: Callable[[], Any]):
+    try:
+        return factory()
+    except (FileNotFoundError, ImportError, ModuleNotFoundError) as e:
+        print(f"{name} is not available, it votes with the scanner: {e}", file=sys.stderr)
+        return None
+
+
+def percentiles(latencies: List[float]) -> Dict[str, float]:
+    if not latencies:
+        return {"count": 0}
+    milliseconds = np.array(latencies) * 1000
+    return {
+        "count": len(latencies),
+        "mean_ms": float(milliseconds.mean()),
+        "p50_ms": float(np.percentile(milliseconds, 50)),
+        "p90_ms": float(np.percentile(milliseconds, 90)),
+        "p99_ms": float(np.percentile(milliseconds, 99)),
+        "max_ms": float(milliseconds.max()),
+    }
+
+
+class Benchmark:
+
+    def __init__(self, data_dir: str, llm_latency: float = 0.0):
+        self.data_dir = data_dir
+        self.echo = WindowEcho()
+        self.llm = StubClient(latency=llm_latency, responder=self.echo)
+        self.scanner = ScannerAgent(self.llm)
+
+        from agents.random_forest_agent import RandomForestAgent
+        from agents.tabpfn_agent import TabPFNAgent
+        self.members = {
+            "frontier": ScannerVote(),
+            "random_forest": load_member("Random Forest Agent", RandomForestAgent) or ScannerVote(),
+            "tabpfn": load_member("TabPFN Agent", TabPFNAgent) or ScannerVote(),
+        }
+        self.stubbed = [name for name, member in self.members.items() if isinstance(member, ScannerVote)]
+
+    def run_dataset(self, filename: str) -> Dict[str, Any]:
+        with open(os.path.join(self.data_dir, filename), 'r') as file:
+            # A window without events has nothing to scan or featurize
+            records = [record for record in json.load(file) if record['situation'].get('details')]
+        workdir = tempfile.mkdtemp(prefix="careagent-bench-")
+        try:
+            return self._replay(records, workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def _replay(self, records: List[Dict[str, Any]], workdir: str) -> Dict[str, Any]:
+        latencies = {stage: [] for stage in ["scan", "featurize", "ensemble", "persist"]}
+        member_latencies = {name: [] for name in self.members}
+        member_votes = {name: [] for name in self.members}
+        truths, estimates = [], []
+
+        # Parse: the raw events of the whole dataset, as the sensor feed would deliver them
+        events_path = os.path.join(workdir, "events.jsonl")
+        with open(events_path, 'w') as file:
+            for record in records:
+                for event in record['situation']['details']:
+                    file.write(json.dumps(event) + '\n')
+        started = time.perf_counter()
+        parser = EventParser(events_path)
+        parser.file.retention_weeks = RETENTION_WEEKS
+        parser.parse()
+        parse_seconds = time.perf_counter() - started
+
+        ensemble = EnsembleAgent.__new__(EnsembleAgent)
+        ensemble.frontier, ensemble.random_forest, ensemble.tabPFN = [
+            Timed(self.members[name], member_latencies[name], member_votes[name]) for name in ["frontier", "random_forest", "tabpfn"]]
+        memory_file = RotatingJSONFile(os.path.join(workdir, "memory.json"), retention_weeks=RETENTION_WEEKS,
+                                       archive_dir=os.path.join(workdir, "archives"), is_jsonl=False)
+        store = InvestigationStore(memory_file).load()
+
+        # The labelled windows go through the per-window stages one at a time, like the planning agent runs
+        started = time.perf_counter()
+        for record in records:
+            stage_start = time.perf_counter()
+            self.echo.description = record['situation']['situation_description']
+            selection = self.scanner.summarize([LoadedSituation(record['situation'])])
+            situation = selection.situations[0]
+            latencies["scan"].append(time.perf_counter() - stage_start)
+
+            stage_start = time.perf_counter()
+            prepare_features(situation)
+            latencies["featurize"].append(time.perf_counter() - stage_start)
+
+            stage_start = time.perf_counter()
+            estimate = ensemble.estimate(situation)
+            latencies["ensemble"].append(time.perf_counter() - stage_start)
+
+            stage_start = time.perf_counter()
+            store.add(Investigation(situation=situation, estimate=estimate))
+            store.save()
+            latencies["persist"].append(time.perf_counter() - stage_start)
+
+            truths.append(record['situation']['result'])
+            estimates.append(estimate)
+        elapsed = time.perf_counter() - started
+
+        def accuracy(predicted):
+            return float(np.mean([p == t for p, t in zip(predicted, truths)])) if truths else None
+
+        return {
+            "windows": len(records),
+            "events": sum(len(record['situation']['details']) for record in records),
+            "parse": {"seconds": parse_seconds, "windows": len(parser.entries)},
+            "stages": {stage: percentiles(values) for stage, values in latencies.items()},
+            "members": {name: percentiles(values) for name, values in member_latencies.items()},
+            "windows_per_second": len(records) / elapsed if elapsed else None,
+            "accuracy": {"ensemble": accuracy(estimates),
+                         **{name: accuracy(votes) for name, votes in member_votes.items() if name not in self.stubbed}},
+        }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT_PROJECT_PATH, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """
+    List the stages whose median latency grew by more than REGRESSION_FACTOR against a previous run
+    """
+    regressions = []
+    for dataset, result in results["datasets"].items():
+        previous = baseline.get("datasets", {}).get(dataset)
+        if not previous:
+            continue
+        for group in ["stages", "members"]:
+            for stage, stats in result[group].items():
+                before = previous.get(group, {}).get(stage, {}).get("p50_ms")
+                after = stats.get("p50_ms")
+                if before and after and after > before * REGRESSION_FACTOR:
+                    regressions.append(f"{dataset} {stage}: p50 {before:.2f}ms -> {after:.2f}ms")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the agent pipeline on the labelled datasets")
+    parser.add_argument("--dataset", action="append", dest="datasets", help="dataset in the data directory (repeatable)")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="simulated latency of each stubbed LLM call")
+    parser.add_argument("--trace-memory", action="store_true", help="also report the peak Python heap, at some cost in speed")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--compare", help="results of a previous run to check for regressions")
+    args = parser.parse_args()
+
+    if args.trace_memory:
+        tracemalloc.start()
+    benchmark = Benchmark(os.getenv('DATA_DIR', os.path.join(ROOT_PROJECT_PATH, 'data')), args.llm_latency_ms / 1000)
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "datasets": {name: benchmark.run_dataset(name) for name in args.datasets or DATASETS},
+        "stubbed_members": benchmark.stubbed,
+        "llm_calls": benchmark.llm.calls,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    if args.trace_memory:
+        results["peak_heap_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            regressions = compare(results, json.load(file))
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
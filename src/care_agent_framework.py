@@ -2,11 +2,16 @@ import os
 import sys
 import logging
 import json
+import time
 from typing import List, Optional
 from dotenv import load_dotenv
 from agents.planning_agent import PlanningAgent
 from agents.situations import Situation, Investigation
 from agents.rotating_json_file import RotatingJSONFile
+from agents.investigation_store import InvestigationStore
+from agents.json_store import DEFAULT_HOME
+from agents.metrics import metrics
+from log_utils import make_formatter
 import numpy as np
 
 # Colors for logging
@@ -24,7 +29,7 @@ def init_logging():
     
     handler = logging.StreamHandler(sys.stdout)
     handler.setLevel(logging.INFO)
-    formatter = logging.Formatter(
+    formatter = make_formatter(
         "[%(asctime)s] [Agents] [%(levelname)s] %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S %z",
     )
@@ -36,12 +41,15 @@ class CareAgentFramework:
     """Get the project root directory (2 levels up from CareAgentFramework.py)."""
     ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(__file__))
     MEMORY_FILENAME = ROOT_PROJECT_PATH + "/data/memory.json"
+    # Where this process's metrics are saved for the dashboard backend to serve at /metrics
+    METRICS_FILENAME = ROOT_PROJECT_PATH + "/data/metrics.json"
 
     def __init__(self):
         init_logging()
         load_dotenv()
         self.memory_file = RotatingJSONFile(self.MEMORY_FILENAME, retention_weeks=52, archive_dir=None, is_jsonl=False) # retain data for 1 year
-        self.memory = self.read_memory()
+        self.store = InvestigationStore(self.memory_file).load()
+        self.home = os.getenv('HOME_ID', DEFAULT_HOME)
         self.collection = [] # we should put in the anomalous situations here
         self.planner = None
 
@@ -50,7 +58,11 @@ class CareAgentFramework:
             self.log("Initializing Agent Framework")
             self.planner = PlanningAgent(self.collection)
             self.log("Agent Framework is ready")
-        
+
+    @property
+    def memory(self) -> List[Investigation]:
+        return self.store.investigations
+
     def read_memory(self) -> List[Investigation]:
         if os.path.exists(self.MEMORY_FILENAME):
             data = self.memory_file.read()
@@ -59,8 +71,8 @@ class CareAgentFramework:
         return []
     
     def write_memory(self) -> None:
-        data = [situation.dict() for situation in self.memory]
-        self.memory_file.overwrite(data)
+        with metrics.timer("stage_seconds", stage="persist"):
+            self.store.save()
 
     def update_memory(self, index, updated_investigation):
         """
@@ -70,27 +82,51 @@ class CareAgentFramework:
             index (int): The index of the investigation to update.
             updated_investigation (Investigation): The updated investigation object.
         """
-        investigations = self.read_memory()
-        if 0 <= index < len(investigations):
-            investigations[index] = updated_investigation
-            self.memory_file.overwrite([inv.dict() for inv in investigations])
-        else:
-            raise IndexError("Index out of range for investigations")
+        with self.store.lock:
+            self.store.update(index, updated_investigation)
+            self.store.save()
+
+    def relabel(self, investigation_id: str, estimate: str) -> Investigation:
+        """
+        Set the estimate of the investigation with the given id (human reenforced learning).
+
+        Args:
+            investigation_id (str): The stable id of the investigation.
+            estimate (str): Either "normal" or "anomalous".
+        """
+        # Held from the lookup to the save, so a refresh on the run thread cannot move the position meanwhile
+        with self.store.lock:
+            index = self.store.position(investigation_id)
+            # The review time marks the investigation as human labelled, for retraining to learn from
+            investigation = self.store.get(index).model_copy(update={"estimate": estimate, "reviewed_at": int(time.time())})
+            self.update_memory(index, investigation)
+        return investigation
 
     def log(self, message: str):
-        text = BG_BLUE + WHITE + "[Agent Framework] " + message + RESET
-        logging.info(text)
+        logging.info(message, extra={"agent": "Agent Framework", "color": BG_BLUE + WHITE})
 
     def run(self) -> List[Situation]:
         self.init_agents_as_needed()
+        # Show the planner what the dashboard backend or a backfill saved since the last run; a no-op if nothing
+        # did. What they save while it plans is merged by the save below, under the file lock.
+        if self.store.refresh():
+            self.log("Memory changed on disk, investigations updated")
         logging.info("Kicking off Planning Agent")
         result = self.planner.plan(memory=self.memory)
-        logging.info(f"Planning Agent has completed and returned: {result}")
+        logging.info("Planning Agent has completed and returned: %s", result)
         if result:
-            self.memory.append(result)
+            result.home = result.home or self.home
+            self.store.add(result)
             self.write_memory()
+        self.write_metrics()
         return self.memory
 
+    def write_metrics(self) -> None:
+        try:
+            metrics.write_snapshot(self.METRICS_FILENAME, process="agents")
+        except OSError as e:
+            logging.warning(f"Could not save metrics: {e}")
+
 
 if __name__=="__main__":
     CareAgentFramework().run()
@@ -1,29 +1,26 @@
 import logging
-import queue
+import math
 import threading
-import time
 import gradio as gr
 from gradio_modal import Modal
 from care_agent_framework import CareAgentFramework
 from agents.situations import Investigation, Situation
-from log_utils import reformat
+from log_utils import ColorFormatter, get_log_bus
 import plotly.graph_objects as go
 from datetime import datetime
 import json
 
 TIMEZONE = datetime.now().astimezone().tzinfo
 
-class QueueHandler(logging.Handler):
-    def __init__(self, log_queue):
-        super().__init__()
-        self.log_queue = log_queue
+# Number of log lines shown in the log panel
+LOG_LINES = 18
 
-    def emit(self, record):
-        self.log_queue.put(self.format(record))
+# Number of investigations shown per page of the situation tables
+PAGE_SIZE = 25
 
 
 def html_for(log_data):
-    output = '<br>'.join(log_data[-18:])
+    output = '<br>'.join(log_data[-LOG_LINES:])
     return f"""
     <div id="scrollContent" style="height: 400px; overflow-y: auto; border: 1px solid #ccc; background-color: #808080; padding: 10px;">
     {output}
@@ -31,16 +28,15 @@ def html_for(log_data):
     """
 
 
-def setup_logging(log_queue):
-    handler = QueueHandler(log_queue)
-    formatter = logging.Formatter(
+def setup_logging():
+    # The log panel converts colors to HTML, so it always gets the colored renderer
+    formatter = ColorFormatter(
         "[%(asctime)s] %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S %z",
     )
-    handler.setFormatter(formatter)
     logger = logging.getLogger()
-    logger.addHandler(handler)
     logger.setLevel(logging.INFO)
+    return get_log_bus(formatter)
 
 
 class App:
@@ -73,122 +69,171 @@ class App:
                     if index < len(investigations):
                         details = investigations[index].situation.details
                         # Format details nicely for display
-                        details_str = "\n".join(detail for detail in details)
+                        details_str = "\n".join(detail.to_json() for detail in details)
                         print(f"Showing details for index: {index}")
                         return Modal(visible=False), details_str, Modal(visible=True)
                 print("No details to show or invalid index")
                 return Modal(visible=False), "", Modal(visible=False)
     
-            def table_for(invs):
-                result_table = []
-                for inv in invs:
-                    row = [
-                        inv.situation.situation_description,
-                        inv.situation.result,
-                        f"{datetime.fromtimestamp(inv.situation.start_timestamp, tz=TIMEZONE)}",
-                        f"{datetime.fromtimestamp(inv.situation.end_timestamp, tz=TIMEZONE)}",
-                        inv.situation.start_timestamp,
-                        inv.situation.end_timestamp,
-                        inv.estimate #this is the estimated value (adjusted by human reenforced learning)
-                    ]
-                    result_table.append(row)
-                return result_table
-
-            def update_output(log_data, log_queue, result_queue):
-                initial_result = table_for(self.get_agent_framework().memory)
-                final_result = None
-                while True:
-                    try:
-                        message = log_queue.get_nowait()
-                        log_data.append(reformat(message))
-                        yield log_data, html_for(log_data), final_result or initial_result
-                    except queue.Empty:
-                        try:
-                            final_result = result_queue.get_nowait()
-                            yield log_data, html_for(log_data), final_result or initial_result
-                        except queue.Empty:
-                            if final_result is not None:
-                                break
-                            time.sleep(0.5)
+            # Rendered <tr> markup per investigation position, reused until the row's version changes
+            row_cache = {}
+
+            def row_html(index, inv, version):
+                cached = row_cache.get(index)
+                if cached and cached[0] == version:
+                    return cached[1]
+                estimate = inv.estimate #this is the estimated value (adjusted by human reenforced learning)
+                selected_normal = "selected" if estimate == "normal" else ""
+                selected_anomalous = "selected" if estimate == "anomalous" else ""
+
+                # Add a row with a clickable event
+                html = f"""
+                        <tr>
+                            <td style="border: 1px solid #ddd; padding: 8px;" onclick="window.showDetails({index})">{inv.situation.situation_description}</td>
+                            <td style="border: 1px solid #ddd; padding: 8px;">{inv.situation.result}</td>
+                            <td style="border: 1px solid #ddd; padding: 8px;">{datetime.fromtimestamp(inv.situation.start_timestamp, tz=TIMEZONE)}</td>
+                            <td style="border: 1px solid #ddd; padding: 8px;">{datetime.fromtimestamp(inv.situation.end_timestamp, tz=TIMEZONE)}</td>
+                            <td style="border: 1px solid #ddd; padding: 8px;">{inv.situation.start_timestamp}</td>
+                            <td style="border: 1px solid #ddd; padding: 8px;">{inv.situation.end_timestamp}</td>
+                            <td style="border: 1px solid #ddd; padding: 8px;">
+                                <select 
+                                    onchange="window.handleDropdownChange(this.value, '{inv.id}')"
+                                    data-row-id="{inv.id}"
+                                >
+                                    <option value="normal" {selected_normal}>Normal</option>
+                                    <option value="anomalous" {selected_anomalous}>Anomalous</option>
+                                </select>
+                            </td>
+                        </tr>
+                        """
+                row_cache[index] = (version, html)
+                return html
 
+            def update_output(log_data, subscription, done):
+                finished = False
+                while not finished:
+                    # Check for completion before draining, so no line logged ahead of it is missed
+                    finished = done.is_set()
+                    lines = subscription.drain() if finished else subscription.get()
+                    if lines:
+                        log_data = (log_data + lines)[-LOG_LINES:]
+                    if lines or finished:
+                        yield log_data, html_for(log_data), finished
+
+
+            # The figure last built from the daily aggregate, with the aggregate revision it reflects
+            plot_cache = {"revision": None, "figure": None}
 
             def get_plot():
-                # Process data to count the number of anomalous situations per day
-                investigations = self.get_agent_framework().memory
-                anomalous_counts = {}
-                
-                for inv in investigations:
-                    if inv.estimate == "anomalous":
-                        date = datetime.fromtimestamp(inv.situation.start_timestamp, tz=TIMEZONE).date()
-                        if date not in anomalous_counts:
-                            anomalous_counts[date] = 0
-                        anomalous_counts[date] += 1
-                
-                # Prepare data for the bar chart
-                dates = [date.strftime('%Y-%m-%d') for date in anomalous_counts.keys()]
-                counts = list(anomalous_counts.values())
-                
+                # Draw the number of anomalous situations per day from the maintained aggregate,
+                # rebuilding the figure only when a count has changed
+                daily = self.get_agent_framework().store.daily
+                if plot_cache["revision"] == daily.revision:
+                    return plot_cache["figure"]
+
+                bars = []
+                for home, counts in daily.by_home().items():
+                    dates = [day.strftime('%Y-%m-%d') for day, _ in counts]
+                    bars.append(go.Bar(x=dates, y=[total for _, total in counts], name=home))
+
                 # Create the bar chart
-                fig = go.Figure(data=[go.Bar(x=dates, y=counts)])
+                fig = go.Figure(data=bars)
                 fig.update_layout(
                     title='Number of Anomalous Situations per Day',
                     xaxis_title='Date',
                     yaxis_title='Number of Anomalous Situations',
                     height=400,
+                    showlegend=len(bars) > 1,
                 )
+                plot_cache["revision"] = daily.revision
+                plot_cache["figure"] = fig
                 return fig
 
-            def do_run():
-                new_investigations = self.get_agent_framework().run()
-                table = table_for(new_investigations)
-                return table
+            def render_table(estimate, page, text, signature):
+                """
+                Render one page of investigations with the given estimate.
+                The signature records what the client was last sent; if no row on the
+                page has changed the table is left untouched instead of being re-sent.
+                """
+                store = self.get_agent_framework().store
+                page = max(int(page or 1), 1)
+                # The run thread may change the store meanwhile; the page and its versions are read together
+                with store.lock:
+                    total, rows = store.query(estimate=estimate, text=text, page=page, page_size=PAGE_SIZE)
+                    pages = max(math.ceil(total / PAGE_SIZE), 1)
+                    if page > pages:
+                        page = pages
+                        total, rows = store.query(estimate=estimate, text=text, page=page, page_size=PAGE_SIZE)
+                    versions = {index: store.versions[index] for index, _ in rows}
+                new_signature = (page, text or "", total, tuple((index, versions[index]) for index, _ in rows))
+                if new_signature == signature:
+                    return gr.update(), signature
+                return create_html_table(rows, versions, total, page, pages), new_signature
+
+            def run_with_logging(initial_log_data, anomalous_page, anomalous_filter, anomalous_signature,
+                                 normal_page, normal_filter, normal_signature):
+                done = threading.Event()
+                subscription = setup_logging().subscribe(capacity=LOG_LINES)
 
-            def run_with_logging(initial_log_data):
-                log_queue = queue.Queue()
-                result_queue = queue.Queue()
-                setup_logging(log_queue)
-                
                 def worker():
-                    result = do_run()
-                    result_queue.put(result)
-                
+                    try:
+                        self.get_agent_framework().run()
+                    except Exception:
+                        logging.exception("Agent Framework run failed")
+                    finally:
+                        done.set()
+                        subscription.wake()
+
                 thread = threading.Thread(target=worker)
                 thread.start()
-                
-                for log_data, output, final_result in update_output(initial_log_data, log_queue, result_queue):
-                    yield log_data, output, create_html_table(final_result, "anomalous"), create_html_table(final_result, "normal"), get_plot()
+
+                signatures = {"anomalous": anomalous_signature, "normal": normal_signature}
+                plot_revision = self.get_agent_framework().store.daily.revision
+                first = True
+                with subscription:
+                    for log_data, output, finished in update_output(initial_log_data, subscription, done):
+                        # The tables and plot only change when a run adds an investigation, not on each log line
+                        if first or finished:
+                            anomalous_html, signatures["anomalous"] = render_table("anomalous", anomalous_page, anomalous_filter, signatures["anomalous"])
+                            normal_html, signatures["normal"] = render_table("normal", normal_page, normal_filter, signatures["normal"])
+                        else:
+                            anomalous_html, normal_html = gr.update(), gr.update()
+                        daily_revision = self.get_agent_framework().store.daily.revision
+                        updated_plot = get_plot() if first or daily_revision != plot_revision else gr.update()
+                        plot_revision = daily_revision
+                        first = False
+                        yield log_data, output, anomalous_html, normal_html, updated_plot, signatures["anomalous"], signatures["normal"]
            
 
-            def handle_dropdown_change(value):
+            def handle_dropdown_change(value, anomalous_page, anomalous_filter, anomalous_signature,
+                                       normal_page, normal_filter, normal_signature):
                 print("Dropdown change handler called with value:", value)
+                plot_revision = self.get_agent_framework().store.daily.revision
                 try:
                     data = json.loads(value)
-                    index = data["index"]
+                    investigation_id = data["id"]
                     estimate = data["value"]
 
-                    investigations = self.get_agent_framework().memory
-                    investigation = investigations[index]
-
-                    # setting the estimate (human reenforced learning)
-                    investigation.estimate = estimate
-
                     if estimate == "anomalous":
-                        print(f"Marking investigation {index} as anomalous")
+                        print(f"Marking investigation {investigation_id} as anomalous")
                     else:
-                        print(f"Marking investigation {index} as normal")
-
-                    self.get_agent_framework().update_memory(index, investigation)
+                        print(f"Marking investigation {investigation_id} as normal")
 
-                    # Update the table and plot
-                    updated_anomalous_table = create_html_table(table_for(investigations), "anomalous")
-                    updated_normal_table = create_html_table(table_for(investigations), "normal")
-                    updated_plot = get_plot()
-                    return updated_anomalous_table, updated_normal_table, updated_plot
+                    # setting the estimate (human reenforced learning)
+                    self.get_agent_framework().relabel(investigation_id, estimate)
                 except Exception as e:
-                    return create_html_table(table_for([]), "anomalous"), create_html_table(table_for([]), "normal"), get_plot()
-
-            def create_html_table(data, estimateToShow="anomalous"):
-                table_html = """
+                    print(f"Failed to update investigation: {e}")
+
+                # Update the tables and plot
+                anomalous_html, anomalous_signature = render_table("anomalous", anomalous_page, anomalous_filter, anomalous_signature)
+                normal_html, normal_signature = render_table("normal", normal_page, normal_filter, normal_signature)
+                plot_changed = self.get_agent_framework().store.daily.revision != plot_revision
+                updated_plot = get_plot() if plot_changed else gr.update()
+                return anomalous_html, normal_html, updated_plot, anomalous_signature, normal_signature
+
+            def create_html_table(rows, versions, total, page, pages):
+                table_html = f"""
+                <div style="padding: 4px 0;">Page {page} of {pages} ({total} situations)</div>
                 <table style="width:100%; border-collapse: collapse;">
                     <thead>
                         <tr>
@@ -203,33 +248,7 @@ class App:
                     </thead>
                     <tbody>
                 """
-                for idx, row in enumerate(data):
-                    estimate = row[6]  # Estimate field
-
-                    if estimate == estimateToShow: #only include rows that match the estimateToShow                    
-                        selected_normal = "selected" if estimate == "normal" else ""
-                        selected_anomalous = "selected" if estimate == "anomalous" else ""
-
-                        # Add a row with a clickable event
-                        table_html += f"""
-                        <tr>
-                            <td style="border: 1px solid #ddd; padding: 8px;" onclick="window.showDetails({idx})">{row[0]}</td>
-                            <td style="border: 1px solid #ddd; padding: 8px;">{row[1]}</td>
-                            <td style="border: 1px solid #ddd; padding: 8px;">{row[2]}</td>
-                            <td style="border: 1px solid #ddd; padding: 8px;">{row[3]}</td>
-                            <td style="border: 1px solid #ddd; padding: 8px;">{row[4]}</td>
-                            <td style="border: 1px solid #ddd; padding: 8px;">{row[5]}</td>
-                            <td style="border: 1px solid #ddd; padding: 8px;">
-                                <select 
-                                    onchange="window.handleDropdownChange(this.value, {idx})"
-                                    data-row-index="{idx}"
-                                >
-                                    <option value="normal" {selected_normal}>Normal</option>
-                                    <option value="anomalous" {selected_anomalous}>Anomalous</option>
-                                </select>
-                            </td>
-                        </tr>
-                        """
+                table_html += "".join(row_html(index, inv, versions[index]) for index, inv in rows)
                 table_html += """
                     </tbody>
                 </table>
@@ -247,24 +266,45 @@ class App:
                 with gr.Column(scale=1):
                     plot = gr.Plot(value=get_plot(), show_label=False)
 
+            # What each table last sent to this client, see render_table
+            anomalous_signature = gr.State(None)
+            normal_signature = gr.State(None)
+
             with gr.Tab("Anomalous Situations"):
+                with gr.Row():
+                    anomalous_filter = gr.Textbox(label="Filter", placeholder="Search descriptions", scale=3)
+                    anomalous_page = gr.Number(label="Page", value=1, precision=0, minimum=1, scale=1)
                 with gr.Row():
                     anomalous_investigations_html = gr.HTML()
 
             with gr.Tab("Normal Situations"):
+                with gr.Row():
+                    normal_filter = gr.Textbox(label="Filter", placeholder="Search descriptions", scale=3)
+                    normal_page = gr.Number(label="Page", value=1, precision=0, minimum=1, scale=1)
                 with gr.Row():
                     normal_investigations_html = gr.HTML()
 
+            table_inputs = [anomalous_page, anomalous_filter, anomalous_signature, normal_page, normal_filter, normal_signature]
+            run_outputs = [log_data, logs, anomalous_investigations_html, normal_investigations_html, plot, anomalous_signature, normal_signature]
+
+            for page, text, signature, html, estimate in [
+                (anomalous_page, anomalous_filter, anomalous_signature, anomalous_investigations_html, "anomalous"),
+                (normal_page, normal_filter, normal_signature, normal_investigations_html, "normal"),
+            ]:
+                def render(page, text, signature, estimate=estimate):
+                    return render_table(estimate, page, text, signature)
+                page.change(fn=render, inputs=[page, text, signature], outputs=[html, signature])
+                text.submit(fn=render, inputs=[page, text, signature], outputs=[html, signature])
 
             dropdown_data = gr.Textbox(elem_id="dropdown-data-input", visible=True)
 
             dropdown_data.change(
                 fn=handle_dropdown_change,
-                inputs=[dropdown_data],
-                outputs=[anomalous_investigations_html, normal_investigations_html, plot]
+                inputs=[dropdown_data] + table_inputs,
+                outputs=[anomalous_investigations_html, normal_investigations_html, plot, anomalous_signature, normal_signature]
             )
 
-            ui.load(run_with_logging, inputs=[log_data], outputs=[log_data, logs, anomalous_investigations_html, normal_investigations_html, plot])
+            ui.load(run_with_logging, inputs=[log_data] + table_inputs, outputs=run_outputs)
 
             # JavaScript to trigger modal display on row click
             ui.load(
@@ -304,8 +344,8 @@ class App:
             ui.load(
                 None, None, None,
                 js="""
-                window.handleDropdownChange = function(value, index) {
-                    const data = JSON.stringify({ index: index, value: value });
+                window.handleDropdownChange = function(value, id) {
+                    const data = JSON.stringify({ id: id, value: value });
                     const textbox = document.querySelector("#dropdown-data-input textarea");
                     if (textbox) {
                         textbox.value = data;
@@ -320,7 +360,7 @@ class App:
             )
 
             timer = gr.Timer(value=30, active=True)
-            timer.tick(run_with_logging, inputs=[log_data], outputs=[log_data, logs, anomalous_investigations_html, normal_investigations_html, plot])
+            timer.tick(run_with_logging, inputs=[log_data] + table_inputs, outputs=run_outputs)
 
         ui.launch(share=False, inbrowser=True)
 
@@ -1,13 +1,31 @@
 import functools
+import hashlib
+import json
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
 from http import HTTPStatus
-from typing import Annotated, Callable
+from typing import Annotated, Any, Callable
 import jwt
 from fastapi import Depends, HTTPException, WebSocket, WebSocketException, status
 from fastapi.requests import HTTPConnection
-from jwt import PyJWKClient
+from jwt import PyJWK, PyJWKClientError, PyJWKSet
 from pydantic import BaseModel
 from starlette.requests import Request
 
+# How long fetched signing keys are used before being refreshed in the background
+JWKS_TTL_SECONDS = 300
+
+# Unknown key ids trigger a fetch on the request path, but at most this often
+JWKS_MIN_REFETCH_SECONDS = 30
+
+JWKS_FETCH_TIMEOUT_SECONDS = 5
+
+# Verified tokens are remembered until they expire, or for at most this long
+VERIFIED_TOKEN_MAX_AGE_SECONDS = 300
+VERIFIED_TOKEN_CACHE_SIZE = 4096
+
 
 class AuthConfig(BaseModel):
     jwks_url: str
@@ -75,15 +93,143 @@ def get_authorized_user(
         )
 
 
+def fetch_jwks(url: str) -> dict[str, Any]:
+    with urllib.request.urlopen(url, timeout=JWKS_FETCH_TIMEOUT_SECONDS) as response:
+        return json.load(response)
+
+
+class JWKSCache:
+    """Signing keys from a JWKS endpoint, keyed by kid.
+
+    Known keys are served from memory; once they are older than the TTL they keep
+    being served while a background thread refreshes them. Only a kid that is not
+    known yet (e.g. after key rotation) makes a request wait for a fetch.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        fetch: Callable[[str], dict[str, Any]] = fetch_jwks,
+        ttl: float = JWKS_TTL_SECONDS,
+        min_refetch: float = JWKS_MIN_REFETCH_SECONDS,
+    ):
+        self.url = url
+        self.ttl = ttl
+        self.min_refetch = min_refetch
+        self._fetch = fetch
+        self._keys: dict[str, PyJWK] = {}
+        self._fetched_at = 0.0
+        self._attempted_at = float("-inf")
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def refresh(self) -> None:
+        with self._lock:
+            self._attempted_at = time.monotonic()
+        jwk_set = PyJWKSet.from_dict(self._fetch(self.url))
+        keys = {
+            key.key_id: key
+            for key in jwk_set.keys
+            if key.key_id and key.public_key_use in ("sig", None)
+        }
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+
+    def _refresh_in_background(self) -> None:
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Failed to refresh signing keys from {self.url}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, name="jwks-refresh", daemon=True).start()
+
+    def get_signing_key(self, kid: str | None) -> PyJWK:
+        now = time.monotonic()
+        key = self._keys.get(kid)
+        if key is not None:
+            if now - self._fetched_at > self.ttl:
+                self._refresh_in_background()
+            return key
+
+        if now - self._attempted_at >= self.min_refetch:
+            self.refresh()
+            key = self._keys.get(kid)
+        if key is None:
+            raise PyJWKClientError(f"Unable to find a signing key that matches: {kid}")
+        return key
+
+
+class VerifiedTokenCache:
+    """Payloads of tokens that already passed signature verification.
+
+    Entries are keyed by a hash of the audience and token, and are dropped once the
+    token expires, so repeated requests from one session skip RSA verification.
+    """
+
+    def __init__(
+        self,
+        max_size: int = VERIFIED_TOKEN_CACHE_SIZE,
+        max_age: float = VERIFIED_TOKEN_MAX_AGE_SECONDS,
+    ):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._entries: OrderedDict[str, tuple[float, dict[str, Any]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token: str, audience: str) -> str:
+        return hashlib.sha256(f"{audience}\0{token}".encode()).hexdigest()
+
+    def get(self, token: str, audience: str) -> dict[str, Any] | None:
+        key = self._key(token, audience)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, payload = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    def put(self, token: str, audience: str, payload: dict[str, Any]) -> None:
+        exp = payload.get("exp")
+        if not isinstance(exp, (int, float)):
+            # Without an expiry there is nothing to bound the entry by
+            return
+        expires_at = min(exp, time.time() + self.max_age)
+        key = self._key(token, audience)
+        with self._lock:
+            self._entries[key] = (expires_at, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+verified_tokens = VerifiedTokenCache()
+
+
 @functools.cache
-def get_jwks_client(url: str):
-    """Reuse client cached by its url, client caches keys by default."""
-    return PyJWKClient(url, cache_keys=True)
+def get_jwks_client(url: str) -> JWKSCache:
+    """Reuse the key cache for a url across requests."""
+    return JWKSCache(url)
 
 
 def get_signing_key(url: str, token: str) -> tuple[str, str]:
     client = get_jwks_client(url)
-    signing_key = client.get_signing_key_from_jwt(token)
+    kid = jwt.get_unverified_header(token).get("kid")
+    signing_key = client.get_signing_key(kid)
     key = signing_key.key
     alg = signing_key.algorithm_name
     if alg != "RS256":
@@ -143,6 +289,10 @@ def authorize_token(
 
     payload = None
     for audience, jwks_url in jwks_urls:
+        payload = verified_tokens.get(token, audience)
+        if payload is not None:
+            break
+
         try:
             key, alg = get_signing_key(jwks_url, token)
         except Exception as e:
@@ -160,6 +310,8 @@ def authorize_token(
             print(f"Failed to decode and validate token {e}")
             continue
 
+        verified_tokens.put(token, audience, payload)
+
     try:
         user = User.model_validate(payload)
         print(f"User {user.sub} authenticated")
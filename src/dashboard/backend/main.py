@@ -1,6 +1,6 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from routers import sensor_data
+from routers import metrics, sensor_data, sensor_events
 
 app = FastAPI()
 
@@ -15,3 +15,5 @@ app.add_middleware(
 
 # Include your routers
 app.include_router(sensor_data.router)
+app.include_router(sensor_events.router)
+app.include_router(metrics.router)
@@ -0,0 +1,45 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+import json
+import os
+
+# Importing sensor_data puts src/ on sys.path for the shared agents modules
+from routers.sensor_data import MEMORY_FILE_PATH
+from agents.metrics import metrics, render_prometheus
+
+router = APIRouter()
+
+# The agent framework saves its metrics here after every run
+AGENT_METRICS_PATH = os.path.join(os.path.dirname(MEMORY_FILE_PATH), 'metrics.json')
+
+
+def collect_snapshots():
+    """
+    Return the agent framework's last saved snapshot, if any, and this backend's own
+    """
+    snapshots = []
+    try:
+        with open(AGENT_METRICS_PATH, 'r') as f:
+            snapshots.append(json.load(f))
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    snapshots.append(metrics.snapshot(process="backend"))
+    return snapshots
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Serve the metrics in the Prometheus text format
+    """
+    snapshots = await run_in_threadpool(collect_snapshots)
+    return PlainTextResponse(render_prometheus(snapshots), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/api/metrics")
+async def get_metrics_snapshot():
+    """
+    Serve the metrics as JSON snapshots, one per process
+    """
+    return await run_in_threadpool(collect_snapshots)
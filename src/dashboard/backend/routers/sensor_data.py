@@ -1,63 +1,249 @@
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
+from email.utils import formatdate, parsedate_to_datetime
+import hashlib
 import json
-from typing import List, Literal
+import sys
+import threading
+import time
+from typing import List, Literal, Optional
 import os
 
+# The file locking helpers live with the agents in src/, so that this backend and the
+# agent framework coordinate through one implementation
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from agents.json_store import DEFAULT_HOME, atomic_write, investigation_id, lock_for, update_json, version_of
+from agents.metrics import metrics
+
 router = APIRouter()
 
+# Upper bound on the page size a client can ask for
+MAX_LIMIT = 500
+DEFAULT_LIMIT = 50
+
 class SituationUpdate(BaseModel):
-    index: int
     estimate: Literal['normal', 'anomalous']
+    # Accepted for older clients and ignored: situations are addressed by id in the path
+    index: Optional[int] = None
 
 def get_memory_file_path():
     # Get the project root directory (4 levels up from this file)
     # src/dashboard/backend/routers -> src/
     current_dir = os.path.dirname(os.path.abspath(__file__))
     project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_dir))))
-    
+
     # Create data directory if it doesn't exist
     data_dir = os.path.join(project_root, 'data')
     os.makedirs(data_dir, exist_ok=True)
-    
+
     memory_path = os.path.join(data_dir, 'memory.json')
-    
+
     # Create empty memory.json if it doesn't exist
-    if not os.path.exists(memory_path):
-        with open(memory_path, 'w') as f:
-            json.dump([], f)
-    
+    with lock_for(memory_path):
+        if not os.path.exists(memory_path):
+            atomic_write(memory_path, lambda f: json.dump([], f))
+
     return memory_path
 
+# Resolved once; the file is (re)created here rather than on every request
+MEMORY_FILE_PATH = get_memory_file_path()
+
+
+class MemoryCache:
+    """
+    The parsed contents of memory.json, reloaded only when the file changes (see json_store.version_of).
+    Recently encoded responses are kept too, so repeated identical queries skip serialization.
+    """
+
+    MAX_RESPONSES = 32
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._signature = None
+        self._data: List[dict] = []
+        self._responses = {}
+
+    def snapshot(self):
+        """
+        Return the current investigations together with the file stat and version (see json_store.version_of)
+        they were read at. Blocking: call it from a worker thread.
+        """
+        with self._lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return [], None, None
+            if version_of(self.path) != self._signature:
+                # Shared with other readers, so the version read agrees with the contents
+                with lock_for(self.path).shared():
+                    signature = version_of(self.path)
+                    stat = os.stat(self.path)
+                    with open(self.path, 'r') as f:
+                        self._data = json.load(f)
+                for item in self._data:
+                    item.setdefault('id', investigation_id(item))
+                self._signature = signature
+                self._responses = {}
+            return self._data, stat, self._signature
+
+    def encoded(self, etag: str, build):
+        """
+        Return the match count and encoded body for an ETag, building and remembering them if needed
+        """
+        with self._lock:
+            response = self._responses.get(etag)
+        if response is not None:
+            metrics.count("cache_hits_total", cache="sensor_data_responses")
+        else:
+            metrics.count("cache_misses_total", cache="sensor_data_responses")
+            total, payload = build()
+            response = (total, json.dumps(payload).encode('utf-8'))
+            with self._lock:
+                if len(self._responses) >= self.MAX_RESPONSES:
+                    self._responses.pop(next(iter(self._responses)))
+                self._responses[etag] = response
+        return response
+
+
+memory_cache = MemoryCache(MEMORY_FILE_PATH)
+
+
+def matches(item: dict, start: Optional[int], end: Optional[int], estimate: Optional[str], home: Optional[str]) -> bool:
+    situation = item.get('situation', {})
+    if start is not None and situation.get('end_timestamp', 0) < start:
+        return False
+    if end is not None and situation.get('start_timestamp', 0) > end:
+        return False
+    if estimate is not None and item.get('estimate') != estimate:
+        return False
+    if home is not None and (item.get('home') or DEFAULT_HOME) != home:
+        return False
+    return True
+
+
+def summarize(item: dict) -> dict:
+    """
+    Project an investigation without the raw sensor events in situation.details
+    """
+    summary = dict(item)
+    summary['situation'] = {key: value for key, value in item.get('situation', {}).items() if key != 'details'}
+    return summary
+
+
+def not_modified(request: Request, etag: str, last_modified: float) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
 @router.get("/api/sensor-data")
-async def get_sensor_data():
+async def get_sensor_data(
+    request: Request,
+    start: Optional[int] = Query(None, description="Only situations ending at or after this unix timestamp"),
+    end: Optional[int] = Query(None, description="Only situations starting at or before this unix timestamp"),
+    estimate: Optional[Literal['normal', 'anomalous']] = None,
+    home: Optional[str] = None,
+    page: Optional[int] = Query(None, ge=1),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_LIMIT),
+    fields: Literal['full', 'summary'] = Query('full', description="'summary' leaves out situation.details"),
+):
+    """
+    Return investigations from memory.json, optionally filtered and paginated.
+    The body stays a plain list; with page or limit set, X-Total-Count carries the number of matches.
+    """
     try:
-        with open(get_memory_file_path(), 'r') as f:
-            data = json.load(f)
-        return JSONResponse(content=data)
+        data, stat, file_version = await run_in_threadpool(memory_cache.snapshot)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.put("/api/sensor-data/{index}")
-async def update_situation(index: int, update: SituationUpdate):
+    paginate = page is not None or limit is not None
+    page = page or 1
+    limit = limit or DEFAULT_LIMIT
+
+    # The file version plus the query identify the response; the version is the one the cache was
+    # loaded at, so a rewrite the modification time and size cannot tell apart still changes the ETag
+    version = "-".join(f"{part:x}" for part in file_version) if file_version else "empty"
+    query = json.dumps([start, end, estimate, home, paginate and page, paginate and limit, fields])
+    etag = f'"{version}-{hashlib.md5(query.encode("utf-8")).hexdigest()[:16]}"'
+    last_modified = stat.st_mtime if stat else 0
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(last_modified, usegmt=True),
+        "Cache-Control": "no-cache",
+    }
+
+    if not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    def build():
+        selected = [item for item in data if matches(item, start, end, estimate, home)]
+        total = len(selected)
+        if paginate:
+            offset = (page - 1) * limit
+            selected = selected[offset:offset + limit]
+        return total, [summarize(item) for item in selected] if fields == 'summary' else selected
+
+    total, body = await run_in_threadpool(memory_cache.encoded, etag, build)
+    headers["X-Total-Count"] = str(total)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@router.get("/api/sensor-data/{situation_id}")
+async def get_situation(situation_id: str):
+    """
+    Return one investigation in full, with the raw sensor events the stream leaves out
+    """
     try:
-        # Read current data
-        with open(get_memory_file_path(), 'r') as f:
-            data = json.load(f)
-        
-        # Validate index
-        if index >= len(data):
-            raise HTTPException(status_code=404, detail="Situation not found")
-        
-        # Update the estimate
-        data[index]['estimate'] = update.estimate
-        
-        # Write back to file
-        with open(get_memory_file_path(), 'w') as f:
-            json.dump(data, f, indent=2)
-        
-        return {"message": "Successfully updated", "data": data[index]}
+        data, _, _ = await run_in_threadpool(memory_cache.snapshot)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    for item in data:
+        if item['id'] == situation_id:
+            return item
+    raise HTTPException(status_code=404, detail="Situation not found")
+
+
+def relabel(situation_id: str, estimate: str) -> Optional[dict]:
+    """
+    Set the estimate of one investigation in memory.json. Relabels arriving together are
+    committed in one rewrite of the file (see json_store.GroupCommit).
+    Blocking: call it from a worker thread.
+    :return: the updated investigation, or None if there is no investigation with that id
+    """
+    reviewed_at = int(time.time())
+
+    def update(data):
+        for item in data:
+            if item.setdefault('id', investigation_id(item)) == situation_id:
+                item['estimate'] = estimate
+                # Marks the investigation as human labelled, for retraining to learn from
+                item['reviewed_at'] = reviewed_at
+                return item
+        return None
+
+    return update_json(MEMORY_FILE_PATH, update, default=[])
+
+
+@router.put("/api/sensor-data/{situation_id}")
+async def update_situation(situation_id: str, update: SituationUpdate):
+    try:
+        item = await run_in_threadpool(relabel, situation_id, update.estimate)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if item is None:
+        raise HTTPException(status_code=404, detail="Situation not found")
 
+    return {"message": "Successfully updated", "data": item}
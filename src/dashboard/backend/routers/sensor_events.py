@@ -0,0 +1,135 @@
+from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect
+from starlette.concurrency import run_in_threadpool
+from typing import Dict, List, Optional, Set
+import asyncio
+
+from databutton_app.mw.auth_mw import User, get_authorized_user
+from routers.sensor_data import memory_cache
+
+router = APIRouter()
+
+# How often memory.json is checked for changes; a check is a stat() unless the file changed
+POLL_INTERVAL_SECONDS = 0.5
+
+# Events a slow client may fall behind by before it is disconnected and has to resync
+SUBSCRIBER_QUEUE_SIZE = 256
+
+
+def compact(item: dict) -> dict:
+    """
+    The fields of an investigation a dashboard lists; the raw sensor events are left out,
+    for a client to fetch from GET /api/sensor-data/{id} when it shows them
+    """
+    situation = item.get('situation', {})
+    return {
+        "id": item['id'],
+        "home": item.get('home'),
+        "estimate": item.get('estimate'),
+        "situation_description": situation.get('situation_description'),
+        "result": situation.get('result'),
+        "start_timestamp": situation.get('start_timestamp'),
+        "end_timestamp": situation.get('end_timestamp'),
+    }
+
+
+def diff_investigations(previous: Dict[str, dict], current: Dict[str, dict]) -> List[dict]:
+    """
+    Describe how the investigations changed as a list of compact events
+    """
+    events = []
+    for situation_id, item in current.items():
+        before = previous.get(situation_id)
+        if before is None:
+            events.append({"type": "investigation.created", "investigation": compact(item)})
+            if item.get('estimate') == 'anomalous':
+                events.append({"type": "alert", "investigation": compact(item)})
+        elif before.get('estimate') != item.get('estimate'):
+            events.append({"type": "investigation.relabelled", "id": situation_id, "estimate": item.get('estimate')})
+    for situation_id in previous.keys() - current.keys():
+        events.append({"type": "investigation.removed", "id": situation_id})
+    return events
+
+
+class InvestigationBroadcaster:
+    """
+    Watches memory.json while anybody is subscribed and pushes what changed to every subscriber.
+    Changes made by the agent framework and by relabels through this API are picked up alike.
+    """
+
+    def __init__(self):
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self._subscribers.add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._watch())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, event: dict):
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Drop the laggard; None tells its connection to close so the client reloads
+                self._subscribers.discard(queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
+
+    async def _watch(self):
+        # Until the first successful read there is nothing to diff against, and nothing is published
+        data, known = None, None
+        while self._subscribers:
+            try:
+                current_data, _, _ = await run_in_threadpool(memory_cache.snapshot)
+            except Exception as e:
+                # Missing or being replaced: try again on the next tick rather than leave the subscribers waiting
+                print(f"Failed to read investigations: {e}")
+            else:
+                if current_data is not data:
+                    data = current_data
+                    current = {item['id']: item for item in data}
+                    if known is not None:
+                        for event in diff_investigations(known, current):
+                            self.publish(event)
+                    known = current
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
+
+
+broadcaster = InvestigationBroadcaster()
+
+
+def get_stream_user(websocket: WebSocket) -> Optional[User]:
+    # Without an auth config (local development) the stream is as open as the REST routes
+    if getattr(websocket.app.state, "auth_config", None) is None:
+        return None
+    return get_authorized_user(websocket)
+
+
+@router.websocket("/api/sensor-data/stream")
+async def stream_sensor_data(websocket: WebSocket, user: Optional[User] = Depends(get_stream_user)):
+    """
+    Push investigation.created, investigation.relabelled, investigation.removed and alert events as they happen
+    """
+    # Browsers require the server to pick one of the offered protocols; prefer one that is not the bearer token
+    protocols = [p.strip() for p in websocket.headers.get("Sec-Websocket-Protocol", "").split(",") if p.strip()]
+    plain = [p for p in protocols if not p.startswith("Authorization.Bearer.")]
+    await websocket.accept(subprotocol=(plain or protocols or [None])[0])
+
+    queue = broadcaster.subscribe()
+    try:
+        await websocket.send_json({"type": "hello"})
+        while True:
+            event = await queue.get()
+            if event is None:
+                await websocket.close(code=1013, reason="Too far behind, reload")
+                break
+            await websocket.send_json(event)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        broadcaster.unsubscribe(queue)
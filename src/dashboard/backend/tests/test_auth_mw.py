@@ -0,0 +1,168 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+
+from databutton_app.mw import auth_mw
+from databutton_app.mw.auth_mw import AuthConfig, JWKSCache, VerifiedTokenCache, authorize_token
+
+AUDIENCE = "care-dashboard"
+
+
+def make_key(kid):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update(kid=kid, use="sig", alg="RS256")
+    return private_key, jwk
+
+
+class JWKSStub:
+    """
+    A local JWKS endpoint serving whichever keys the test sets, counting the fetches
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.fetches = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.fetches += 1
+                body = json.dumps({"keys": stub.keys}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/.well-known/jwks.json"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture(scope="module")
+def keys():
+    return {kid: make_key(kid) for kid in ("key-1", "key-2")}
+
+
+@pytest.fixture
+def stub(keys):
+    stub = JWKSStub()
+    stub.keys = [keys["key-1"][1]]
+    yield stub
+    stub.close()
+
+
+@pytest.fixture(autouse=True)
+def fresh_caches(monkeypatch):
+    auth_mw.get_jwks_client.cache_clear()
+    monkeypatch.setattr(auth_mw, "verified_tokens", VerifiedTokenCache())
+    yield
+    auth_mw.get_jwks_client.cache_clear()
+
+
+def sign(keys, kid, audience=AUDIENCE, expires_in=600, sub="user-1"):
+    claims = {"sub": sub, "aud": audience, "exp": int(time.time()) + expires_in}
+    return jwt.encode(claims, keys[kid][0], algorithm="RS256", headers={"kid": kid})
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_known_keys_are_served_from_memory_within_the_ttl(stub):
+    cache = JWKSCache(stub.url, ttl=60)
+    first = cache.get_signing_key("key-1")
+    assert cache.get_signing_key("key-1") is first
+    assert stub.fetches == 1
+
+
+def test_expired_keys_are_served_while_refreshed_in_the_background(stub, keys):
+    cache = JWKSCache(stub.url, ttl=0.05)
+    cache.get_signing_key("key-1")
+    # The endpoint rotates in a second key, which only a refresh can pick up
+    stub.keys = [keys["key-1"][1], keys["key-2"][1]]
+    time.sleep(0.1)
+
+    started = time.monotonic()
+    assert cache.get_signing_key("key-1").key_id == "key-1"
+    assert time.monotonic() - started < 0.05
+    assert wait_for(lambda: "key-2" in cache._keys)
+    assert stub.fetches == 2
+
+
+def test_unknown_kids_fetch_at_most_once_per_interval(stub, keys):
+    cache = JWKSCache(stub.url, ttl=60, min_refetch=60)
+    cache.get_signing_key("key-1")
+    for _ in range(5):
+        with pytest.raises(jwt.PyJWKClientError):
+            cache.get_signing_key("unknown")
+    # Only the first lookup fetched; every unknown kid after it waits out min_refetch
+    assert stub.fetches == 1
+
+    stub.keys = [keys["key-1"][1], keys["key-2"][1]]
+    cache.min_refetch = 0
+    assert cache.get_signing_key("key-2").key_id == "key-2"
+    assert stub.fetches == 2
+
+
+def test_a_verified_token_skips_signature_verification(stub, keys, monkeypatch):
+    config = AuthConfig(jwks_url=stub.url, audience=AUDIENCE, header="authorization")
+    token = sign(keys, "key-1")
+    decodes = []
+    decode = jwt.decode
+    monkeypatch.setattr(auth_mw.jwt, "decode", lambda *args, **kwargs: decodes.append(1) or decode(*args, **kwargs))
+
+    assert authorize_token(token, config).sub == "user-1"
+    assert authorize_token(token, config).sub == "user-1"
+    assert len(decodes) == 1
+    assert stub.fetches == 1
+
+
+def test_verified_tokens_are_evicted_at_exp(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(auth_mw.time, "time", lambda: now[0])
+    cache = VerifiedTokenCache(max_age=300)
+    cache.put("token", AUDIENCE, {"sub": "user-1", "exp": now[0] + 10})
+
+    now[0] += 9
+    assert cache.get("token", AUDIENCE) == {"sub": "user-1", "exp": 1_000_010.0}
+    now[0] += 1
+    assert cache.get("token", AUDIENCE) is None
+    assert len(cache._entries) == 0
+
+
+def test_verified_tokens_are_bounded_by_max_age(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(auth_mw.time, "time", lambda: now[0])
+    cache = VerifiedTokenCache(max_age=60)
+    cache.put("token", AUDIENCE, {"sub": "user-1", "exp": now[0] + 3600})
+    now[0] += 60
+    assert cache.get("token", AUDIENCE) is None
+
+
+def test_a_token_verified_for_one_audience_is_not_a_hit_for_another(stub, keys):
+    token = sign(keys, "key-1")
+    assert authorize_token(token, AuthConfig(jwks_url=stub.url, audience=AUDIENCE, header="authorization")) is not None
+    assert auth_mw.verified_tokens.get(token, AUDIENCE) is not None
+    assert auth_mw.verified_tokens.get(token, "other-app") is None
+    # Verified afresh for the other audience, where the aud claim fails
+    assert authorize_token(token, AuthConfig(jwks_url=stub.url, audience="other-app", header="authorization")) is None
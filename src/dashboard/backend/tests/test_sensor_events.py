@@ -0,0 +1,72 @@
+import asyncio
+
+from routers import sensor_events
+from routers.sensor_events import InvestigationBroadcaster, diff_investigations
+
+
+def investigation(id, estimate="normal"):
+    return {
+        "id": id,
+        "home": "home",
+        "estimate": estimate,
+        "situation": {
+            "situation_description": f"situation {id}",
+            "result": estimate,
+            "start_timestamp": 1000,
+            "end_timestamp": 1059,
+            "details": ['{"timestamp": 1000, "room": "kitchen"}'] * 50,
+        },
+    }
+
+
+def test_created_events_leave_out_the_sensor_events():
+    created = investigation("a", "anomalous")
+    # The scanner's result and the final estimate can differ; both are listed
+    created["situation"]["result"] = "normal"
+    events = diff_investigations({}, {"a": created})
+    assert [event["type"] for event in events] == ["investigation.created", "alert"]
+    for event in events:
+        assert event["investigation"] == {
+            "id": "a",
+            "home": "home",
+            "estimate": "anomalous",
+            "situation_description": "situation a",
+            "result": "normal",
+            "start_timestamp": 1000,
+            "end_timestamp": 1059,
+        }
+
+
+def test_relabels_and_removals():
+    previous = {"a": investigation("a"), "b": investigation("b")}
+    events = diff_investigations(previous, {"a": investigation("a", "anomalous")})
+    assert events == [
+        {"type": "investigation.relabelled", "id": "a", "estimate": "anomalous"},
+        {"type": "investigation.removed", "id": "b"},
+    ]
+
+
+def test_the_watcher_outlives_failed_reads(monkeypatch):
+    snapshots = [FileNotFoundError("memory.json"), [investigation("a")], OSError("mid-rotation"),
+                 [investigation("a"), investigation("b")]]
+
+    def snapshot():
+        result = snapshots.pop(0) if len(snapshots) > 1 else snapshots[0]
+        if isinstance(result, Exception):
+            raise result
+        return result, None, None
+
+    monkeypatch.setattr(sensor_events.memory_cache, "snapshot", snapshot)
+    monkeypatch.setattr(sensor_events, "POLL_INTERVAL_SECONDS", 0.01)
+
+    async def run():
+        broadcaster = InvestigationBroadcaster()
+        queue = broadcaster.subscribe()
+        event = await asyncio.wait_for(queue.get(), timeout=5)
+        broadcaster.unsubscribe(queue)
+        await asyncio.wait_for(broadcaster._task, timeout=5)
+        return event
+
+    event = asyncio.run(run())
+    assert event["type"] == "investigation.created"
+    assert event["investigation"]["id"] == "b"
@@ -1,4 +1,4 @@
-export const updateAnomalyStatus = async (id: number, status: string) => {
+export const updateAnomalyStatus = async (id: string, status: string) => {
   const response = await fetch(`/api/sensor-data/${id}`, {
     method: 'PUT',
     headers: {
@@ -1,4 +1,4 @@
-import { useState, useEffect, useCallback } from 'react';
+import { useState, useEffect, useCallback, useRef } from 'react';
 
 // Define types for our sensor data
 export interface SensorDetail {
@@ -43,6 +43,7 @@ export interface AnomalyLog {
 }
 
 export interface SensorDataItem {
+  id: string; // Stable id used to address the situation in the API
   situation: Situation;
   estimate: 'normal' | 'anomalous';
   anomalyId?: string; // Reference to an anomaly log if this is anomalous
@@ -63,11 +64,58 @@ const extractRoomFromDetails = (details: string[]): string => {
   }
 };
 
+// Transform a memory.json item into SensorDataItem format
+const toSensorDataItem = (item: any): SensorDataItem => ({
+  id: item.id,
+  situation: {
+    situation_description: item.situation.situation_description,
+    result: item.situation.result,
+    start_timestamp: item.situation.start_timestamp,
+    end_timestamp: item.situation.end_timestamp,
+    details: item.situation.details
+  },
+  estimate: item.estimate,  // Use the estimate field directly from the data
+  anomalyId: item.estimate === 'anomalous' ? generateId() : undefined
+});
+
+// Create an anomaly log for a situation marked as anomalous in the estimate field
+const toAnomalyLog = (item: SensorDataItem): AnomalyLog => ({
+  id: item.anomalyId!,
+  timestamp: item.situation.end_timestamp,
+  description: item.situation.situation_description,
+  severityLevel: 'medium',
+  reviewStatus: 'pending',
+  relatedSensors: [],
+  roomLocation: extractRoomFromDetails(item.situation.details),
+  detectionConfidence: 75,
+  situationId: generateId(),
+  estimate: item.estimate,
+  situation: {  // Make sure we're including the full situation
+    situation_description: item.situation.situation_description,
+    result: item.situation.result,
+    start_timestamp: item.situation.start_timestamp,
+    end_timestamp: item.situation.end_timestamp,
+    details: item.situation.details
+  }
+});
+
+// Changes are pushed over this stream; polling is only a fallback while it is down
+const STREAM_PATH = '/api/sensor-data/stream';
+const FALLBACK_POLL_INTERVAL = 10000;
+const MAX_RECONNECT_DELAY = 30000;
+
 export const useSensorData = () => {
   const [data, setData] = useState<SensorDataItem[]>([]);
   const [anomalyLogs, setAnomalyLogs] = useState<AnomalyLog[]>([]);
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState<Error | null>(null);
+  const itemsRef = useRef<SensorDataItem[]>([]);
+
+  const publish = useCallback((items: SensorDataItem[]) => {
+    itemsRef.current = items;
+    setData(items);
+    setAnomalyLogs(items.filter(item => item.estimate === 'anomalous').map(toAnomalyLog));
+  }, []);
 
   const loadData = useCallback(async () => {
     try {
@@ -75,51 +123,61 @@ export const useSensorData = () => {
       if (!response.ok) throw new Error('Failed to fetch sensor data');
       
       const memoryData = await response.json();
-      
-      // Transform memory data into SensorDataItem format
-      const transformedData: SensorDataItem[] = memoryData.map((item: any) => ({
-        situation: {
-          situation_description: item.situation.situation_description,
-          result: item.situation.result,
-          start_timestamp: item.situation.start_timestamp,
-          end_timestamp: item.situation.end_timestamp,
-          details: item.situation.details
-        },
-        estimate: item.estimate,  // Use the estimate field directly from the data
-        anomalyId: item.estimate === 'anomalous' ? generateId() : undefined
-      }));
-
-      // Create anomaly logs only for situations marked as anomalous in the estimate field
-      const newAnomalyLogs: AnomalyLog[] = transformedData
-        .filter(item => item.estimate === 'anomalous')
-        .map(item => ({
-          id: item.anomalyId!,
-          timestamp: item.situation.end_timestamp,
-          description: item.situation.situation_description,
-          severityLevel: 'medium',
-          reviewStatus: 'pending',
-          relatedSensors: [],
-          roomLocation: extractRoomFromDetails(item.situation.details),
-          detectionConfidence: 75,
-          situationId: generateId(),
-          estimate: item.estimate,
-          situation: {  // Make sure we're including the full situation
-            situation_description: item.situation.situation_description,
-            result: item.situation.result,
-            start_timestamp: item.situation.start_timestamp,
-            end_timestamp: item.situation.end_timestamp,
-            details: item.situation.details
-          }
-        }));
-
-      setData(transformedData);
-      setAnomalyLogs(newAnomalyLogs);
+      publish(memoryData.map(toSensorDataItem));
       setLoading(false);
     } catch (err) {
       setError(err instanceof Error ? err : new Error('Unknown error occurred'));
       setLoading(false);
     }
-  }, []);
+  }, [publish]);
+
+  // Apply one event from the stream to the current items
+  const applyEvent = useCallback((event: any) => {
+    const items = itemsRef.current;
+    switch (event.type) {
+      case 'investigation.created': {
+        // The stream sends the listed fields only; the sensor events follow from the REST API
+        const created = event.investigation;
+        publish([...items.filter(item => item.id !== created.id), toSensorDataItem({
+          id: created.id,
+          estimate: created.estimate,
+          situation: {
+            situation_description: created.situation_description,
+            result: created.result,
+            start_timestamp: created.start_timestamp,
+            end_timestamp: created.end_timestamp,
+            details: []
+          }
+        })]);
+        fetch(`/api/sensor-data/${created.id}`)
+          .then(response => response.ok ? response.json() : null)
+          .then(full => {
+            if (!full) return;
+            const current = itemsRef.current.find(item => item.id === full.id);
+            if (!current) return;
+            const loaded = toSensorDataItem(full);
+            publish(itemsRef.current.map(item => item.id !== full.id ? item : {
+              ...loaded,
+              // A relabel may have arrived while the events were loading
+              estimate: current.estimate,
+              anomalyId: current.estimate === 'anomalous' ? current.anomalyId || loaded.anomalyId || generateId() : undefined
+            }));
+          })
+          .catch(err => console.error('Failed to load investigation details:', err));
+        break;
+      }
+      case 'investigation.relabelled':
+        publish(items.map(item => item.id !== event.id ? item : {
+          ...item,
+          estimate: event.estimate,
+          anomalyId: event.estimate === 'anomalous' ? item.anomalyId || generateId() : undefined
+        }));
+        break;
+      case 'investigation.removed':
+        publish(items.filter(item => item.id !== event.id));
+        break;
+    }
+  }, [publish]);
 
   const updateAnomalyStatus = useCallback(async (anomalyId: string, status: 'normal' | 'anomalous', notes?: string) => {
     try {
@@ -128,42 +186,88 @@ export const useSensorData = () => {
       if (!anomalyLog) throw new Error('Anomaly not found');
 
       // Find the matching situation by timestamp
-      const situationIndex = data.findIndex(item => 
+      const situation = data.find(item => 
         item.situation.start_timestamp === anomalyLog.situation.start_timestamp &&
         item.situation.end_timestamp === anomalyLog.situation.end_timestamp
       );
       
-      if (situationIndex === -1) throw new Error('Situation not found');
+      if (!situation) throw new Error('Situation not found');
 
       // Update the backend
-      const response = await fetch(`/api/sensor-data/${situationIndex}`, {
+      const response = await fetch(`/api/sensor-data/${situation.id}`, {
         method: 'PUT',
         headers: {
           'Content-Type': 'application/json',
         },
         body: JSON.stringify({
-          index: situationIndex,
           estimate: status
         })
       });
 
       if (!response.ok) throw new Error('Failed to update situation');
 
-      // Immediately reload the data after update
-      await loadData();
+      // Apply the change right away; the stream confirms it to every other dashboard
+      applyEvent({ type: 'investigation.relabelled', id: situation.id, estimate: status });
 
     } catch (error) {
       console.error('Error updating anomaly status:', error);
       throw error;
     }
-  }, [data, anomalyLogs, loadData]);
+  }, [data, anomalyLogs, applyEvent]);
 
   useEffect(() => {
+    let socket: WebSocket | null = null;
+    let pollId: ReturnType<typeof setInterval> | null = null;
+    let reconnectId: ReturnType<typeof setTimeout> | null = null;
+    let reconnectDelay = 1000;
+    let missedEvents = false;
+    let stopped = false;
+
+    const startPolling = () => {
+      if (pollId === null) pollId = setInterval(loadData, FALLBACK_POLL_INTERVAL);
+    };
+
+    const stopPolling = () => {
+      if (pollId !== null) clearInterval(pollId);
+      pollId = null;
+    };
+
+    const connect = () => {
+      const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+      socket = new WebSocket(`${protocol}//${window.location.host}${STREAM_PATH}`);
+
+      socket.onmessage = (message) => {
+        const event = JSON.parse(message.data);
+        if (event.type === 'hello') {
+          // Catch up on anything that changed while disconnected, then rely on the stream
+          reconnectDelay = 1000;
+          stopPolling();
+          if (missedEvents) loadData();
+          missedEvents = false;
+        } else {
+          applyEvent(event);
+        }
+      };
+
+      socket.onclose = () => {
+        if (stopped) return;
+        missedEvents = true;
+        startPolling();
+        reconnectId = setTimeout(connect, reconnectDelay);
+        reconnectDelay = Math.min(reconnectDelay * 2, MAX_RECONNECT_DELAY);
+      };
+    };
+
     loadData();
-    
-    const intervalId = setInterval(loadData, 10000);
-    return () => clearInterval(intervalId);
-  }, [loadData]);
+    connect();
+
+    return () => {
+      stopped = true;
+      stopPolling();
+      if (reconnectId !== null) clearTimeout(reconnectId);
+      socket?.close();
+    };
+  }, [loadData, applyEvent]);
 
   return { 
     data, 
@@ -74,6 +74,7 @@ export default defineConfig({
 				target: 'http://localhost:8080',
 				changeOrigin: true,
 				secure: false,
+				ws: true,
 			}
 		}
 	},
@@ -1,3 +1,11 @@
+import json
+import logging
+import os
+import re
+import threading
+from collections import deque
+from typing import List, Optional
+
 # Foreground colors
 RED = '\033[31m'
 GREEN = '\033[32m'
@@ -25,10 +33,187 @@ mapper = {
     BG_BLUE+WHITE: "#ff7800"
 }
 
+# Every color code maps to an opening span and RESET closes it, so a single
+# precompiled pattern converts a message in one pass
+_REPLACEMENTS = {key: f'<span style="color: {value}">' for key, value in mapper.items()}
+_REPLACEMENTS[RESET] = '</span>'
+_ANSI_PATTERN = re.compile('|'.join(re.escape(code) for code in sorted(_REPLACEMENTS, key=len, reverse=True)))
+
 
 def reformat(message):
-    for key, value in mapper.items():
-        message = message.replace(key, f'<span style="color: {value}">')
-    message = message.replace(RESET, '</span>')
-    return message
-    
\ No newline at end of file
+    return _ANSI_PATTERN.sub(lambda match: _REPLACEMENTS[match.group(0)], message)
+
+
+# Any color code, for renderers that want plain text
+_ANY_ANSI_PATTERN = re.compile(r'\033\[[0-9;]*m')
+
+
+def render_fields(fields: dict) -> str:
+    return " ".join(f"{key}={value}" for key, value in fields.items())
+
+
+class ColorFormatter(logging.Formatter):
+    """
+    Renders records logged by agents, which carry agent, color, event and fields attributes,
+    as '[Agent Name] message key=value ...' in the agent's color. Other records render as usual.
+    """
+
+    def __init__(self, fmt: Optional[str] = None, datefmt: Optional[str] = None, color: bool = True):
+        super().__init__(fmt, datefmt)
+        self.color = color
+
+    def formatMessage(self, record):
+        agent = getattr(record, 'agent', None)
+        if agent is not None:
+            text = f"[{agent}] {record.message}"
+            fields = getattr(record, 'fields', None)
+            if fields:
+                text += " " + render_fields(fields)
+            if self.color and getattr(record, 'color', None):
+                text = record.color + text + RESET
+            record.message = text
+        return super().formatMessage(record)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Renders each record as one JSON object per line, with the agent, event and fields as keys
+    """
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "agent": getattr(record, 'agent', None),
+            "event": getattr(record, 'event', None),
+            "message": _ANY_ANSI_PATTERN.sub('', record.getMessage()),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def make_formatter(fmt: Optional[str] = None, datefmt: Optional[str] = None) -> logging.Formatter:
+    """
+    Return the renderer chosen by the LOG_FORMAT environment variable: 'json' for JSON lines,
+    'plain' for text without colors, anything else for colored text
+    """
+    log_format = os.getenv('LOG_FORMAT', 'color').lower()
+    if log_format == 'json':
+        return JsonLinesFormatter()
+    return ColorFormatter(fmt, datefmt, color=log_format != 'plain')
+
+
+class LogSubscription:
+    """
+    A bounded ring buffer of rendered log lines for a single listener.
+    When the listener falls behind, the oldest lines are dropped.
+    """
+
+    def __init__(self, bus: 'LogBus', capacity: int):
+        self._bus = bus
+        self._lines = deque(maxlen=capacity)
+        self._condition = threading.Condition()
+        self._woken = False
+
+    def put(self, line: str):
+        with self._condition:
+            self._lines.append(line)
+            self._condition.notify()
+
+    def wake(self):
+        """
+        Release a listener blocked in get() even if no line has arrived
+        """
+        with self._condition:
+            self._woken = True
+            self._condition.notify_all()
+
+    def get(self, timeout: Optional[float] = None) -> List[str]:
+        """
+        Block until a line is available (or wake() is called), then drain the buffer
+        :param timeout: the longest to wait in seconds, None to wait indefinitely
+        :return: the lines received since the last call, oldest first
+        """
+        with self._condition:
+            if not self._lines and not self._woken:
+                self._condition.wait(timeout)
+            self._woken = False
+            return self._drain()
+
+    def drain(self) -> List[str]:
+        """
+        Return whatever lines are buffered without waiting
+        """
+        with self._condition:
+            return self._drain()
+
+    def _drain(self) -> List[str]:
+        lines = list(self._lines)
+        self._lines.clear()
+        return lines
+
+    def close(self):
+        self._bus.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class LogBus(logging.Handler):
+    """
+    A logging handler that broadcasts each record to every subscriber.
+    Records are formatted and converted to HTML once, and only while somebody is listening.
+    """
+
+    def __init__(self, capacity: int = 100):
+        super().__init__()
+        self.capacity = capacity
+        self._subscribers = ()
+        self._subscribers_lock = threading.Lock()
+
+    def subscribe(self, capacity: Optional[int] = None) -> LogSubscription:
+        subscription = LogSubscription(self, capacity or self.capacity)
+        with self._subscribers_lock:
+            self._subscribers = self._subscribers + (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription: LogSubscription):
+        with self._subscribers_lock:
+            self._subscribers = tuple(s for s in self._subscribers if s is not subscription)
+
+    def emit(self, record):
+        # Read the tuple once; subscribe/unsubscribe replace it rather than mutate it
+        subscribers = self._subscribers
+        if not subscribers:
+            return
+        try:
+            line = reformat(self.format(record))
+        except Exception:
+            self.handleError(record)
+            return
+        for subscription in subscribers:
+            subscription.put(line)
+
+
+_log_bus = None
+_log_bus_lock = threading.Lock()
+
+
+def get_log_bus(formatter: Optional[logging.Formatter] = None) -> LogBus:
+    """
+    Return the process-wide LogBus, attaching it to the root logger the first time
+    """
+    global _log_bus
+    with _log_bus_lock:
+        if _log_bus is None:
+            _log_bus = LogBus()
+            if formatter:
+                _log_bus.setFormatter(formatter)
+            logging.getLogger().addHandler(_log_bus)
+        return _log_bus
@@ -0,0 +1,328 @@
+"""
+Retrain the Random Forest and TabPFN models from the curated training data plus every
+investigation a person has reviewed in the UI or dashboard, and publish the models that
+validate at least as well as the current ones to the model registry, from where the agents pick them up.
+
+Run once with `python retraining.py --once`, or leave it running to retrain on a schedule.
+"""
+
+import argparse
+import copy
+import importlib.util
+import json
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.feature_extraction import DictVectorizer
+from sklearn.metrics import accuracy_score, roc_auc_score
+from sklearn.preprocessing import StandardScaler
+
+from agents.features import prepare_features, prepare_tabular_data
+from agents.json_store import investigation_id
+from agents.model_registry import ModelRegistry
+from log_utils import make_formatter
+
+# Colors for logging
+BG_GREEN = '\033[42m'
+WHITE = '\033[37m'
+
+ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Curated examples every model is trained on, in the data directory
+TRAINING_FILES = ['training_data.json']
+MEMORY_FILE = 'memory.json'
+
+# Percentage of examples held out for validation, chosen by id so the split is the same on every run
+HOLDOUT_PERCENT = 20
+# A candidate is published unless it scores more than this below the current model on the hold-out set
+TOLERANCE = 0.02
+# Retrain on schedule only once this many reviews have come in since the last published model
+MIN_NEW_REVIEWS = 1
+DEFAULT_INTERVAL_SECONDS = 6 * 60 * 60
+
+# Trees added per incremental Random Forest update, and the size at which it is rebuilt from scratch
+RF_TREES = 100
+RF_INCREMENT_TREES = 25
+RF_MAX_TREES = 400
+
+
+def log(message: str, event: Optional[str] = None, **fields):
+    logging.info(message, extra={"agent": "Retraining", "color": BG_GREEN + WHITE, "event": event, "fields": fields})
+
+
+class Example(NamedTuple):
+    """
+    A labelled window of sensor events, shaped like a Situation as far as the feature extraction is concerned
+    """
+    id: str
+    details: List[Any]
+    result: str
+    reviewed_at: Optional[int] = None
+
+
+def collect_examples(data_dir: str, training_files: List[str] = TRAINING_FILES) -> List[Example]:
+    """
+    Gather the curated examples and the reviewed investigations, labelled by their human-confirmed estimate.
+    A reviewed investigation replaces a curated example for the same window.
+    """
+    examples = {}
+    for filename in training_files:
+        with open(os.path.join(data_dir, filename), 'r') as file:
+            for record in json.load(file):
+                situation = record['situation']
+                examples[investigation_id(record)] = Example(investigation_id(record), situation['details'], situation['result'])
+
+    memory_path = os.path.join(data_dir, MEMORY_FILE)
+    if os.path.exists(memory_path):
+        with open(memory_path, 'r') as file:
+            contents = file.read()
+        for record in json.loads(contents) if contents.strip() else []:
+            if record.get('reviewed_at'):
+                situation_id = record.get('id') or investigation_id(record)
+                examples[situation_id] = Example(situation_id, record['situation']['details'], record['estimate'], record['reviewed_at'])
+    return list(examples.values())
+
+
+def split_holdout(examples: List[Example]) -> Tuple[List[Example], List[Example]]:
+    """
+    Split examples into training and hold-out sets by id. An example stays on the same side
+    across runs, so a model is never validated on examples an earlier version was trained on.
+    """
+    train, holdout = [], []
+    for example in examples:
+        (holdout if int(example.id[:8], 16) % 100 < HOLDOUT_PERCENT else train).append(example)
+    return train, holdout
+
+
+def labels(examples: List[Example]) -> np.ndarray:
+    return np.array([1 if example.result == 'anomalous' else 0 for example in examples])
+
+
+def validate(predict_proba: Callable[[List[Example]], np.ndarray], holdout: List[Example]) -> Dict[str, float]:
+    """
+    Score a model on the hold-out set
+    :param predict_proba: returns the probability of 'anomalous' for each example
+    """
+    y = labels(holdout)
+    probabilities = predict_proba(holdout)
+    metrics = {"accuracy": float(accuracy_score(y, probabilities >= 0.5)), "holdout": len(holdout)}
+    if len(set(y)) == 2:
+        metrics["roc_auc"] = float(roc_auc_score(y, probabilities))
+    return metrics
+
+
+class ModelTrainer:
+    """
+    Trains one family of models and knows how to predict with the artifacts it produces
+    """
+
+    name: str = ""
+    legacy_file: str = ""
+
+    def available(self) -> bool:
+        """
+        Whether the libraries this model needs are installed
+        """
+        return True
+
+    def train(self, examples: List[Example], previous: Optional[Any]) -> Tuple[Any, bool]:
+        """
+        Fit a new artifact
+        :param previous: the current artifact, to update incrementally where the model allows
+        :return: the artifact, and whether it was updated incrementally
+        """
+        raise NotImplementedError
+
+    def predict_proba(self, artifact: Any, examples: List[Example]) -> np.ndarray:
+        raise NotImplementedError
+
+
+class RandomForestTrainer(ModelTrainer):
+    """
+    A DictVectorizer, StandardScaler and RandomForestClassifier, as in the original training notebook.
+    As long as no new features appear, the current forest is kept and grown with extra trees fitted
+    on all examples, rather than being rebuilt.
+    """
+
+    name = 'random_forest'
+    legacy_file = 'random_forest_model.pkl'
+
+    def train(self, examples, previous):
+        features = [prepare_features(example) for example in examples]
+        y = labels(examples)
+        if previous is not None:
+            model, scaler, vec = copy.deepcopy(previous)
+            known = set(vec.feature_names_)
+            incremental = (isinstance(model, RandomForestClassifier)
+                           and all(key in known for row in features for key in row)
+                           and model.n_estimators + RF_INCREMENT_TREES <= RF_MAX_TREES)
+            if incremental:
+                model.set_params(warm_start=True, n_estimators=model.n_estimators + RF_INCREMENT_TREES, n_jobs=-1)
+                model.fit(scaler.transform(vec.transform(features)), y)
+                return (model, scaler, vec), True
+
+        vec = DictVectorizer(sparse=False)
+        scaler = StandardScaler()
+        X = scaler.fit_transform(vec.fit_transform(features))
+        model = RandomForestClassifier(n_estimators=RF_TREES, random_state=42, n_jobs=-1)
+        model.fit(X, y)
+        return (model, scaler, vec), False
+
+    def predict_proba(self, artifact, examples):
+        model, scaler, vec = artifact
+        X = scaler.transform(vec.transform([prepare_features(example) for example in examples]))
+        return model.predict_proba(X)[:, list(model.classes_).index(1)]
+
+
+class TabPFNTrainer(ModelTrainer):
+    """
+    TabPFN learns in context from the examples it is fitted with, so there is nothing to update
+    incrementally: every run refits on all examples.
+    """
+
+    name = 'tabpfn'
+    legacy_file = 'tabpfn_model.pkl'
+
+    def available(self):
+        return importlib.util.find_spec('tabpfn') is not None
+
+    def train(self, examples, previous):
+        from tabpfn import TabPFNClassifier
+
+        df = prepare_tabular_data(examples)
+        X = df.drop(columns=['result'], errors='ignore')
+        model = TabPFNClassifier()
+        model.fit(X, labels(examples))
+        return (model, list(X.columns)), False
+
+    def predict_proba(self, artifact, examples):
+        model, feature_names = artifact
+        X = prepare_tabular_data(examples, feature_names)
+        return model.predict_proba(X)[:, list(model.classes_).index(1)]
+
+
+class Retrainer:
+    """
+    Retrains every model family side by side and publishes the candidates that pass validation
+    """
+
+    def __init__(self, data_dir: str, training_files: List[str] = TRAINING_FILES,
+                 trainers: Optional[List[ModelTrainer]] = None):
+        self.data_dir = data_dir
+        self.training_files = training_files
+        self.registry = ModelRegistry(data_dir)
+        self.trainers = [trainer for trainer in trainers or [RandomForestTrainer(), TabPFNTrainer()] if trainer.available()]
+
+    def new_reviews(self, examples: List[Example]) -> int:
+        """
+        Count the reviews that some model has not been trained on yet
+        """
+        reviewed_through = min((self.registry.current(trainer.name) or {}).get("reviewed_through", 0)
+                               for trainer in self.trainers)
+        return sum(1 for example in examples if (example.reviewed_at or 0) > reviewed_through)
+
+    def run(self, force: bool = False) -> Dict[str, Optional[int]]:
+        """
+        Retrain and validate every model, publishing those that pass
+        :param force: retrain even if nothing has been reviewed since the last run
+        :return: the published version per model, or None where the model was not published
+        """
+        examples = collect_examples(self.data_dir, self.training_files)
+        if not force and self.new_reviews(examples) < MIN_NEW_REVIEWS:
+            log("No new reviews since the last retraining")
+            return {}
+        train, holdout = split_holdout(examples)
+        log(f"Retraining on {len(train)} examples, validating on {len(holdout)}")
+
+        # Random Forest fits its trees on every core; the families themselves train side by side
+        with ThreadPoolExecutor(max_workers=len(self.trainers)) as executor:
+            futures = {trainer.name: executor.submit(self.retrain, trainer, train, holdout) for trainer in self.trainers}
+        return {name: future.result() for name, future in futures.items()}
+
+    def retrain(self, trainer: ModelTrainer, train: List[Example], holdout: List[Example]) -> Optional[int]:
+        try:
+            current, current_version = self.registry.load(trainer.name, legacy_file=trainer.legacy_file)
+        except FileNotFoundError:
+            current, current_version = None, None
+        candidate, incremental = trainer.train(train, current)
+
+        metrics = validate(lambda examples: trainer.predict_proba(candidate, examples), holdout) if holdout else {}
+        baseline = None
+        if current is not None and holdout:
+            try:
+                baseline = validate(lambda examples: trainer.predict_proba(current, examples), holdout)
+            except Exception as e:
+                log(f"Could not score the current {trainer.name} model: {e}")
+        if baseline and metrics["accuracy"] < baseline["accuracy"] - TOLERANCE:
+            log(f"Rejected {trainer.name}: accuracy {metrics['accuracy']:.3f} against {baseline['accuracy']:.3f} for version {current_version}")
+            return None
+
+        reviewed_through = max((example.reviewed_at or 0 for example in train + holdout), default=0)
+        version = self.registry.publish(trainer.name, candidate, metrics,
+                                        examples=len(train), incremental=incremental,
+                                        reviewed_through=reviewed_through)
+        log(f"Published {trainer.name} version {version}", event="published", model=trainer.name, version=version, **metrics)
+        return version
+
+
+class RetrainingScheduler:
+    """
+    Runs the retrainer in a background thread at a fixed interval
+    """
+
+    def __init__(self, retrainer: Retrainer, interval: float = DEFAULT_INTERVAL_SECONDS):
+        self.retrainer = retrainer
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> 'RetrainingScheduler':
+        self._thread = threading.Thread(target=self._loop, name="retraining", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.retrainer.run()
+            except Exception as e:
+                logging.exception(f"Retraining failed: {e}")
+            self._stop.wait(self.interval)
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(make_formatter("[%(asctime)s] [%(levelname)s] %(message)s"))
+    logging.basicConfig(level=logging.INFO, handlers=[handler])
+    parser = argparse.ArgumentParser(description="Retrain the anomaly models from reviewed investigations")
+    parser.add_argument("--once", action="store_true", help="retrain once and exit instead of running on a schedule")
+    parser.add_argument("--force", action="store_true", help="retrain even if nothing new has been reviewed")
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL_SECONDS, help="seconds between scheduled runs")
+    parser.add_argument("--training-file", action="append", dest="training_files",
+                        help="curated training file in the data directory (repeatable)")
+    args = parser.parse_args()
+
+    retrainer = Retrainer(os.getenv('DATA_DIR', os.path.join(ROOT_PROJECT_PATH, 'data')), args.training_files or TRAINING_FILES)
+    if args.once:
+        retrainer.run(force=args.force)
+    else:
+        if args.force:
+            retrainer.run(force=True)
+        scheduler = RetrainingScheduler(retrainer, args.interval).start()
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            scheduler.stop()
@@ -1,5 +1,9 @@
+import csv
+import json
 import math
-import matplotlib.pyplot as plt
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
 
 GREEN = "\033[92m"
 YELLOW = "\033[93m"
@@ -7,50 +11,170 @@ RED = "\033[91m"
 RESET = "\033[0m"
 COLOR_MAP = {"red":RED, "orange": YELLOW, "green": GREEN}
 
+# The label treated as the positive class for precision, recall and ROC-AUC
+POSITIVE = "anomalous"
+
+
+def split_prediction(prediction):
+    """
+    A predictor may return just a label, or a (label, probability of POSITIVE) pair
+    """
+    if isinstance(prediction, tuple):
+        return prediction[0], prediction[1]
+    return prediction, None
+
+
+def predict_chunk(predictor, items, batched):
+    """
+    Predict a chunk of items, returning the predictions and the seconds each took.
+    Module level so it can run in a process pool.
+    """
+    start = time.perf_counter()
+    if batched:
+        predictions = list(predictor(items))
+        elapsed = time.perf_counter() - start
+        return predictions, [elapsed / len(items)] * len(items)
+    predictions, latencies = [], []
+    for item in items:
+        predictions.append(predictor(item))
+        latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+    return predictions, latencies
+
+
 class Tester:
 
-    def __init__(self, predictor, data, title=None, size=20):
+    def __init__(self, predictor, data, title=None, size=20, workers=1, batch_size=None,
+                 processes=False, verbose=True, plot=True):
+        """
+        :param predictor: called with a datapoint, returning a label or a (label, probability) pair
+        :param workers: the number of threads (or processes) to predict with
+        :param batch_size: if set, the predictor is called with lists of this many datapoints and returns a list
+        :param processes: use a process pool instead of threads; the predictor must then be picklable
+        :param verbose: print a colored line per datapoint
+        :param plot: draw the confusion matrix when reporting
+        """
         self.predictor = predictor
         self.data = data
         self.title = title or predictor.__name__.replace("_", " ").title()
-        self.size = size
+        self.size = min(size, len(data))
+        self.workers = workers
+        self.batch_size = batch_size
+        self.processes = processes
+        self.verbose = verbose
+        self.plot = plot
         self.guesses = []
         self.truths = []
         self.errors = []
         self.colors = []
+        self.probabilities = []
+        self.latencies = []
 
     def color_for(self, error, truth):
         if not error:
             return "green"
         else:
             return "red"
-    
-    def run_datapoint(self, i):
+
+    def record(self, i, prediction, latency):
         datapoint = self.data[i]
-        guess = self.predictor(datapoint)
+        guess, probability = split_prediction(prediction)
         truth = datapoint.result
         error = guess != truth
         color = self.color_for(error, truth)
-        details = datapoint.details if len(datapoint.details) <= 40 else datapoint.details[:40]+"..."
         self.guesses.append(guess)
-        self.truths.append(truth) 
+        self.truths.append(truth)
         self.errors.append(error)
         self.colors.append(color)
-        print(f"{COLOR_MAP[color]}{i+1}: Guess: {guess} Truth: {truth:} Error: {error:} Item: {details}{RESET}")
+        self.probabilities.append(probability)
+        self.latencies.append(latency)
+        if self.verbose:
+            details = datapoint.details if len(datapoint.details) <= 40 else datapoint.details[:40]+"..."
+            print(f"{COLOR_MAP[color]}{i+1}: Guess: {guess} Truth: {truth:} Error: {error:} Item: {details}{RESET}")
 
-    def chart(self, title):
-        actual = self.truths
-        predicted = self.guesses
-
-        # Get unique classes
-        classes = list(set(actual + predicted))  # Union of unique classes in actual and predicted
+    def run_datapoint(self, i):
+        start = time.perf_counter()
+        prediction = self.predictor(self.data[i])
+        self.record(i, prediction, time.perf_counter() - start)
+
+    def run_parallel(self):
+        """
+        Predict the datapoints in chunks over a pool, recording the results in the original order
+        """
+        chunk_size = self.batch_size or max(1, math.ceil(self.size / (self.workers * 4)))
+        chunks = [list(range(start, min(start + chunk_size, self.size))) for start in range(0, self.size, chunk_size)]
+        pool = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+        with pool(max_workers=self.workers) as executor:
+            futures = [executor.submit(predict_chunk, self.predictor, [self.data[i] for i in chunk], bool(self.batch_size))
+                       for chunk in chunks]
+            for chunk, future in zip(chunks, futures):
+                predictions, latencies = future.result()
+                for i, prediction, latency in zip(chunk, predictions, latencies):
+                    self.record(i, prediction, latency)
+
+    def confusion_matrix(self) -> Dict[str, Dict[str, int]]:
+        classes = sorted(set(self.truths + self.guesses), key=str)
+        matrix = {truth: {guess: 0 for guess in classes} for truth in classes}
+        for truth, guess in zip(self.truths, self.guesses):
+            matrix[truth][guess] += 1
+        return matrix
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Summarize the datapoints that were run: error rate, confusion matrix, precision and recall
+        of the positive class, ROC-AUC when the predictor gave probabilities, and latency
+        """
+        count = len(self.guesses)
+        true_positive = sum(1 for t, g in zip(self.truths, self.guesses) if t == POSITIVE and g == POSITIVE)
+        predicted_positive = sum(1 for g in self.guesses if g == POSITIVE)
+        actual_positive = sum(1 for t in self.truths if t == POSITIVE)
+        precision = true_positive / predicted_positive if predicted_positive else None
+        recall = true_positive / actual_positive if actual_positive else None
+        metrics = {
+            "title": self.title,
+            "count": count,
+            "error": sum(self.errors) / count if count else None,
+            "hits": (count - sum(self.errors)) / count if count else None,
+            "confusion_matrix": self.confusion_matrix(),
+            "precision": precision,
+            "recall": recall,
+            "f1": 2 * precision * recall / (precision + recall) if precision is not None and recall is not None and precision + recall else None,
+            "roc_auc": None,
+        }
+        scored = [(t == POSITIVE, p) for t, p in zip(self.truths, self.probabilities) if p is not None]
+        if scored and len(scored) == count and len({t for t, _ in scored}) == 2:
+            from sklearn.metrics import roc_auc_score
+            metrics["roc_auc"] = float(roc_auc_score([t for t, _ in scored], [p for _, p in scored]))
+        if self.latencies:
+            ordered = sorted(self.latencies)
+            metrics["latency_ms"] = {
+                "mean": 1000 * sum(ordered) / count,
+                "p50": 1000 * ordered[int(0.5 * (count - 1))],
+                "p90": 1000 * ordered[int(0.9 * (count - 1))],
+                "p99": 1000 * ordered[int(0.99 * (count - 1))],
+                "max": 1000 * ordered[-1],
+            }
+        return metrics
+
+    def write_report(self, path: str):
+        """
+        Write the metrics and every prediction to a .json file, or the predictions alone to a .csv file
+        """
+        rows = [{"index": i, "guess": g, "truth": t, "error": e, "probability": p, "latency_ms": 1000 * l}
+                for i, (g, t, e, p, l) in enumerate(zip(self.guesses, self.truths, self.errors, self.probabilities, self.latencies))]
+        with open(path, 'w', newline='') as file:
+            if path.endswith('.csv'):
+                writer = csv.DictWriter(file, fieldnames=list(rows[0].keys()) if rows else ["index"])
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                json.dump({"metrics": self.metrics(), "predictions": rows}, file, indent=2)
 
-        # Initialize the confusion matrix as a dictionary
-        confusion_matrix = {true: {pred: 0 for pred in classes} for true in classes}
+    def chart(self, title):
+        import matplotlib.pyplot as plt
 
-        # Populate the confusion matrix
-        for a, p in zip(actual, predicted):
-            confusion_matrix[a][p] += 1
+        confusion_matrix = self.confusion_matrix()
+        classes = list(confusion_matrix.keys())
 
         # Convert the confusion matrix into a 2D list for visualization
         matrix = [[confusion_matrix[true][pred] for pred in classes] for true in classes]
@@ -69,7 +193,7 @@ class Tester:
         plt.xlabel('Predicted Label')
 
         max_val = max(max(row) for row in matrix) if matrix else 1
-        
+
         # Add text annotations
         for i in range(len(classes)):
             for j in range(len(classes)):
@@ -85,18 +209,40 @@ class Tester:
 
 
     def report(self):
-        average_error = sum(self.errors) / self.size
-        hits = sum(1 for color in self.colors if color=="green")
-        title = f"{self.title} Error={average_error:,.2f} Hits={hits/self.size*100:.1f}%"
-        self.chart(title)
+        metrics = self.metrics()
+        if metrics["count"] == 0:
+            return metrics
+        title = f"{self.title} Error={metrics['error']:,.2f} Hits={metrics['hits']*100:.1f}%"
+        if self.plot:
+            self.chart(title)
+        else:
+            print(title)
+        return metrics
 
     def run(self):
-        self.error = 0
-        for i in range(self.size):
-            self.run_datapoint(i)
-        self.report()
+        if self.workers > 1 or self.batch_size:
+            self.run_parallel()
+        else:
+            for i in range(self.size):
+                self.run_datapoint(i)
+        return self.report()
 
     @classmethod
     def test(cls, function, data):
         cls(function, data, size=len(data)).run()
-        #cls(function, data, size=1).run() #uncomment this line when we want to just test
\ No newline at end of file
+        #cls(function, data, size=1).run() #uncomment this line when we want to just test
+
+    @classmethod
+    def evaluate(cls, function, data, workers=4, batch_size=None, processes=False,
+                 report_path: Optional[str] = None, plot=False) -> Dict[str, Any]:
+        """
+        Evaluate a predictor over all the data without printing a line per datapoint, as in CI
+        :param report_path: where to write a .json or .csv report, if anywhere
+        :return: the metrics
+        """
+        tester = cls(function, data, size=len(data), workers=workers, batch_size=batch_size,
+                     processes=processes, verbose=False, plot=plot)
+        metrics = tester.run()
+        if report_path:
+            tester.write_report(report_path)
+        return metrics
@@ -0,0 +1,72 @@
+import time
+
+from agents.events import SensorEvent
+from agents.investigation_store import InvestigationStore
+from agents.llm import StubClient
+from agents.rotating_json_file import RotatingJSONFile
+from agents.scanner_agent import ScannerAgent
+from agents.situations import Investigation
+from backfill import RETENTION_WEEKS, Backfill, Checkpoint
+
+HOUR = 60 * 60
+# Recent enough that nothing rotates out, and spread so every event starts a window of its own
+START = int(time.time()) - 30 * 24 * HOUR
+
+
+def events(count):
+    return [SensorEvent.from_dict({"timestamp": START + index * 12 * HOUR, "room": "kitchen", "nodeId": 1,
+                                   "endpointId": 1, "attribute": {"OnOff": {"OnOff": True}}})
+            for index in range(count)]
+
+
+def memory(path):
+    return RotatingJSONFile(path, retention_weeks=RETENTION_WEEKS, is_jsonl=False)
+
+
+def investigation(start):
+    return Investigation(**{
+        "situation": {"situation_description": f"window {start}", "result": "normal", "start_timestamp": start,
+                      "end_timestamp": start + 3599, "details": []},
+        "estimate": "normal",
+    })
+
+
+class InterleavingPool:
+    """
+    Stands in for the worker pool; before predicting each batch it lets another writer save,
+    so every batch is saved over a file changed since the backfill last read it
+    """
+
+    def __init__(self, between):
+        self.between = between
+
+    def predict(self, situations):
+        self.between()
+        return [{} for _ in situations]
+
+
+def test_a_backfill_and_a_running_store_keep_each_others_investigations(tmp_path):
+    path = str(tmp_path / "memory.json")
+    ui = InvestigationStore(memory(path)).load()
+    ui.add(investigation(START - HOUR))
+    ui.save()
+    created = []
+
+    def ui_saves():
+        # The agents keep creating investigations while the backfill runs
+        created.append(int(time.time()) - len(created) * HOUR)
+        ui.add(investigation(created[-1]))
+        ui.save()
+
+    store = InvestigationStore(memory(path)).load()
+    backfill = Backfill(store, ScannerAgent(StubClient()), InterleavingPool(ui_saves))
+    totals = backfill.run(iter(events(6)), Checkpoint(str(tmp_path / "checkpoint.json")), batch_size=2)
+    assert totals["investigations"] == 6
+    ui_saves()
+
+    on_disk = InvestigationStore(memory(path)).load()
+    starts = {investigation.situation.start_timestamp for investigation in on_disk.investigations}
+    assert {event.timestamp for event in events(6)} <= starts
+    assert {START - HOUR, *created} <= starts
+    assert len(on_disk) == 1 + 6 + len(created)
+    assert len(ui) == len(on_disk)
@@ -0,0 +1,125 @@
+import socket
+import threading
+import zlib
+
+import numpy as np
+import pytest
+
+from agents.embeddings import EmbeddingServer, EmbeddingService, RemoteEmbeddings, connect
+
+DIMENSION = 16
+
+
+class HashingModel:
+    """
+    Stands in for the SentenceTransformer: a bag of hashed words, recording the size of each batch
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def get_sentence_embedding_dimension(self):
+        return DIMENSION
+
+    def encode(self, texts, batch_size=None, normalize_embeddings=False, convert_to_numpy=True):
+        self.gate.wait(5)
+        self.batches.append(len(texts))
+        if any(text == "fail" for text in texts):
+            raise ValueError("cannot encode")
+        vectors = np.zeros((len(texts), DIMENSION), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.split():
+                vectors[row, zlib.crc32(word.encode()) % DIMENSION] += 1
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-9)
+
+
+def embed_concurrently(service, texts):
+    results = [None] * len(texts)
+
+    def run(index):
+        results[index] = service.embed(texts[index])
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(len(texts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+@pytest.fixture
+def model():
+    return HashingModel()
+
+
+@pytest.fixture
+def server(tmp_path, model):
+    server = EmbeddingServer(str(tmp_path / "embeddings.sock"), EmbeddingService(model, max_wait=0.05), idle_timeout=None)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.close()
+    thread.join(5)
+
+
+def test_concurrent_requests_are_encoded_in_batches(model):
+    service = EmbeddingService(model, batch_size=64, max_wait=0.05)
+    texts = [f"kitchen motion at night {index}" for index in range(20)]
+    results = embed_concurrently(service, texts)
+    assert sum(model.batches) == 20
+    assert len(model.batches) < 20
+    for text, vector in zip(texts, results):
+        assert np.allclose(vector, model.encode([text])[0])
+
+
+def test_a_list_gives_a_row_per_text_and_nothing_gives_no_rows(model):
+    service = EmbeddingService(model)
+    assert service.embed(["a", "b c"]).shape == (2, DIMENSION)
+    assert service.embed([]).shape == (0, DIMENSION)
+
+
+def test_processes_share_the_server_model(server, model):
+    remote = RemoteEmbeddings(server.address)
+    assert remote.dimension == DIMENSION
+    texts = [f"bathroom door opened {index}" for index in range(12)]
+    results = embed_concurrently(remote, texts)
+    assert len(model.batches) < 12
+    for text, vector in zip(texts, results):
+        assert vector.dtype == np.float32
+        assert np.allclose(vector, model.encode([text])[0])
+    assert remote.embed(["one", "two"]).shape == (2, DIMENSION)
+
+
+def test_encoding_errors_reach_the_caller(server):
+    remote = RemoteEmbeddings(server.address)
+    with pytest.raises(RuntimeError, match="cannot encode"):
+        remote.embed("fail")
+    # The connection is still usable
+    assert remote.embed("pillbox opened").shape == (DIMENSION,)
+
+
+def test_connect_uses_a_listening_server(server):
+    assert connect(server.address, timeout=1).embed("porch occupied").shape == (DIMENSION,)
+
+
+def test_a_second_server_at_the_same_address_is_refused(server, model):
+    with pytest.raises(FileExistsError):
+        EmbeddingServer(server.address, EmbeddingService(model))
+
+
+def test_a_socket_left_behind_is_replaced(tmp_path, model):
+    address = str(tmp_path / "stale.sock")
+    # A server that died without cleaning up: the file remains, nobody listens
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(address)
+    stale.close()
+    server = EmbeddingServer(address, EmbeddingService(model), idle_timeout=None)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        assert RemoteEmbeddings(address).embed("hall light on").shape == (DIMENSION,)
+    finally:
+        server.close()
+        thread.join(5)
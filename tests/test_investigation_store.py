@@ -0,0 +1,95 @@
+import time
+
+from agents.investigation_store import InvestigationStore
+from agents.rotating_json_file import RotatingJSONFile
+from agents.situations import Investigation
+
+
+def investigation(age, estimate="normal"):
+    start = int(time.time()) - age
+    return Investigation(**{
+        "situation": {"situation_description": f"window {start}", "result": estimate, "start_timestamp": start,
+                      "end_timestamp": start + 3599, "details": []},
+        "estimate": estimate,
+    })
+
+
+def test_daily_revision_moves_on_across_a_rebuild(tmp_path):
+    store = InvestigationStore(RotatingJSONFile(str(tmp_path / "memory.json"), is_jsonl=False)).load()
+    store.add(investigation(3600, "anomalous"))
+    seen = store.daily.revision
+    # Reloading counts the same single anomaly from scratch, which must not reuse the revision
+    store.load()
+    assert store.daily.revision > seen
+
+
+def test_stores_sharing_a_file_keep_each_others_investigations(tmp_path):
+    path = str(tmp_path / "memory.json")
+    first = InvestigationStore(RotatingJSONFile(path, is_jsonl=False)).load()
+    second = InvestigationStore(RotatingJSONFile(path, is_jsonl=False)).load()
+
+    first.add(investigation(7200))
+    first.save()
+    second.add(investigation(3600, "anomalous"))
+    second.save()
+    first.add(investigation(0))
+    first.save()
+
+    on_disk = InvestigationStore(RotatingJSONFile(path, is_jsonl=False)).load()
+    assert len(on_disk) == 3
+    assert on_disk.count("anomalous") == 1
+    assert len(first) == 3
+
+
+def test_a_save_keeps_what_another_process_saved_since_the_last_refresh(tmp_path):
+    path = str(tmp_path / "memory.json")
+    agents = InvestigationStore(RotatingJSONFile(path, is_jsonl=False)).load()
+    agents.add(investigation(7200))
+    agents.save()
+    dashboard = InvestigationStore(RotatingJSONFile(path, is_jsonl=False)).load()
+
+    # The agents refresh, then plan; meanwhile the dashboard relabels and another investigation is saved
+    agents.refresh()
+    reviewed = dashboard.get(0).model_copy(update={"estimate": "anomalous", "reviewed_at": int(time.time())})
+    dashboard.update(0, reviewed)
+    dashboard.add(investigation(3600))
+    dashboard.save()
+    agents.add(investigation(0))
+    agents.save()
+
+    on_disk = InvestigationStore(RotatingJSONFile(path, is_jsonl=False)).load()
+    assert len(on_disk) == 3
+    assert on_disk.get(on_disk.position(reviewed.id)) == reviewed
+
+
+def test_a_review_made_elsewhere_stands_over_an_estimate_made_here(tmp_path):
+    path = str(tmp_path / "memory.json")
+    backfill = InvestigationStore(RotatingJSONFile(path, is_jsonl=False)).load()
+    backfill.add(investigation(3600))
+    backfill.save()
+    dashboard = InvestigationStore(RotatingJSONFile(path, is_jsonl=False)).load()
+
+    # The backfill re-estimates an investigation a person is relabelling at the same time
+    backfill.update(0, backfill.get(0).model_copy(update={"estimate": "anomalous",
+                                                          "situation": investigation(3600).situation}))
+    dashboard.update(0, dashboard.get(0).model_copy(update={"estimate": "normal", "reviewed_at": int(time.time())}))
+    dashboard.save()
+    backfill.save()
+
+    [saved] = InvestigationStore(RotatingJSONFile(path, is_jsonl=False)).load().investigations
+    assert (saved.estimate, saved.reviewed_at) == ("normal", dashboard.get(0).reviewed_at)
+
+
+def test_a_refresh_keeps_changes_not_yet_saved(tmp_path):
+    path = str(tmp_path / "memory.json")
+    first = InvestigationStore(RotatingJSONFile(path, is_jsonl=False)).load()
+    first.add(investigation(7200))
+    first.save()
+    second = InvestigationStore(RotatingJSONFile(path, is_jsonl=False)).load()
+    second.add(investigation(3600))
+    second.save()
+
+    unsaved = first.add(investigation(0, "anomalous"))
+    assert first.refresh()
+    assert len(first) == 3
+    assert first.get(unsaved).estimate == "anomalous"
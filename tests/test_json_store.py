@@ -0,0 +1,130 @@
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from agents.json_store import FileLock
+from agents.rotating_json_file import RotatingJSONFile
+
+HOLD = """
+import sys, time
+sys.path.insert(0, {src!r})
+from agents.json_store import FileLock
+with FileLock({path!r}).shared():
+    print("held", flush=True)
+    time.sleep({seconds})
+"""
+
+
+def record(start, batch):
+    return {"situation": {"start_timestamp": start}, "batch": batch}
+
+
+def test_readers_share_the_lock(tmp_path):
+    lock = FileLock(str(tmp_path / "data.json"))
+    inside, both = threading.Barrier(2, timeout=5), []
+
+    def read():
+        with lock.shared():
+            # Each reader waits here for the other, which only passes if both hold the lock at once
+            inside.wait()
+            both.append(True)
+
+    readers = [threading.Thread(target=read) for _ in range(2)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    assert both == [True, True]
+
+
+def test_writer_waits_for_a_reader(tmp_path):
+    lock = FileLock(str(tmp_path / "data.json"))
+    reading, order = threading.Event(), []
+
+    def write():
+        reading.wait()
+        with lock:
+            order.append("write")
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    with lock.shared():
+        reading.set()
+        time.sleep(0.2)
+        order.append("read")
+    writer.join(timeout=5)
+    assert order == ["read", "write"]
+
+
+def test_writer_waits_for_a_reader_in_another_process(tmp_path):
+    path = str(tmp_path / "data.json")
+    src = str(Path(__file__).parent.parent / "src")
+    reader = subprocess.Popen([sys.executable, "-c", HOLD.format(src=src, path=path, seconds=0.5)],
+                              stdout=subprocess.PIPE, text=True)
+    try:
+        assert reader.stdout.readline().strip() == "held"
+        started = time.monotonic()
+        with FileLock(path):
+            waited = time.monotonic() - started
+    finally:
+        reader.wait(timeout=5)
+    assert waited > 0.2
+
+
+def test_shared_lock_is_reentrant_and_cannot_be_upgraded(tmp_path):
+    lock = FileLock(str(tmp_path / "data.json"))
+    with lock.shared():
+        with lock.shared():
+            assert lock.held_shared()
+        with pytest.raises(RuntimeError):
+            lock.acquire()
+        assert lock.held_shared()
+    assert not lock.held_shared()
+    # Released, it can be taken exclusively, and shared within that
+    with lock:
+        with lock.shared():
+            assert lock.held()
+
+
+def test_writing_while_reading_is_refused(tmp_path):
+    file = RotatingJSONFile(str(tmp_path / "data.json"), is_jsonl=False)
+    with file.lock.shared():
+        with pytest.raises(RuntimeError):
+            file.overwrite([record(int(time.time()), 0)])
+
+
+def test_concurrent_reads_see_whole_writes(tmp_path):
+    file = RotatingJSONFile(str(tmp_path / "data.json"), is_jsonl=False)
+    now = int(time.time())
+    file.overwrite([record(now, 0)])
+    done, seen, errors = threading.Event(), set(), []
+
+    def read():
+        while not done.is_set():
+            try:
+                records = file.read()
+                # A write replaces every record with ones of its own batch
+                batches = {record["batch"] for record in records}
+                assert len(records) == 10 or batches == {0}
+                assert len(batches) == 1
+                seen.update(batches)
+            except Exception as error:
+                errors.append(error)
+                return
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    try:
+        for batch in range(1, 30):
+            file.overwrite([record(now, batch) for _ in range(10)])
+    finally:
+        done.set()
+    for reader in readers:
+        reader.join()
+    assert errors == []
+    assert len(seen) > 1
@@ -0,0 +1,136 @@
+import threading
+import time
+
+import pytest
+
+from agents.llm import Priority, RateLimited, StubClient
+from agents.llm_scheduler import LLMScheduler, TokenBucket
+
+MESSAGES = [{"role": "user", "content": "Is this normal?"}]
+
+
+def send(scheduler, count, priority=Priority.BACKLOG, max_tokens=5):
+    for _ in range(count):
+        scheduler.complete(MESSAGES, "gpt-4o-mini", max_tokens=max_tokens, priority=priority)
+
+
+def test_token_bucket_refills_continuously_up_to_its_capacity():
+    bucket = TokenBucket(60, window=60.0)
+    start = bucket.updated
+    assert bucket.wait_time(60, start) == 0
+    bucket.take(60, start)
+    assert bucket.wait_time(1, start) == pytest.approx(1.0)
+    assert bucket.wait_time(1, start + 1.0) == pytest.approx(0.0)
+    # Never more than a full bucket, however long it waits
+    assert bucket.wait_time(60, start + 3600) == 0
+    assert bucket.level == 60
+    # A request larger than the budget waits for a full bucket rather than forever
+    bucket.take(60, start + 3600)
+    assert bucket.wait_time(100, start + 3600) == pytest.approx(60.0)
+
+
+def test_requests_per_window_are_held_to_the_budget():
+    stub = StubClient(max_concurrency=4)
+    scheduler = LLMScheduler(stub, rpm=5, tpm=1_000_000, window=1.0)
+    started = time.monotonic()
+    send(scheduler, 10)
+    # Five go at once from the full bucket; the other five wait for it to refill at five a second
+    assert time.monotonic() - started >= 0.9
+    assert stub.calls == 10
+
+
+def test_tokens_per_window_are_held_to_the_budget():
+    # Replies of about 400 tokens, so about two requests fit in the bucket at once
+    stub = StubClient(max_concurrency=4, responder=lambda messages, response_format: "normal " * 400)
+    scheduler = LLMScheduler(stub, rpm=1000, tpm=1000, window=1.0)
+    started = time.monotonic()
+    send(scheduler, 5, max_tokens=400)
+    # Three of them wait for about 400 tokens each to refill, at 1000 a second
+    assert time.monotonic() - started >= 0.8
+    assert stub.calls == 5
+
+
+def test_a_provider_is_never_overrun_by_a_scheduler_within_its_limits():
+    # A bucket lets a full budget through at once and then refills, so any window of the provider's
+    # sees up to twice the budget: the scheduler's is set to less than half the provider's limit
+    stub = StubClient(max_concurrency=4, rpm_limit=10, window=1.0)
+    scheduler = LLMScheduler(stub, rpm=4, tpm=1_000_000, window=1.0)
+    threads = [threading.Thread(target=send, args=(scheduler, 5)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert stub.calls == 20
+    assert stub.throttled == 0
+
+
+def test_requests_are_sent_by_priority_then_in_order():
+    release = threading.Event()
+    order = []
+
+    def responder(messages, response_format):
+        order.append(messages[0]["content"])
+        if messages[0]["content"] == "first":
+            release.wait(5)
+        return "normal"
+
+    scheduler = LLMScheduler(StubClient(max_concurrency=1, responder=responder), rpm=1000, tpm=1_000_000)
+    first = threading.Thread(target=scheduler.complete, args=([{"role": "user", "content": "first"}], "gpt-4o-mini"))
+    first.start()
+    while not order:
+        time.sleep(0.01)
+
+    threads = []
+    for content, priority in (("backlog 1", Priority.BACKLOG), ("backlog 2", Priority.BACKLOG),
+                              ("alert", Priority.ALERT)):
+        thread = threading.Thread(target=scheduler.complete,
+                                  args=([{"role": "user", "content": content}], "gpt-4o-mini"),
+                                  kwargs={"priority": priority})
+        thread.start()
+        threads.append(thread)
+        # Queued one after the other, so their order within a priority is known
+        while len(scheduler._queue) < len(threads):
+            time.sleep(0.01)
+
+    release.set()
+    for thread in [first] + threads:
+        thread.join(5)
+    assert order == ["first", "alert", "backlog 1", "backlog 2"]
+
+
+def test_throttling_halves_the_requests_in_flight_and_quick_replies_restore_them():
+    stub = StubClient(max_concurrency=4, rpm_limit=2, window=0.2)
+    scheduler = LLMScheduler(stub, rpm=1000, tpm=1_000_000, max_retries=10)
+    assert scheduler.limit == 4
+    threads = [threading.Thread(target=send, args=(scheduler, 1)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert stub.throttled >= 1
+    assert stub.calls == 4
+    assert scheduler.limit < 4
+
+    # Additive increase: one more in flight after each round of quick replies
+    stub.rpm_limit = None
+    limits = []
+    for _ in range(10):
+        send(scheduler, 1)
+        limits.append(scheduler.limit)
+    assert limits == sorted(limits)
+    assert scheduler.limit == 4
+
+
+def test_slow_replies_reduce_the_requests_in_flight():
+    scheduler = LLMScheduler(StubClient(max_concurrency=4, latency=0.02), rpm=1000, tpm=1_000_000,
+                             target_latency=0.005)
+    send(scheduler, 3)
+    assert scheduler.limit == 1
+
+
+def test_a_request_still_refused_after_its_retries_raises():
+    stub = StubClient(max_concurrency=1, rpm_limit=0, window=0.05)
+    scheduler = LLMScheduler(stub, rpm=1000, tpm=1_000_000, max_retries=1)
+    with pytest.raises(RateLimited):
+        send(scheduler, 1)
+    assert stub.throttled == 2
@@ -0,0 +1,54 @@
+from datetime import datetime
+
+from agents.events import SensorEvent
+from agents.prompt_builder import REPEAT_SECONDS, TIMEZONE, encode_events
+
+START = int(datetime(2025, 1, 26, 20, 1, tzinfo=TIMEZONE).timestamp())
+
+
+def event(offset, room, attribute, node=1):
+    return SensorEvent.from_dict({"timestamp": START + offset, "room": room, "nodeId": node, "endpointId": 1,
+                                  "attribute": attribute})
+
+
+def fridge(offset):
+    return event(offset, "kitchen", {"BooleanState": {"StateValue": "fridge_opened"}}, node=2)
+
+
+def pillbox(offset):
+    return event(offset, "pillbox", {"OnOff": {"OnOff": True}}, node=3)
+
+
+def test_a_repeat_separated_by_other_events_is_kept():
+    # The evening fridge opening, the pillbox, then the fridge again at 02:03 the next night
+    night = 6 * 3600 + 2 * 60
+    lines = encode_events([fridge(0), pillbox(600), fridge(night)])
+    assert lines == [
+        "[Sun Jan 26 2025]",
+        "20:01:00 kitchen BooleanState.StateValue=fridge_opened",
+        "20:11:00 pillbox OnOff=true",
+        "[Mon Jan 27 2025]",
+        "02:03:00 kitchen BooleanState.StateValue=fridge_opened",
+    ]
+
+
+def test_a_repeat_long_after_the_event_before_is_kept():
+    lines = encode_events([pillbox(0), pillbox(3600)])
+    assert lines[1:] == ["20:01:00 pillbox OnOff=true", "21:01:00 pillbox OnOff=true"]
+
+
+def test_an_immediate_duplicate_report_is_dropped():
+    lines = encode_events([pillbox(0), pillbox(REPEAT_SECONDS), fridge(REPEAT_SECONDS + 5)])
+    assert lines[1:] == ["20:01:00 pillbox OnOff=true", "20:02:05 kitchen BooleanState.StateValue=fridge_opened"]
+
+
+def test_the_same_reading_from_another_sensor_is_kept():
+    lines = encode_events([pillbox(0), event(1, "bathroom", {"OnOff": {"OnOff": True}}, node=4)])
+    assert lines[1:] == ["20:01:00 pillbox OnOff=true", "20:01:01 bathroom OnOff=true"]
+
+
+def test_occupancy_pings_in_a_room_become_one_line():
+    # The last ping repeats the one before it within REPEAT_SECONDS, so only three are changes
+    pings = [event(offset, "porch", {"OccupancySensing": {"Occupancy": occupied}}, node=5)
+             for offset, occupied in ((0, 1), (120, 0), (240, 1), (270, 1))]
+    assert encode_events(pings)[1:] == ["20:01:00-20:05:00 porch occupancy changed 3 times, ends occupied"]
@@ -0,0 +1,73 @@
+import json
+import time
+
+from agents.investigation_store import InvestigationStore
+from agents.rotating_json_file import RotatingJSONFile, record_key
+from agents.situations import Investigation
+
+WEEK = 7 * 24 * 60 * 60
+
+
+def investigation(age, estimate="normal"):
+    start = int(time.time()) - age
+    return {
+        "situation": {"situation_description": f"window {start}", "result": estimate, "start_timestamp": start,
+                      "end_timestamp": start + 3599, "details": []},
+        "estimate": estimate,
+    }
+
+
+def archived(file):
+    return [record_key(entry) for entry in file.read_archives()]
+
+
+def test_rotated_investigations_are_archived_once_across_saves(tmp_path):
+    memory = RotatingJSONFile(str(tmp_path / "memory.json"), retention_weeks=4, is_jsonl=False)
+    memory.overwrite([investigation(8 * WEEK), investigation(6 * WEEK), investigation(WEEK)])
+    memory.retention_weeks = 52
+    store = InvestigationStore(memory).load()
+    assert len(store) == 3
+
+    # The retention shrinks under the loaded store; each save rotates first
+    memory.retention_weeks = 4
+    store.add(Investigation(**investigation(0, "anomalous")))
+    for _ in range(3):
+        store.save()
+        memory.rotate()
+
+    keys = archived(memory)
+    assert len(keys) == 2
+    assert len(set(keys)) == 2
+    assert len(store) == 2
+    assert store.count("anomalous") == 1
+    assert [record["situation"]["start_timestamp"] for record in memory.read()] == \
+           [investigation.situation.start_timestamp for investigation in store.investigations]
+
+
+def test_a_record_written_back_after_rotation_is_not_archived_again(tmp_path):
+    events = RotatingJSONFile(str(tmp_path / "events.json"), retention_weeks=1, is_jsonl=True)
+    old = {"timestamp": int(time.time()) - 2 * WEEK, "room": "kitchen"}
+    new = {"timestamp": int(time.time()), "room": "hall"}
+    events.write([dict(old), dict(new)])
+    events.rotate()
+    assert events.read() == [new]
+
+    # A writer holding an old copy appends the rotated event again
+    events.write([dict(old)])
+    events.rotate()
+    assert events.read() == [new]
+    assert archived(events) == [record_key(old)]
+    assert len(events.segments()) == 1
+
+
+def test_old_investigations_never_saved_are_written_for_rotation_to_archive(tmp_path):
+    memory = RotatingJSONFile(str(tmp_path / "memory.json"), retention_weeks=4, is_jsonl=False)
+    store = InvestigationStore(memory).load()
+    store.add(Investigation(**investigation(8 * WEEK)))
+    store.save()
+    memory.rotate()
+    assert len(archived(memory)) == 1
+    store.save()
+    memory.rotate()
+    assert len(archived(memory)) == 1
+    assert json.loads((tmp_path / "memory.json").read_text()) == []